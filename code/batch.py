@@ -0,0 +1,439 @@
+################################################################
+#
+#  Batch mode: run many TOPCAT analyses (one config.ini each) under one scheduler
+#
+#  Rather than launching a separate driver.py per docket, this runs the
+#  stages of every analysis (see driver.py --stage) from a shared worker pool:
+#
+#    extract     one task per analysis
+#    preprocess  one task per group of analyses sharing a preprocessing script and
+#                stoplist, so spaCy starts up once per group rather than once per analysis
+#    profile     one task per analysis, if profile = true in its config
+#    prune       one task per analysis, if its config sets mindf, maxdf or maxvocab
+#    sweep       one task per analysis, if sweep is set in its config; with
+#                granularities = auto, the analysis's model, curate and later tasks
+#                are planned once it has written its recommendation
+#    search      one task per analysis, if hypersearch = true in its config
+#    import      one task per analysis with package = mallet: the training documents
+#                are imported once, and every granularity's model task reads them
+#    model       one task per analysis and granularity (a MALLET JVM, or one per
+#                parallel seed when the config sets ensemble)
+#    infer       one task per analysis, if infercsv is set in its config (all of its
+#                granularities in one task, so they share the preprocessed shards)
+#    merge       one task per analysis, if mergetopics = true in its config (then only
+#                the finest granularity has a model task)
+#    curate      one task per analysis and granularity
+#    organize    one task per analysis
+#
+#  Ready tasks are interleaved round-robin across analyses. MALLET tasks are
+#  charged against a shared core and JVM heap budget, so the number of JVMs
+#  competing for the machine stays bounded; a JVM that runs out of memory is
+#  retried with no more than its --mallet_heap_gb. A combined status and timing
+#  report (batch_report.json and batch_report.txt) is rewritten as tasks finish,
+#  and each task's output goes to its own log file.
+#
+#  Example:
+#    python code/batch.py --configs docket1.ini docket2.ini docket3.ini
+#                         --workers 6 --cores 12 --heap_gb 24
+#                         --mallet_threads 2 --mallet_heap_gb 4
+#                         --report_dir batch_out
+#
+#  An analysis whose task fails is marked failed and its remaining stages are
+#  skipped; the other analyses carry on.
+#
+################################################################
+import argparse
+import concurrent.futures
+import configparser
+import json
+import os
+import subprocess
+import sys
+import time
+
+driver_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'driver.py')
+
+STAGE_ORDER = ['extract', 'preprocess', 'profile', 'prune', 'sweep', 'search', 'import', 'model', 'infer', 'merge', 'curate', 'organize']
+
+
+class Task:
+    def __init__(self, name, analyses, stage, granularity=None, cores=1, heap_gb=0, deps=()):
+        self.name        = name
+        self.analyses    = analyses       # analysis names this task belongs to
+        self.stage       = stage
+        self.granularity = granularity
+        self.cores       = cores
+        self.heap_gb     = heap_gb
+        self.deps        = list(deps)
+        self.cmd         = None
+        self.env         = None
+        self.makedirs    = []             # directories to create before running
+        self.then        = None           # called once the task is done, returning further tasks to schedule
+        self.status      = 'pending'      # pending, running, done, failed, skipped
+        self.start       = None
+        self.end         = None
+        self.returncode  = None
+        self.log         = None
+
+    def seconds(self):
+        if self.start is None or self.end is None:
+            return None
+        return round(self.end - self.start, 1)
+
+    def as_dict(self):
+        return {'task': self.name, 'analyses': self.analyses, 'stage': self.stage,
+                'granularity': self.granularity, 'status': self.status,
+                'cores': self.cores, 'heap_gb': self.heap_gb,
+                'start': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.start)) if self.start else None,
+                'seconds': self.seconds(), 'returncode': self.returncode, 'log': self.log}
+
+
+def batch_granularities(config_file, config):
+    # granularities = auto means the sweep's recommendation (see driver.granularity_list), which is only
+    # known once the analysis's sweep task has run: None until then (see sweep_granularities)
+    granularities = config.get('variables', 'granularities')
+    if granularities.strip() != 'auto':
+        return [int(x) for x in granularities.split()]
+    if not config.get('variables', 'sweep', fallback='').strip():
+        sys.exit("Error: {} has granularities = auto but no sweep granularities to choose from; "
+                 "set sweep in the config".format(config_file))
+    return None
+
+
+def sweep_granularities(analysis):
+    # The granularities the analysis's sweep recommended, from the report its sweep task wrote
+    with open(os.path.join(analysis['workdir'], 'granularity_sweep', 'sweep.json')) as f:
+        return json.load(f)['recommended']
+
+
+def read_analysis(config_file):
+    # The handful of config.ini values the scheduler needs; driver.py reads the rest
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    get = lambda key: config.get('variables', key)
+    return {'config':        os.path.abspath(config_file),
+            'name':          os.path.splitext(os.path.basename(config_file))[0],
+            'modelname':     get('modelname'),
+            'preproc':       get('preproc'),
+            'stoplist':      get('stoplist'),
+            'rawdocs':       get('rawdocs'),
+            'preprocdir':    get('preprocdir'),
+            'workdir':       get('workdir'),
+            'profile':       config.getboolean('variables', 'profile', fallback=True),
+            'infercsv':      config.get('variables', 'infercsv', fallback=''),
+            'package':       config.get('variables', 'package', fallback='mallet'),
+            'sweep':         config.get('variables', 'sweep', fallback='').strip(),
+            'sweepjobs':     config.getint('variables', 'sweepjobs', fallback=0),
+            'hypersearch':   config.getboolean('variables', 'hypersearch', fallback=False),
+            'hypersearchjobs': config.getint('variables', 'hypersearchjobs', fallback=0),
+            'prune':         (config.getint('variables', 'mindf', fallback=1) > 1 or
+                              config.getfloat('variables', 'maxdf', fallback=1.0) < 1 or
+                              config.getint('variables', 'maxvocab', fallback=0) > 0),
+            'mergetopics':   config.getboolean('variables', 'mergetopics', fallback=False),
+            'ensemble':      config.getint('variables', 'ensemble', fallback=1),
+            'ensemblejobs':  config.getint('variables', 'ensemblejobs', fallback=0),
+            'granularities': batch_granularities(config_file, config)}
+
+
+def mallet_env(args, **extra):
+    # Environment for a MALLET task: each JVM's heap, also the most an out-of-memory retry may
+    # take (see mallet_utils.max_memory), so retries stay within what the scheduler reserved
+    heap = "{}g".format(args.mallet_heap_gb)
+    return dict(os.environ, MALLET_MEMORY=heap, MALLET_MAX_MEMORY=heap, **extra)
+
+
+def build_tasks(analyses, args, logdir):
+    tasks = []
+    def driver_cmd(analysis, stage, granularity=None):
+        cmd = ['python', driver_script, '--config', analysis['config'], '--stage', stage]
+        if granularity is not None:
+            cmd += ['--granularity', str(granularity)]
+        if args.output_safe:
+            cmd += ['--output-safe']
+        return cmd
+
+    def plan_models(a, ready, granularities):
+        # Analysis A's model, inference, merge, curation and organize tasks, all after READY
+        planned = []
+        curate  = []
+        models  = []
+        # With ensemble > 1, a model task trains several seeds at once (see driver.py run_ensemble)
+        runs = min(a['ensemble'], a['ensemblejobs'] or a['ensemble'])
+        # With mergetopics, only the finest granularity is trained and the others are merged from it
+        trained = [max(granularities)] if a['mergetopics'] else granularities
+        for k in trained:
+            m = Task("{}:model_k{}".format(a['name'], k), [a['name']], 'model', k,
+                     cores=args.mallet_threads * runs, heap_gb=args.mallet_heap_gb * runs, deps=[ready])
+            m.cmd = driver_cmd(a, 'model', k)
+            m.env = mallet_env(args, MALLET_THREADS=str(args.mallet_threads))
+            c = Task("{}:curate_k{}".format(a['name'], k), [a['name']], 'curate', k, deps=[m])
+            c.cmd = driver_cmd(a, 'curate', k)
+            planned.extend([m, c])
+            models.append(m)
+            curate.append(c)
+        if a['infercsv']:
+            t = Task("{}:infer".format(a['name']), [a['name']], 'infer',
+                     cores=args.mallet_threads, heap_gb=args.mallet_heap_gb, deps=models)
+            t.cmd = driver_cmd(a, 'infer')
+            t.env = mallet_env(args)
+            planned.append(t)
+            curate.append(t)
+        if a['mergetopics']:
+            # After inference, so that inferred documents are merged too
+            merge = Task("{}:merge".format(a['name']), [a['name']], 'merge',
+                         deps=models + [t for t in curate if t.stage == 'infer'])
+            merge.cmd = driver_cmd(a, 'merge')
+            planned.append(merge)
+            for k in granularities:
+                if k not in trained:
+                    c = Task("{}:curate_k{}".format(a['name'], k), [a['name']], 'curate', k, deps=[merge])
+                    c.cmd = driver_cmd(a, 'curate', k)
+                    planned.append(c)
+                    curate.append(c)
+        t = Task("{}:organize".format(a['name']), [a['name']], 'organize', deps=curate)
+        t.cmd = driver_cmd(a, 'organize')
+        planned.append(t)
+        for t in planned:
+            t.log = os.path.join(logdir, t.name.replace(':', '_') + '.log')
+        return planned
+
+    extract = {}
+    for a in analyses:
+        t = Task("{}:extract".format(a['name']), [a['name']], 'extract')
+        t.cmd = driver_cmd(a, 'extract')
+        extract[a['name']] = t
+        tasks.append(t)
+
+    # One preprocessing task per (script, stoplist) group: a single spaCy startup for all of them.
+    # Output goes where driver.py --stage preprocess would put it (see driver.preprocessed_docs_file).
+    groups = {}
+    for a in analyses:
+        groups.setdefault((a['preproc'], a['stoplist']), []).append(a)
+    preprocess = {}
+    for i, ((preproc, stoplist), members) in enumerate(sorted(groups.items())):
+        jobsfile = os.path.join(logdir, "preprocess_jobs_{}.tsv".format(i + 1))
+        with open(jobsfile, 'w') as f:
+            for a in members:
+                outfile = os.path.join(a['preprocdir'], "{}_preprocessed.txt".format(a['modelname']))
+                f.write("{}\t{}\t{}\n".format(a['rawdocs'], outfile, a['modelname']))
+        t = Task("preprocess_{}".format(i + 1), [a['name'] for a in members], 'preprocess',
+                 deps=[extract[a['name']] for a in members])
+        t.cmd      = ['python', preproc, '--stoplist', stoplist, '--jobs', jobsfile]
+        t.makedirs = [a['preprocdir'] for a in members]
+        for a in members:
+            preprocess[a['name']] = t
+        tasks.append(t)
+
+    for a in analyses:
+        if a['profile']:
+            t = Task("{}:profile".format(a['name']), [a['name']], 'profile', deps=[preprocess[a['name']]])
+            t.cmd = driver_cmd(a, 'profile')
+            tasks.append(t)
+        # Models train on the pruned documents when the config asks for pruning (see driver.training_docs_file)
+        ready = preprocess[a['name']]
+        if a['prune']:
+            ready = Task("{}:prune".format(a['name']), [a['name']], 'prune', deps=[ready])
+            ready.cmd = driver_cmd(a, 'prune')
+            tasks.append(ready)
+        # ... the granularity sweep, when the config has one (sweepjobs models at once, by default one per core)
+        if a['sweep']:
+            jobs  = a['sweepjobs'] or max(1, args.cores // args.mallet_threads)
+            sweep = Task("{}:sweep".format(a['name']), [a['name']], 'sweep',
+                         cores=args.mallet_threads * jobs, heap_gb=args.mallet_heap_gb * jobs, deps=[ready])
+            sweep.cmd = driver_cmd(a, 'sweep')
+            sweep.env = mallet_env(args, MALLET_THREADS=str(args.mallet_threads))
+            tasks.append(sweep)
+            ready = sweep
+        # ... with the hyperparameters the search picks, when the config asks for one
+        # (hypersearchjobs candidate models at once, by default one per core)
+        if a['hypersearch']:
+            jobs  = a['hypersearchjobs'] or max(1, args.cores // args.mallet_threads)
+            ready = Task("{}:search".format(a['name']), [a['name']], 'search',
+                         cores=args.mallet_threads * jobs, heap_gb=args.mallet_heap_gb * jobs, deps=[ready])
+            ready.cmd = driver_cmd(a, 'search')
+            ready.env = mallet_env(args, MALLET_THREADS=str(args.mallet_threads))
+            tasks.append(ready)
+        # MALLET models read one instance file, imported before any of them start
+        if a['package'] == 'mallet':
+            ready = Task("{}:import".format(a['name']), [a['name']], 'import',
+                         heap_gb=args.mallet_heap_gb, deps=[ready])
+            ready.cmd = driver_cmd(a, 'import')
+            ready.env = mallet_env(args)
+            tasks.append(ready)
+        if a['granularities'] is None:
+            # granularities = auto: planned once the sweep task has written its recommendation
+            sweep.then = lambda a=a, ready=ready: plan_models(a, ready, sweep_granularities(a))
+        else:
+            tasks.extend(plan_models(a, ready, a['granularities']))
+
+    for t in tasks:
+        t.log = os.path.join(logdir, t.name.replace(':', '_') + '.log')
+    return tasks
+
+
+def run_task(task):
+    # Runs in a worker thread; the heavy lifting happens in the subprocess
+    for d in task.makedirs:
+        os.makedirs(d, exist_ok=True)
+    with open(task.log, 'w') as log:
+        log.write("Running: {}\n\n".format(' '.join(task.cmd)))
+        log.flush()
+        result = subprocess.run(task.cmd, stdout=log, stderr=subprocess.STDOUT, env=task.env)
+    return result.returncode
+
+
+def write_report(tasks, analyses, report_dir, batch_start):
+    per_analysis = []
+    for a in analyses:
+        mine     = [t for t in tasks if a['name'] in t.analyses]
+        statuses = set(t.status for t in mine)
+        if 'failed' in statuses:
+            status = 'failed'
+        elif statuses == {'done'}:
+            status = 'done'
+        elif 'running' in statuses or 'done' in statuses:
+            status = 'running'
+        else:
+            status = 'pending'
+        stage_seconds = {}
+        for t in mine:
+            if t.seconds() is not None:
+                stage_seconds[t.stage] = round(stage_seconds.get(t.stage, 0) + t.seconds(), 1)
+        starts = [t.start for t in mine if t.start]
+        ends   = [t.end   for t in mine if t.end]
+        wall   = round(max(ends) - min(starts), 1) if starts and ends else None
+        per_analysis.append({'analysis': a['name'], 'config': a['config'], 'status': status,
+                             'wall_seconds': wall, 'stage_seconds': stage_seconds})
+    report = {'started': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(batch_start)),
+              'elapsed_seconds': round(time.time() - batch_start, 1),
+              'analyses': per_analysis,
+              'tasks': [t.as_dict() for t in tasks]}
+    with open(os.path.join(report_dir, 'batch_report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    with open(os.path.join(report_dir, 'batch_report.txt'), 'w') as f:
+        f.write("TOPCAT batch started {}, elapsed {}s\n\n".format(report['started'], report['elapsed_seconds']))
+        f.write("{:<30} {:<8} {:>10}  {}\n".format('analysis', 'status', 'wall (s)', 'stage seconds'))
+        for a in per_analysis:
+            stages = ' '.join("{}={}".format(s, a['stage_seconds'][s]) for s in STAGE_ORDER if s in a['stage_seconds'])
+            f.write("{:<30} {:<8} {:>10}  {}\n".format(a['analysis'], a['status'], str(a['wall_seconds']), stages))
+        f.write("\n{:<40} {:<8} {:>8}\n".format('task', 'status', 'seconds'))
+        for t in tasks:
+            f.write("{:<40} {:<8} {:>8}\n".format(t.name, t.status, str(t.seconds())))
+
+
+def schedule(tasks, analyses, args):
+    batch_start = time.time()
+    pending     = list(tasks)
+    running     = {}
+    started     = {a['name']: 0 for a in analyses}
+    cores_used  = 0
+    heap_used   = 0
+
+    def fits(t):
+        # An oversized task may still run alone, otherwise it would never start
+        if not running:
+            return True
+        return cores_used + t.cores <= args.cores and heap_used + t.heap_gb <= args.heap_gb
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as pool:
+        while pending or running:
+            # Skip tasks downstream of a failure
+            for t in list(pending):
+                if any(d.status in ('failed', 'skipped') for d in t.deps):
+                    t.status = 'skipped'
+                    pending.remove(t)
+
+            # Interleave analyses: each free slot goes to the analysis that has had the fewest tasks started
+            ready = [t for t in pending if all(d.status == 'done' for d in t.deps)]
+            while len(running) < args.workers:
+                candidates = [t for t in ready if t.status == 'pending' and fits(t)]
+                if not candidates:
+                    break
+                t = min(candidates, key=lambda t: (min(started[a] for a in t.analyses), STAGE_ORDER.index(t.stage)))
+                pending.remove(t)
+                t.status = 'running'
+                t.start  = time.time()
+                for a in t.analyses:
+                    started[a] += 1
+                cores_used += t.cores
+                heap_used  += t.heap_gb
+                running[pool.submit(run_task, t)] = t
+                print("{}  started  {}".format(time.strftime('%H:%M:%S'), t.name))
+
+            if not running:
+                break
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                t = running.pop(future)
+                t.end = time.time()
+                try:
+                    t.returncode = future.result()
+                except Exception as e:
+                    sys.stderr.write("{}: {}\n".format(t.name, e))
+                    t.returncode = -1
+                t.status = 'done' if t.returncode == 0 else 'failed'
+                cores_used -= t.cores
+                heap_used  -= t.heap_gb
+                if t.status == 'done' and t.then:
+                    # Tasks that could only be planned once this one had run (e.g. models for granularities = auto)
+                    try:
+                        more = t.then()
+                    except (OSError, ValueError, KeyError) as e:
+                        sys.stderr.write("{}: can't plan the tasks that follow: {}\n".format(t.name, e))
+                        t.status = 'failed'
+                    else:
+                        tasks.extend(more)
+                        pending.extend(more)
+                print("{}  {:<7}  {} ({}s)".format(time.strftime('%H:%M:%S'), t.status, t.name, t.seconds()))
+                if t.status == 'failed':
+                    print("    see {}".format(t.log))
+            write_report(tasks, analyses, args.report_dir, batch_start)
+
+    write_report(tasks, analyses, args.report_dir, batch_start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='TOPCAT batch mode: run many config.ini analyses under one scheduler')
+    parser.add_argument('--configs', nargs='*', default=[], help='Configuration files, one per analysis')
+    parser.add_argument('--configs_file', default=None, help='File listing configuration files, one per line')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Maximum number of tasks running at once')
+    parser.add_argument('--cores', type=int, default=os.cpu_count() or 1, help='Core budget shared by MALLET runs')
+    parser.add_argument('--heap_gb', type=float, default=8, help='JVM heap budget in GB shared by MALLET runs')
+    parser.add_argument('--mallet_threads', type=int, default=1, help='Cores charged to each MALLET run (and threads it trains with)')
+    parser.add_argument('--mallet_heap_gb', type=int, default=1, help='JVM heap (MALLET_MEMORY) for each MALLET run, in GB')
+    parser.add_argument('--report_dir', default='./batch_out', help='Directory for the status report and per-task logs')
+    parser.add_argument('--output-safe', dest='output_safe', action='store_true', help='Passed on to driver.py')
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true', help='Show the task plan without running it')
+    args = parser.parse_args()
+
+    config_files = list(args.configs)
+    if args.configs_file:
+        with open(args.configs_file) as f:
+            config_files += [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    if not config_files:
+        parser.error('No configuration files given. Use --configs and/or --configs_file.')
+
+    analyses = [read_analysis(c) for c in config_files]
+    names    = [a['name'] for a in analyses]
+    if len(set(names)) != len(names):
+        parser.error('Configuration file names must be distinct; they are used to name analyses in the report.')
+
+    logdir = os.path.join(args.report_dir, 'logs')
+    os.makedirs(logdir, exist_ok=True)
+    tasks = build_tasks(analyses, args, logdir)
+
+    if args.dry_run:
+        print("🧪 DRY RUN MODE - showing the task plan without executing")
+        for t in tasks:
+            deps = ', '.join(d.name for d in t.deps)
+            print("{:<40} cores={} heap={}g  after: {}".format(t.name, t.cores, t.heap_gb, deps or '-'))
+            print("    {}".format(' '.join(t.cmd)))
+            if t.then:
+                print("    (the tasks that follow are planned once it has run)")
+        sys.exit(0)
+
+    print("Starting batch of {} analyses ({} tasks): {}".format(len(analyses), len(tasks), time.strftime('%Y-%m-%d %H:%M:%S')))
+    schedule(tasks, analyses, args)
+    failed = [a for a in analyses if any(t.status == 'failed' for t in tasks if a['name'] in t.analyses)]
+    print("Done: {}. Report in {}".format(time.strftime('%Y-%m-%d %H:%M:%S'), os.path.join(args.report_dir, 'batch_report.txt')))
+    sys.exit(1 if failed else 0)
@@ -4,32 +4,23 @@ import sys
 import time
 import subprocess
 import argparse
-import csv as csv_module
-
-def extract_csv_column_python(csv_file, column_index, output_file):
-    """
-    Extracts column N from CSV file and outputs each value on separate line
-    """
-    with open(csv_file, 'r', encoding='utf-8', newline='') as infile:
-        with open(output_file, 'w', encoding='utf-8') as outfile:
-            reader = csv_module.reader(infile)
-            
-            for row in reader:
-                if len(row) > column_index:
-                    # Output the field value, handling empty fields
-                    outfile.write(row[column_index] + '\n')
-                else:
-                    # Handle case where row doesn't have enough columns
-                    outfile.write('\n')
-
-def load_config(config_file, output_safe=False):
+
+def load_config(config_file, output_safe=False, check_outputs=True):
 
     # Declare parameters as global
     # Yes, this is ugly! I'm being quick and dirty.
     global malletdir, topcatdir, preproc, runmallet
-    global rootdir, csv, textcol, modelname, datadir, outdir, granularities
+    global rootdir, csv, textcol, docidcol, modelname, datadir, outdir, granularities
     global workdir, rawdocs, preprocdir, stoplist, numiterations, maxdocs, seed
     global debug, dry_run
+    global modelstore, modelstore_max_gb, profile, cleanjobs
+    global numthreads, malletmemory, package, passes, batchsize, anchorvocab
+    global convergence, convergenceinterval, warmstart, warmstartiterations
+    global infercsv, inferjobs, ensemble, ensemblejobs, ensemblecentral, outputprofile
+    global mindf, maxdf, maxvocab
+    global sweep, sweepiterations, sweepheldout, sweepjobs, sweepcoherence, sweeprecommend
+    global mergetopics, sparsetopicword, csvexport
+    global alpha, beta, optimizeinterval, hypersearch, hypersearchk, hypersearchconfigs, hypersearchiterations, hypersearchjobs
     
     # Parse config file
     config = configparser.ConfigParser()
@@ -60,6 +51,7 @@ def load_config(config_file, output_safe=False):
     rootdir       = config.get('variables', 'rootdir')
     csv           = config.get('variables', 'csv')
     textcol       = config.get('variables', 'textcol')
+    docidcol      = config.get('variables', 'docidcol', fallback='')
     modelname     = config.get('variables', 'modelname')
     datadir       = config.get('variables', 'datadir')
     outdir        = config.get('variables', 'outdir')
@@ -67,18 +59,21 @@ def load_config(config_file, output_safe=False):
 
     # Check if output directories already exist to avoid overwriting
     # Only exit if output_safe is True OR debug is False (current behavior when output_safe=False)
-    if output_safe and os.path.isdir(outdir):
+    # Stages after extraction (see --stage) expect the directories to exist already
+    if not check_outputs:
+        pass
+    elif output_safe and os.path.isdir(outdir):
         print(f"Output directory {outdir} already exists. Exiting (use --output-safe=false to overwrite).")
         sys.exit(1)
-    if output_safe and os.path.isdir(datadir):
+    if check_outputs and output_safe and os.path.isdir(datadir):
         print(f"Output directory {datadir} already exists. Exiting (use --output-safe=false to overwrite).")
         sys.exit(1)
     
     # Legacy behavior: exit if directories exist and not in debug mode (when output_safe=False)
-    if not output_safe and os.path.isdir(outdir) and not debug:
+    if check_outputs and not output_safe and os.path.isdir(outdir) and not debug:
         print(f"Output directory {outdir} already exists. Exiting.")
         sys.exit(1)
-    if not output_safe and os.path.isdir(datadir) and not debug:
+    if check_outputs and not output_safe and os.path.isdir(datadir) and not debug:
         print(f"Output directory {datadir} already exists. Exiting.")
         sys.exit(1)
         
@@ -90,6 +85,58 @@ def load_config(config_file, output_safe=False):
     numiterations = config.get('variables', 'numiterations')
     maxdocs       = config.get('variables', 'maxdocs')
     seed          = config.get('variables', 'seed')
+    profile       = config.getboolean('variables', 'profile', fallback=True)
+    cleanjobs     = config.get('variables', 'cleanjobs', fallback='1')
+    modelstore    = config.get('variables', 'modelstore', fallback='')
+    modelstore_max_gb = config.get('variables', 'modelstore_max_gb', fallback='20')
+    numthreads    = config.get('variables', 'numthreads', fallback='auto')
+    package       = config.get('variables', 'package', fallback='mallet')
+    passes        = config.get('variables', 'passes', fallback='1')
+    batchsize     = config.get('variables', 'batchsize', fallback='1024')
+    anchorvocab   = config.get('variables', 'anchorvocab', fallback='5000')
+    convergence   = config.getfloat('variables', 'convergence', fallback=0.0)
+    convergenceinterval = config.get('variables', 'convergenceinterval', fallback='100')
+    warmstart     = config.get('variables', 'warmstart', fallback='')
+    warmstartiterations = config.get('variables', 'warmstartiterations', fallback='200')
+    malletmemory  = config.get('variables', 'malletmemory', fallback='auto')
+    infercsv      = config.get('variables', 'infercsv', fallback='')
+    inferjobs     = config.get('variables', 'inferjobs', fallback='0')
+    ensemble      = config.getint('variables', 'ensemble', fallback=1)
+    ensemblejobs  = config.getint('variables', 'ensemblejobs', fallback=0)
+    ensemblecentral = config.getboolean('variables', 'ensemblecentral', fallback=True)
+    outputprofile = config.get('variables', 'outputprofile', fallback='full')
+    mindf         = config.getint('variables', 'mindf', fallback=1)
+    maxdf         = config.getfloat('variables', 'maxdf', fallback=1.0)
+    maxvocab      = config.getint('variables', 'maxvocab', fallback=0)
+    sweep         = config.get('variables', 'sweep', fallback='')
+    sweepiterations = config.get('variables', 'sweepiterations', fallback='200')
+    sweepheldout  = config.get('variables', 'sweepheldout', fallback='0.1')
+    sweepjobs     = config.get('variables', 'sweepjobs', fallback='0')
+    sweepcoherence = config.getboolean('variables', 'sweepcoherence', fallback=False)
+    sweeprecommend = config.get('variables', 'sweeprecommend', fallback='3')
+    mergetopics   = config.getboolean('variables', 'mergetopics', fallback=False)
+    sparsetopicword = config.getboolean('variables', 'sparsetopicword', fallback=False)
+    csvexport     = config.getboolean('variables', 'csvexport', fallback=True)
+    alpha         = config.get('variables', 'alpha', fallback='')
+    beta          = config.get('variables', 'beta', fallback='')
+    optimizeinterval = config.get('variables', 'optimizeinterval', fallback='10')
+    hypersearch   = config.getboolean('variables', 'hypersearch', fallback=False)
+    hypersearchk  = config.get('variables', 'hypersearchk', fallback='')
+    hypersearchconfigs = config.get('variables', 'hypersearchconfigs', fallback='0')
+    hypersearchiterations = config.get('variables', 'hypersearchiterations', fallback='100')
+    hypersearchjobs = config.get('variables', 'hypersearchjobs', fallback='0')
+    if sparsetopicword and package not in ('mallet', 'gibbs'):
+        # Other backends' word-topic counts are rounded expectations
+        print(f"sparsetopicword needs package mallet or gibbs; using dense topic-word files for {package}")
+        sparsetopicword = False
+    if not csvexport and (ensemble > 1 or mergetopics or infercsv):
+        # topic_ensemble.py, merge_topics.py and infer_topics.py read the CSVs
+        print("ensemble, mergetopics or infercsv is set, so writing the word_topics and document_topics CSVs anyway")
+        csvexport = True
+    if infercsv and outputprofile == 'curation':
+        # infer_topics.py needs the model and inferencer
+        print("infercsv is set, so using outputprofile = inference rather than curation")
+        outputprofile = 'inference'
 
 
 
@@ -108,37 +155,290 @@ def extract_text():
     if dry_run:
         print(f"[DRY RUN] Would create workdir: {workdir}")
         print(f"[DRY RUN] Would clean CSV lines using: {os.path.join(topcatdir, 'code/src/csv_clean_lines.py')}")
-        print(f"[DRY RUN] Would extract column {textcol} from CSV using Python CSV module")
-        print(f"[DRY RUN] Would create output file: {rawdocs}")
+        print(f"[DRY RUN] Would build document store from column {textcol} using: {os.path.join(topcatdir, 'code/src/docstore.py')}")
+        print(f"[DRY RUN] Would create output file: {rawdocs} (plus {rawdocs}.idx.npy and {rawdocs}.ids.npy)")
         return
 
     # Create workdir
     os.makedirs(workdir, exist_ok=True)
-    
-    # Clean CSV lines
+    build_docstore(csv, rawdocs)
+    print(f"Done. Created {rawdocs}")
+
+
+def build_docstore(csvfile, output):
+    """Clean CSVFILE and build a document store from its text column at OUTPUT"""
     temp_clean = os.path.join(workdir, "temp_clean.csv")
     csv_clean_script = os.path.join(topcatdir, "code/src/csv_clean_lines.py")
     
-    with open(csv, 'r') as input_file:
-        with open(temp_clean, 'w') as output_file:
-            subprocess.run(["python", csv_clean_script], stdin=input_file, stdout=output_file, check=True)
-    
-    # Extract text column using Python CSV module
-    temp_extracted = os.path.join(workdir, "temp_extracted.txt")
-    extract_csv_column_python(temp_clean, int(textcol) - 1, temp_extracted)  # Convert to 0-based indexing
+    # Large CSVs are cleaned in parallel chunks when cleanjobs > 1 (0 = one per core)
+    subprocess.run(["python", csv_clean_script,
+                    "--infile", csvfile, "--outfile", temp_clean, "--jobs", str(cleanjobs)], check=True)
     
-    with open(temp_extracted, 'r') as input_file:
-        lines = input_file.read().split('\n')
-    os.remove(temp_extracted)
-    
-    # Filter empty lines and skip first line (header)
-    with open(rawdocs, 'w') as output_file:
-        filtered_lines = [line for line in lines[1:] if line.strip()]
-        output_file.write('\n'.join(filtered_lines))
+    # Build the document store: OUTPUT holds the non-empty texts one per line,
+    # with an offset index and the original docIDs alongside it, so that later
+    # stages can fetch just the documents they show instead of copying them all.
+    cmd = [
+        "python", os.path.join(topcatdir, "code/src/docstore.py"),
+        "--csv", temp_clean,
+        "--textcol", str(textcol),
+        "--output", output
+    ]
+    if docidcol:
+        cmd += ["--docidcol", str(docidcol)]
+    subprocess.run(cmd, check=True)
     
     # Clean up temp file
     os.remove(temp_clean)
-    print(f"Done. Created {rawdocs}")
+
+
+def preprocessed_docs_file():
+    """Preprocessed documents in MALLET's docID<tab>label<tab>text format, shared by all granularities"""
+    return os.path.join(preprocdir, f"{modelname}_preprocessed.txt")
+
+
+def pruning():
+    """Whether the config asks for vocabulary pruning"""
+    return mindf > 1 or maxdf < 1 or maxvocab > 0
+
+
+def training_docs_file():
+    """The documents models are trained on: the preprocessed documents, pruned if the config asks for it"""
+    if pruning():
+        return os.path.join(preprocdir, f"{modelname}_pruned.txt")
+    return preprocessed_docs_file()
+
+
+def preprocess_text():
+    """Phase 1b: Preprocess the documents once for all granularities"""
+    preprocessed_docs = preprocessed_docs_file()
+    print(f"Preprocessing {rawdocs}")
+
+    if dry_run:
+        print(f"[DRY RUN] Would preprocess using: {preproc}")
+        print(f"[DRY RUN] Would use stoplist: {stoplist}")
+        print(f"[DRY RUN] Would create preprocessed docs: {preprocessed_docs}")
+        return
+
+    os.makedirs(preprocdir, exist_ok=True)
+    if package == 'mallet' and not pruning():
+        # These are the training documents, so MALLET imports them as they are written
+        # (run_mallet.py --raw_docs), and the import stage finds the instance file current
+        os.makedirs(workdir, exist_ok=True)
+        cmd = [
+            "python", runmallet,
+            "--package", package,
+            "--mallet_bin", os.path.join(malletdir, "bin"),
+            "--preprocessing", preproc,
+            "--stoplist", stoplist,
+            "--modelname", modelname,
+            "--raw_docs", rawdocs,
+            "--preprocessed_docs", preprocessed_docs,
+            "--workdir", workdir,
+            "--instances", instances_file(),
+            "--import_only"
+        ]
+        if malletmemory and malletmemory != 'auto':
+            cmd += ["--mallet_memory", malletmemory]
+    else:
+        cmd = [
+            "python", preproc,
+            "--stoplist", stoplist,
+            "--infile", rawdocs,
+            "--outfile", preprocessed_docs,
+            "--label", modelname
+        ]
+    subprocess.run(cmd, check=True)
+    print(f"Done. Created {preprocessed_docs}")
+
+
+def profile_corpus():
+    """Phase 1c: Profile the raw and preprocessed documents (lengths, vocabulary, duplicates)"""
+    profile_json = os.path.join(outdir, "corpus_profile.json")
+    profile_txt  = os.path.join(outdir, "corpus_profile.txt")
+    print("Profiling corpus")
+
+    if dry_run:
+        print(f"[DRY RUN] Would profile {rawdocs} and {preprocessed_docs_file()}")
+        print(f"[DRY RUN] Would create: {profile_json} and {profile_txt}")
+        return
+
+    cmd = [
+        "python", os.path.join(topcatdir, "code/src/corpus_profile.py"),
+        "--raw_docs", rawdocs,
+        "--preprocessed_docs", preprocessed_docs_file(),
+        "--output_json", profile_json,
+        "--output_txt", profile_txt
+    ]
+    subprocess.run(cmd, check=True)
+    print(f"Done. Created {profile_txt}")
+
+
+def prune_vocabulary():
+    """Phase 1d: Drop rare and overly common terms before modeling"""
+    pruned_docs = training_docs_file()
+    report = os.path.join(preprocdir, f"{modelname}_pruned.json")
+    print(f"Pruning vocabulary of {preprocessed_docs_file()}")
+
+    if dry_run:
+        print(f"[DRY RUN] Would prune terms in fewer than {mindf} documents, in more than {maxdf:.0%} of documents, beyond the {maxvocab or 'unlimited'} most frequent")
+        print(f"[DRY RUN] Would create: {pruned_docs} and {report}")
+        return
+
+    cmd = [
+        "python", os.path.join(topcatdir, "code/src/prune_vocabulary.py"),
+        "--input", preprocessed_docs_file(),
+        "--output", pruned_docs,
+        "--min_df", str(mindf),
+        "--max_df", str(maxdf),
+        "--max_vocab", str(maxvocab),
+        "--report", report
+    ]
+    subprocess.run(cmd, check=True)
+    print(f"Done. Created {pruned_docs}")
+
+
+def sweep_report_file():
+    """Granularity sweep results, whose recommendation is used when granularities = auto"""
+    return os.path.join(workdir, "granularity_sweep", "sweep.json")
+
+
+def run_granularity_sweep():
+    """Phase 1e: Quick models over the sweep granularities, scored on held-out documents"""
+    sweepdir = os.path.dirname(sweep_report_file())
+    print(f"Sweeping granularities {sweep} with {sweepiterations} iterations each")
+
+    if dry_run:
+        print(f"[DRY RUN] Would train and score models in: {sweepdir}")
+        print(f"[DRY RUN] Would create: {sweep_report_file()} and {os.path.join(outdir, 'granularity_sweep.txt')}")
+        return
+
+    cmd = [
+        "python", os.path.join(topcatdir, "code/src/granularity_sweep.py"),
+        "--preprocessed_docs", training_docs_file(),
+        "--workdir", sweepdir,
+        "--modelname", modelname,
+        "--run_mallet", runmallet,
+        "--package", package,
+        "--mallet_bin", os.path.join(malletdir, "bin"),
+        "--granularities", *sweep.split(),
+        "--numiterations", str(sweepiterations),
+        "--heldout", str(sweepheldout),
+        "--jobs", str(sweepjobs),
+        "--random_seed", str(seed),
+        "--recommend", str(sweeprecommend),
+        "--output_json", sweep_report_file(),
+        "--output_txt", os.path.join(outdir, "granularity_sweep.txt")
+    ]
+    if numthreads and numthreads != 'auto':
+        cmd += ["--num_threads", str(numthreads)]
+    if sweepcoherence:
+        cmd += ["--coherence"]
+    subprocess.run(cmd, check=True)
+
+
+def granularity_list():
+    """The granularities to model: as configured, or those the sweep recommended if granularities = auto"""
+    if granularities.strip() != 'auto':
+        return [int(x) for x in granularities.split()]
+    if dry_run and not os.path.exists(sweep_report_file()):
+        print("[DRY RUN] granularities = auto: would use the sweep's recommendation; showing the sweep granularities")
+        return [int(x) for x in sweep.split()]
+    if not os.path.exists(sweep_report_file()):
+        sys.exit(f"Error: granularities = auto needs the sweep's recommendation in {sweep_report_file()}; "
+                 "set sweep in the config and run the sweep stage first")
+    import json
+    with open(sweep_report_file()) as f:
+        recommended = json.load(f)['recommended']
+    print(f"Using the granularities recommended by the sweep: {' '.join(map(str, recommended))}")
+    return recommended
+
+
+def search_report_file():
+    """Hyperparameter search results, whose best setting is used for modeling when hypersearch is true"""
+    return os.path.join(workdir, "hyperparameter_search", "search.json")
+
+
+def run_hyperparameter_search(granularities_list):
+    """Phase 1f: Successive-halving search over alpha, beta and the optimize interval"""
+    # One granularity stands in for all of them: by default the middle one
+    numtopics = hypersearchk or str(sorted(granularities_list)[len(granularities_list) // 2])
+    searchdir = os.path.dirname(search_report_file())
+    print(f"Searching hyperparameters with {numtopics} topics")
+
+    if dry_run:
+        print(f"[DRY RUN] Would train candidate models in: {searchdir}")
+        print(f"[DRY RUN] Would create: {search_report_file()} and {os.path.join(outdir, 'hyperparameter_search.txt')}")
+        return
+
+    cmd = [
+        "python", os.path.join(topcatdir, "code/src/hyperparameter_search.py"),
+        "--preprocessed_docs", training_docs_file(),
+        "--workdir", searchdir,
+        "--modelname", modelname,
+        "--run_mallet", runmallet,
+        "--package", package,
+        "--mallet_bin", os.path.join(malletdir, "bin"),
+        "--numtopics", numtopics,
+        "--max_configs", str(hypersearchconfigs),
+        "--round_iterations", str(hypersearchiterations),
+        "--jobs", str(hypersearchjobs),
+        "--random_seed", str(seed),
+        "--output_json", search_report_file(),
+        "--output_txt", os.path.join(outdir, "hyperparameter_search.txt")
+    ]
+    # Candidates train one thread each unless set explicitly (batch.py sets MALLET_THREADS)
+    if numthreads and numthreads != 'auto':
+        cmd += ["--num_threads", str(numthreads)]
+    elif 'MALLET_THREADS' in os.environ:
+        cmd += ["--num_threads", os.environ['MALLET_THREADS']]
+    subprocess.run(cmd, check=True)
+
+
+def hyperparameters():
+    """Alpha, beta and optimize interval for modeling: the search's best if hypersearch is true, else from the config"""
+    if not hypersearch:
+        return alpha, beta, optimizeinterval
+    if dry_run and not os.path.exists(search_report_file()):
+        print("[DRY RUN] hypersearch = true: would use the search's best setting; showing the config's")
+        return alpha, beta, optimizeinterval
+    if not os.path.exists(search_report_file()):
+        sys.exit(f"Error: hypersearch = true needs the search's best setting in {search_report_file()}; "
+                 "run the search stage first")
+    import json
+    with open(search_report_file()) as f:
+        best = json.load(f)['best']
+    return str(best['alpha']), str(best['beta']), str(best['optimize_interval'])
+
+
+def instances_file():
+    """MALLET instance file for the training documents, shared by every granularity and by inference"""
+    return os.path.join(workdir, f"{modelname}.mallet")
+
+
+def import_training_docs():
+    """Phase 1g: Import the training documents for MALLET once, before the granularities' models"""
+    if package != 'mallet':
+        return
+    print(f"Importing {training_docs_file()} for MALLET")
+
+    if dry_run:
+        print(f"[DRY RUN] Would create: {instances_file()}")
+        return
+
+    # run_mallet.py skips the import if the instance file is already current
+    cmd = [
+        "python", runmallet,
+        "--package", package,
+        "--mallet_bin", os.path.join(malletdir, "bin"),
+        "--modelname", modelname,
+        "--preprocessed_docs", training_docs_file(),
+        "--workdir", workdir,
+        "--instances", instances_file(),
+        "--import_only"
+    ]
+    if malletmemory and malletmemory != 'auto':
+        cmd += ["--mallet_memory", malletmemory]
+    subprocess.run(cmd, check=True)
 
 
 def run_topic_modeling(numtopics):
@@ -150,14 +450,18 @@ def run_topic_modeling(numtopics):
     modeldir = os.path.join(workdir, f"model_k{numtopics}")
     curationdir = os.path.join(modeldir, "curation")
     mallet_outdir = os.path.join(modeldir, "mallet_output")
-    preprocessed_docs = os.path.join(modeldir, "preprocessed.txt")
+    preprocessed_docs = training_docs_file()
     
     if dry_run:
         print(f"[DRY RUN] Would create directories: {modeldir}, {curationdir}")
         print(f"[DRY RUN] Would run MALLET with {numtopics} topics, {numiterations} iterations")
-        print(f"[DRY RUN] Would use stoplist: {stoplist}")
-        print(f"[DRY RUN] Would create preprocessed docs: {preprocessed_docs}")
-        print(f"[DRY RUN] Would output word_topics.csv and document_topics.csv to: {curationdir}")
+        if modelstore:
+            print(f"[DRY RUN] Would reuse a stored model from {modelstore} if one matches")
+        print(f"[DRY RUN] Would import preprocessed docs: {preprocessed_docs}")
+        if ensemble > 1:
+            print(f"[DRY RUN] Would train {ensemble} models with seeds {seed}-{int(seed) + ensemble - 1} in {os.path.join(modeldir, 'ensemble')}")
+            print(f"[DRY RUN] Would score topic stability and curate the {'most central' if ensemblecentral else 'first'} run")
+        print(f"[DRY RUN] Would output curation arrays{' and CSVs' if csvexport else ''} to: {curationdir}")
         return curationdir
     
     # Create directories (but let run_mallet.py create mallet_outdir itself)
@@ -171,57 +475,263 @@ def run_topic_modeling(numtopics):
         shutil.rmtree(mallet_outdir)
     # Note: mallet_outdir will be created by run_mallet.py
     
-    # Run MALLET topic modeling
+    if ensemble > 1:
+        run_ensemble(numtopics, modeldir, mallet_outdir, curationdir)
+    else:
+        subprocess.run(run_mallet_cmd(numtopics, workdir, mallet_outdir, curationdir, seed), check=True)
+    return curationdir
+
+
+def run_mallet_cmd(numtopics, runworkdir, mallet_outdir, outputdir, runseed):
+    """run_mallet.py command for one model, writing the curation arrays (and, with csvexport, word_topics.csv and document_topics.csv) to outputdir"""
+    preprocessed_docs = training_docs_file()
+    model_alpha, model_beta, model_optimize_interval = hyperparameters()
+    extra_args = f"--random-seed {runseed}"
+    if model_alpha:
+        extra_args += f" --alpha {model_alpha}"
+    if model_beta:
+        extra_args += f" --beta {model_beta}"
     cmd = [
         "python", runmallet,
-        "--package", "mallet",
+        "--package", package,
         "--mallet_bin", os.path.join(malletdir, "bin"),
         "--preprocessing", preproc,
         "--stoplist", stoplist,
         "--modelname", modelname,
-        "--raw_docs", rawdocs,
+        "--docstore", rawdocs,
         "--preprocessed_docs", preprocessed_docs,
-        "--workdir", workdir,
+        "--workdir", runworkdir,
         "--modeldir", mallet_outdir,
         "--model2csv", os.path.join(topcatdir, "code/src/model2csv.py"),
-        "--word_topics_file", os.path.join(curationdir, "word_topics.csv"),
-        "--document_topics_file", os.path.join(curationdir, "document_topics.csv"),
+        "--word_topics_file", os.path.join(outputdir, "word_topics.csv"),
+        "--document_topics_file", os.path.join(outputdir, "document_topics.csv"),
         "--numtopics", str(numtopics),
         "--numiterations", str(numiterations),
-        "--extra_args", f"--random-seed {seed}"
+        "--output_profile", outputprofile,
+        "--optimize_interval", str(model_optimize_interval),
+        "--npy_dir", outputdir,
+        "--extra_args", extra_args
     ]
+    if package == 'mallet':
+        cmd += ["--instances", instances_file()]
+    if not csvexport:
+        cmd += ["--skip_csv"]
+    if sparsetopicword:
+        cmd += ["--topic_word_npz", os.path.join(outputdir, "topic_word.npz")]
+    if package == 'online':
+        cmd += ["--passes", str(passes), "--batch_size", str(batchsize)]
+    elif package == 'anchor':
+        cmd += ["--max_vocab", str(anchorvocab)]
+    if convergence:
+        cmd += ["--convergence_tolerance", str(convergence), "--segment_iterations", str(convergenceinterval)]
+    # Continue from the same granularity's model in a previous run's workdir, if it has one
+    # Such a run is likely to be continued from in turn, so it keeps its own state whatever the outputprofile
+    if warmstart:
+        previous_state = os.path.join(warmstart, f"model_k{numtopics}", "mallet_output", f"{modelname}.topic-state.gz")
+        if os.path.exists(previous_state):
+            cmd += ["--warm_start", previous_state, "--warm_start_iterations", str(warmstartiterations)]
+        elif os.path.isdir(os.path.dirname(previous_state)):
+            print(f"Warning: the previous {numtopics}-topic model has no {os.path.basename(previous_state)} "
+                  f"(it was trained with outputprofile curation or inference); training from scratch")
+        else:
+            print(f"No previous model at {previous_state}; training {numtopics} topics from scratch")
+        cmd += ["--keep_state"]
+    if modelstore:
+        cmd += ["--model_store", modelstore, "--model_store_max_gb", str(modelstore_max_gb)]
+    # Left to $MALLET_THREADS / $MALLET_MEMORY (e.g. from batch.py) or auto-sizing unless set in the config
+    if numthreads and numthreads != 'auto':
+        cmd += ["--num_threads", str(numthreads)]
+    if malletmemory and malletmemory != 'auto':
+        cmd += ["--mallet_memory", malletmemory]
     
+    return cmd
+
+
+def run_ensemble(numtopics, modeldir, mallet_outdir, curationdir):
+    """Phase 2, ensemble: train one model per seed in parallel, score topic stability, keep one run for curation"""
+    import shutil
+    from concurrent.futures import ThreadPoolExecutor
+    ensembledir = os.path.join(modeldir, "ensemble")
+    if debug and os.path.exists(ensembledir):
+        print(f"Debug mode: removing existing {ensembledir}")
+        shutil.rmtree(ensembledir)
+    seeds   = [int(seed) + i for i in range(ensemble)]
+    rundirs = [os.path.join(ensembledir, f"seed_{s}") for s in seeds]
+    jobs    = ensemblejobs if ensemblejobs > 0 else min(ensemble, os.cpu_count() or 1)
+
+    # Each run gets its own workdir; they share the instance file, imported beforehand, and
+    # threads are divided between the runs unless set explicitly
+    env = dict(os.environ)
+    if (not numthreads or numthreads == 'auto') and 'MALLET_THREADS' not in env:
+        env['MALLET_THREADS'] = str(max(1, (os.cpu_count() or 1) // jobs))
+    def train(run):
+        runseed, rundir = run
+        os.makedirs(rundir, exist_ok=True)
+        cmd = run_mallet_cmd(numtopics, rundir, os.path.join(rundir, "mallet_output"), rundir, runseed)
+        with open(os.path.join(rundir, "run_mallet.log"), 'w') as log:
+            status = subprocess.run(cmd, stdout=log, stderr=subprocess.STDOUT, env=env).returncode
+        print(f"Seed {runseed}: {'done' if status == 0 else f'failed (exit {status}), see ' + log.name}")
+        return status
+    print(f"Training {ensemble} models with seeds {seeds[0]}-{seeds[-1]}, {jobs} at a time")
+    with ThreadPoolExecutor(jobs) as pool:
+        statuses = list(pool.map(train, zip(seeds, rundirs)))
+    if any(statuses):
+        sys.exit(f"Error: {sum(1 for x in statuses if x)} of {ensemble} ensemble runs failed")
+
+    # Align the runs' topics and score their stability against the run kept for curation
+    report = os.path.join(ensembledir, "ensemble.json")
+    cmd = [
+        "python", os.path.join(topcatdir, "code/src/topic_ensemble.py"),
+        "--runs", *rundirs,
+        "--reference", "central" if ensemblecentral else "0",
+        "--output_json", report,
+        "--output_txt", os.path.join(ensembledir, "topic_stability.txt")
+    ]
     subprocess.run(cmd, check=True)
-    return curationdir
+
+    # The kept run (the most central one, or the configured seed's) becomes the model to curate
+    import json
+    with open(report) as f:
+        kept = rundirs[json.load(f)['reference_run']]
+    print(f"Using {kept} for curation")
+    shutil.move(os.path.join(kept, "mallet_output"), mallet_outdir)
+    for name in ("word_topics.csv", "document_topics.csv", "topic_word.npz", "topic_word.npy", "doc_topic.npy", "vocab.txt"):
+        if os.path.exists(os.path.join(kept, name)):
+            shutil.copy(os.path.join(kept, name), os.path.join(curationdir, name))
+
+
+def infer_docs_file():
+    """Document store for the documents in infercsv, scored by the trained models rather than used in training"""
+    return os.path.join(workdir, f"{modelname}_infer_raw.txt")
+
+
+def extract_infer_text():
+    """Phase 2b setup: document store for the documents to infer topics for"""
+    inferdocs = infer_docs_file()
+    print(f"Extracting documents to infer topics for from {infercsv}")
+    if dry_run:
+        print(f"[DRY RUN] Would build document store: {inferdocs}")
+        return
+    build_docstore(infercsv, inferdocs)
+    print(f"Done. Created {inferdocs}")
+
+
+def infer_new_documents(numtopics):
+    """Phase 2b: Infer topics for the documents in infercsv under the trained model"""
+    modeldir = os.path.join(workdir, f"model_k{numtopics}")
+    curationdir = os.path.join(modeldir, "curation")
+    output = os.path.join(curationdir, "document_topics_all.csv")
+    print(f"Inferring {numtopics} topic proportions for {infer_docs_file()}")
+
+    if dry_run:
+        print(f"[DRY RUN] Would infer topics in parallel shards using: {os.path.join(topcatdir, 'code/src/infer_topics.py')}")
+        print(f"[DRY RUN] Would create: {output}")
+        return
+
+    # Shards are preprocessed once and reused for every granularity
+    cmd = [
+        "python", os.path.join(topcatdir, "code/src/infer_topics.py"),
+        "--docstore", infer_docs_file(),
+        "--preprocessing", preproc,
+        "--stoplist", stoplist,
+        "--modeldir", os.path.join(modeldir, "mallet_output"),
+        "--modelname", modelname,
+        "--package", package,
+        "--training_instances", instances_file(),
+        "--mallet_bin", os.path.join(malletdir, "bin"),
+        "--shard_dir", os.path.join(workdir, "infer_shards"),
+        "--jobs", str(inferjobs),
+        "--random_seed", str(seed),
+        "--document_topics_file", os.path.join(curationdir, "document_topics.csv"),
+        "--output", output
+    ]
+    if malletmemory and malletmemory != 'auto':
+        cmd += ["--mallet_memory", malletmemory]
+    subprocess.run(cmd, check=True)
+
+
+def trained_granularities(granularities_list):
+    """Granularities that get a model of their own: with mergetopics, only the finest"""
+    return [max(granularities_list)] if mergetopics else granularities_list
+
+
+def merge_topic_models(granularities_list):
+    """Phase 2c: Derive the coarser granularities by merging the topics of the finest model"""
+    finest  = max(granularities_list)
+    derived = [k for k in granularities_list if k != finest]
+    if not derived:
+        print(f"Only one granularity ({finest}); nothing to merge")
+        return
+    print(f"Merging the {finest} topic model's topics into {' '.join(map(str, derived))} topics")
+
+    if dry_run:
+        print(f"[DRY RUN] Would write word_topics.csv and document_topics.csv to: {', '.join(curation_dir(k) for k in derived)}")
+        print(f"[DRY RUN] Would create: {os.path.join(outdir, 'topic_merge_tree.txt')}")
+        return
+
+    cmd = [
+        "python", os.path.join(topcatdir, "code/src/merge_topics.py"),
+        "--input_dir", curation_dir(finest),
+        "--numtopics"] + [str(k) for k in derived] + [
+        "--output_dirs"] + [curation_dir(k) for k in derived] + [
+        "--output_json", os.path.join(workdir, f"model_k{finest}", "merge_tree.json"),
+        "--output_txt", os.path.join(outdir, "topic_merge_tree.txt")
+    ]
+    subprocess.run(cmd, check=True)
+
+
+def curation_dir(numtopics):
+    return os.path.join(workdir, f"model_k{numtopics}", "curation")
+
+
+def curation_arrays_current(curationdir):
+    """Whether run_mallet.py wrote the curation arrays at least as recently as the CSVs"""
+    arrays = [os.path.join(curationdir, name) for name in ("doc_topic.npy", "vocab.txt")]
+    if not all(os.path.exists(path) for path in arrays):
+        return False
+    # Granularities derived by mergetopics only have CSVs, possibly newer than arrays from an earlier run
+    newest_csv = max([os.path.getmtime(os.path.join(curationdir, name))
+                      for name in ("word_topics.csv", "document_topics.csv") if os.path.exists(os.path.join(curationdir, name))],
+                     default=0)
+    return min(os.path.getmtime(path) for path in arrays) >= newest_csv
 
 
 def generate_curation_materials(curationdir):
     """Phase 3: Generate human curation materials"""
-    print("Converting run_mallet.py CSV outputs to numpy")
     
     if dry_run:
-        print(f"[DRY RUN] Would convert CSV to numpy in: {curationdir}")
+        print(f"[DRY RUN] Would convert CSV to numpy in: {curationdir}, unless run_mallet.py already wrote the arrays")
         print(f"[DRY RUN] Would create topic curation files with {maxdocs} top docs")
         print(f"[DRY RUN] Would generate Excel files and PDF word clouds")
         return
     
-    # Convert CSV to numpy
-    cmd = [
-        "python", os.path.join(topcatdir, "code/src/convert_csv_to_npy.py"),
-        "--topic_word", os.path.join(curationdir, "word_topics.csv"),
-        "--doc_topic", os.path.join(curationdir, "document_topics.csv"),
-        "--output", curationdir
-    ]
-    subprocess.run(cmd, check=True)
+    # With sparsetopicword, curation reads the topic-word distributions from topic_word.npz
+    # instead of topic_word.npy (granularities derived by mergetopics don't have one)
+    sparse = os.path.join(curationdir, "topic_word.npz")
+    if not (sparsetopicword and os.path.exists(sparse)):
+        sparse = None
+    if curation_arrays_current(curationdir) and (sparse or os.path.exists(os.path.join(curationdir, "topic_word.npy"))):
+        print("Using the numpy arrays written by run_mallet.py")
+    else:
+        print("Converting run_mallet.py CSV outputs to numpy")
+        cmd = [
+            "python", os.path.join(topcatdir, "code/src/convert_csv_to_npy.py"),
+            "--topic_word", os.path.join(curationdir, "word_topics.csv"),
+            "--doc_topic", os.path.join(curationdir, "document_topics.csv"),
+            "--output", curationdir
+        ]
+        if sparse:
+            cmd += ["--skip_topic_word"]
+        subprocess.run(cmd, check=True)
     
     print("Creating topic curation file")
     
     # Create curation files
     cmd = [
         "python", os.path.join(topcatdir, "code/src/create_topic_curation_files_with_custom_ratings_columns.py"),
-        "--topic_word", os.path.join(curationdir, "topic_word.npy"),
+        "--topic_word", sparse or os.path.join(curationdir, "topic_word.npy"),
         "--doc_topic", os.path.join(curationdir, "doc_topic.npy"),
-        "--texts", os.path.join(curationdir, "raw_documents.txt"),
+        "--docstore", rawdocs,
         "--vocab", os.path.join(curationdir, "vocab.txt"),
         "--output", curationdir,
         "--num_top_docs", "-1",
@@ -246,6 +756,10 @@ def organize_final_output(granularities_list):
             print(f"[DRY RUN] Would create: {finaldir}/{prefix}_clouds.pdf")
             print(f"[DRY RUN] Would create: {finaldir}/{prefix}_categories.xlsx")
             print(f"[DRY RUN] Would create: {finaldir}/{prefix}_alldocs.xlsx")
+            if infercsv:
+                print(f"[DRY RUN] Would create: {finaldir}/{prefix}_document_topics_all.csv")
+            if ensemble > 1:
+                print(f"[DRY RUN] Would create: {finaldir}/{prefix}_topic_stability.txt")
         return
     
     for numtopics in granularities_list:
@@ -266,6 +780,14 @@ def organize_final_output(granularities_list):
                    os.path.join(finaldir, f"{prefix}_categories.xlsx"))
         shutil.copy(os.path.join(curationdir, "document_topics.xlsx"), 
                    os.path.join(finaldir, f"{prefix}_alldocs.xlsx"))
+        # Training and inferred documents together, if infercsv was set
+        alldocs = os.path.join(curationdir, "document_topics_all.csv")
+        if os.path.exists(alldocs):
+            shutil.copy(alldocs, os.path.join(finaldir, f"{prefix}_document_topics_all.csv"))
+        # Per-topic stability across seeds, if ensemble > 1
+        stability = os.path.join(modeldir, "ensemble", "topic_stability.txt")
+        if os.path.exists(stability):
+            shutil.copy(stability, os.path.join(finaldir, f"{prefix}_topic_stability.txt"))
 
 
 ################################################################
@@ -278,13 +800,18 @@ if __name__ == "__main__":
     parser.add_argument('--config', default='./config.ini', help='Configuration file path')
     parser.add_argument('--dry-run', action='store_true', help='Show what would be done without actually running')
     parser.add_argument('--output-safe', action='store_true', help='Exit if output directories exist (safer behavior, default is false)')
+    parser.add_argument('--stage', default='all', choices=['all', 'extract', 'preprocess', 'profile', 'prune', 'sweep', 'search', 'import', 'model', 'infer', 'merge', 'curate', 'organize'],
+                        help='Run just one stage of the pipeline (used by batch.py); later stages expect earlier ones to have run')
+    parser.add_argument('--granularity', type=int, default=None,
+                        help='With --stage model, infer or curate, the single granularity to run (default: all granularities)')
     args = parser.parse_args()
     
     # Set global dry_run flag
     dry_run = args.dry_run
+    stage   = args.stage
     
     # Load configuration
-    load_config(args.config, args.output_safe)
+    load_config(args.config, args.output_safe, check_outputs=(stage in ('all', 'extract')))
 
     if dry_run:
         print("🧪 DRY RUN MODE - showing what would be done without executing")
@@ -301,6 +828,7 @@ if __name__ == "__main__":
         print("rootdir =\t {}".format(rootdir))
         print("csv =\t {}".format(csv))
         print("textcol =\t {}".format(textcol))
+        print("docidcol =\t {}".format(docidcol))
         print("modelname =\t {}".format(modelname))
         print("datadir =\t {}".format(datadir))
         print("outdir =\t {}".format(outdir))
@@ -312,34 +840,110 @@ if __name__ == "__main__":
         print("numiterations =\t {}".format(numiterations))
         print("maxdocs =\t {}".format(maxdocs))
         print("seed =\t {}".format(seed))
+        print("profile =\t {}".format(profile))
+        print("modelstore =\t {}".format(modelstore))
+        print("infercsv =\t {}".format(infercsv))
         print("\n")
 
-    # Create output directories
-    if dry_run:
-        print(f"[DRY RUN] Would create output directory: {outdir}")
-        print(f"[DRY RUN] Would create data directory: {datadir}")
-    else:
-        if debug:
-            os.makedirs(outdir, exist_ok=True)
-            os.makedirs(datadir, exist_ok=True)
+    if stage in ('all', 'extract'):
+        # Create output directories
+        if dry_run:
+            print(f"[DRY RUN] Would create output directory: {outdir}")
+            print(f"[DRY RUN] Would create data directory: {datadir}")
         else:
-            os.makedirs(outdir)
-            os.makedirs(datadir)
+            if debug:
+                os.makedirs(outdir, exist_ok=True)
+                os.makedirs(datadir, exist_ok=True)
+            else:
+                os.makedirs(outdir)
+                os.makedirs(datadir)
+
+        # Phase 1: Extract text
+        extract_text()
+
+    # Phase 1b: Preprocess once, shared by all granularities
+    if stage in ('all', 'preprocess'):
+        preprocess_text()
+
+    # Phase 1c: Corpus profile, to inform choice of granularities and pruning
+    if (stage == 'all' and profile) or stage == 'profile':
+        profile_corpus()
+
+    # Phase 1d: Vocabulary pruning, if the config sets mindf, maxdf or maxvocab
+    if (stage == 'all' and pruning()) or stage == 'prune':
+        prune_vocabulary()
 
-    # Phase 1: Extract text
-    extract_text()
+    # Phase 1e: Granularity sweep, if the config sets sweep; with granularities = auto
+    # its recommended granularities are the ones modeled below
+    if (stage == 'all' and sweep) or stage == 'sweep':
+        if not sweep:
+            sys.exit("Error: --stage sweep needs sweep (the granularities to try) in the config")
+        run_granularity_sweep()
 
     # Parse granularities
-    granularities_list = [int(x) for x in granularities.split()]
+    if stage in ('all', 'search', 'model', 'infer', 'merge', 'curate', 'organize'):
+        granularities_list = granularity_list()
+    if args.granularity is not None:
+        stage_granularities = [args.granularity]
+    elif stage in ('all', 'model', 'infer', 'curate', 'organize'):
+        stage_granularities = granularities_list
+
+    # Phase 1f: Hyperparameter search, if hypersearch is true; its best setting is used below
+    if (stage == 'all' and hypersearch) or stage == 'search':
+        if package not in ('mallet', 'gibbs'):
+            sys.exit(f"Error: the hyperparameter search needs package mallet or gibbs, not {package}")
+        run_hyperparameter_search(granularities_list)
+
+    # Phase 1g: Import the training documents once for every granularity (mallet only);
+    # a model stage on its own imports them first if that hasn't been done
+    if stage in ('all', 'import', 'model'):
+        import_training_docs()
 
     # Phase 2 & 3: Loop through different topic model sizes
-    for numtopics in granularities_list:
-        curationdir = run_topic_modeling(numtopics)
-        generate_curation_materials(curationdir)
-        print(f"Done with {numtopics} topics: {time.strftime('%Y-%m-%d %H:%M:%S')}")
+    if stage == 'all':
+        if infercsv:
+            extract_infer_text()
+        for numtopics in trained_granularities(granularities_list):
+            curationdir = run_topic_modeling(numtopics)
+            if infercsv:
+                infer_new_documents(numtopics)
+            generate_curation_materials(curationdir)
+            print(f"Done with {numtopics} topics: {time.strftime('%Y-%m-%d %H:%M:%S')}")
+        # Phase 2c: with mergetopics, the other granularities come from the finest model
+        if mergetopics:
+            merge_topic_models(granularities_list)
+            for numtopics in granularities_list:
+                if numtopics not in trained_granularities(granularities_list):
+                    generate_curation_materials(curation_dir(numtopics))
+                    print(f"Done with {numtopics} topics: {time.strftime('%Y-%m-%d %H:%M:%S')}")
+    elif stage == 'model':
+        for numtopics in stage_granularities:
+            if numtopics in trained_granularities(granularities_list):
+                run_topic_modeling(numtopics)
+            else:
+                print(f"Skipping {numtopics} topics: with mergetopics, it is merged from the finest model")
+    elif stage == 'infer':
+        # Several granularities in one call share the preprocessed shards
+        if not infercsv:
+            print("No infercsv in the config; nothing to infer")
+        else:
+            extract_infer_text()
+            for numtopics in stage_granularities:
+                if numtopics in trained_granularities(granularities_list):
+                    infer_new_documents(numtopics)
+    elif stage == 'merge':
+        merge_topic_models(granularities_list)
+    elif stage == 'curate':
+        for numtopics in stage_granularities:
+            generate_curation_materials(curation_dir(numtopics))
 
     # Phase 4: Organize final output
-    organize_final_output(granularities_list)
+    if stage in ('all', 'organize'):
+        organize_final_output(granularities_list)
+
+    if stage != 'all':
+        print(f"Done with stage {stage}: {time.strftime('%Y-%m-%d %H:%M:%S')}")
+        sys.exit(0)
 
     print("================================================================")
     if dry_run:
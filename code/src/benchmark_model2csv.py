@@ -0,0 +1,113 @@
+################################################################
+#
+#  Benchmark for model2csv.py's MALLET loaders on a large-vocabulary model
+#
+#  Writes a synthetic MALLET model (MODELNAME.topic-word-weights, with a
+#  row for every word in every topic, and MODELNAME.doc-topics) to a
+#  scratch directory and times reading it both ways:
+#
+#    legacy   the loader model2csv.py used to have: pandas' python
+#             parser, then one DataFrame column per topic from a
+#             groupby over the topic numbers
+#    current  model2csv.read_topic_word_weights: pandas' C parser into
+#             one K x V array, normalized in a single operation
+#
+#  and likewise for the doc-topics file. The two topic-word matrices are
+#  checked to be identical before the timings are reported.
+#
+#  Example:
+#    python benchmark_model2csv.py --vocab 100000 --topics 50 --docs 20000
+#
+################################################################
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import model2csv
+
+
+def write_model(modeldir, modelname, V, K, D, seed=0):
+    # Synthetic outputs in MALLET's layouts: beta + counts for the weights, smoothed proportions for the documents
+    rng    = np.random.default_rng(seed)
+    vocab  = ["w{}".format(v) for v in range(V)]
+    counts = rng.poisson(0.5, size=(K, V))
+    with open(os.path.join(modeldir, modelname + '.word-topic-counts'), 'w') as f:
+        for v, word in enumerate(vocab):
+            f.write("{} {} {}\n".format(v, word, ' '.join("{}:{}".format(k, counts[k, v]) for k in np.flatnonzero(counts[:, v]))))
+    with open(os.path.join(modeldir, modelname + '.topic-word-weights'), 'w') as f:
+        for k in range(K):
+            f.writelines("{}\t{}\t{}\n".format(k, word, 0.01 + c) for word, c in zip(vocab, counts[k].tolist()))
+    theta = rng.dirichlet(np.full(K, 0.1), size=D)
+    with open(os.path.join(modeldir, modelname + '.doc-topics'), 'w') as f:
+        for d in range(D):
+            f.write("{}\t{}\t{}\n".format(d, d + 1, '\t'.join(map(repr, theta[d].tolist()))))
+    return vocab
+
+
+def legacy_word_topics(weights_file, vocab):
+    # model2csv.py's loader before read_topic_word_weights
+    betaT_df      = pd.DataFrame(vocab, columns = ['Word'])
+    beta_input_df = pd.read_csv(weights_file, sep='\t', encoding='utf-8', engine='python', header=None,
+                                names = ['topicnum', 'word', 'weight'], on_bad_lines='warn')
+    for topicnum, group_df in beta_input_df.groupby('topicnum'):
+        weights = group_df['weight'].values
+        betaT_df.loc[:,"Topic {}".format(topicnum+1)] = weights / weights.sum()
+    return betaT_df.iloc[:, 1:].to_numpy()
+
+
+def current_word_topics(weights_file, vocab):
+    weights = model2csv.read_topic_word_weights(weights_file, len(vocab))
+    return (weights / weights.sum(axis=1, keepdims=True)).T
+
+
+def read_doc_topics(path, K, engine):
+    cols = ['docnum', 'docID'] + ["Topic {}".format(k + 1) for k in range(K)]
+    return pd.read_csv(path, sep='\t', encoding='utf-8', engine=engine, header=None, names=cols, on_bad_lines='warn')
+
+
+def timed(function, *args):
+    start  = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time model2csv.py\'s MALLET loaders against the legacy ones')
+    parser.add_argument('--vocab',   type=int, default=50000, help='Vocabulary size')
+    parser.add_argument('--topics',  type=int, default=50)
+    parser.add_argument('--docs',    type=int, default=10000)
+    parser.add_argument('--workdir', default=None, help='Scratch directory (default: a temporary one, removed afterwards)')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='model2csv_benchmark_')
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        sys.stderr.write("Writing a {} word, {} topic, {} document model to {}\n".format(args.vocab, args.topics, args.docs, workdir))
+        vocab        = write_model(workdir, 'bench', args.vocab, args.topics, args.docs)
+        weights_file = os.path.join(workdir, 'bench.topic-word-weights')
+        docs_file    = os.path.join(workdir, 'bench.doc-topics')
+
+        legacy,  legacy_seconds  = timed(legacy_word_topics, weights_file, vocab)
+        current, current_seconds = timed(current_word_topics, weights_file, vocab)
+        if not np.array_equal(legacy, current):
+            sys.stderr.write("Error: the loaders disagree (max difference {})\n".format(np.abs(legacy - current).max()))
+            sys.exit(1)
+        legacy_docs,  legacy_docs_seconds  = timed(read_doc_topics, docs_file, args.topics, 'python')
+        current_docs, current_docs_seconds = timed(read_doc_topics, docs_file, args.topics, 'c')
+        if not legacy_docs.equals(current_docs):
+            sys.stderr.write("Error: the doc-topics readers disagree\n")
+            sys.exit(1)
+
+        print("{:<20} {:>10} {:>10} {:>8}".format('', 'legacy', 'current', 'speedup'))
+        for label, old, new in [('topic-word-weights', legacy_seconds, current_seconds),
+                                ('doc-topics',         legacy_docs_seconds, current_docs_seconds)]:
+            print("{:<20} {:>9.2f}s {:>9.2f}s {:>7.1f}x".format(label, old, new, old / max(new, 1e-9)))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir)
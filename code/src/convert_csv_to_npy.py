@@ -16,6 +16,9 @@ if __name__ == "__main__":
                type=str,
                help='path to .csv file storing the document-topic info')
     
+    parser.add('--skip_topic_word',
+               action='store_true',
+               help='write only vocab.txt from the topic-word CSV, not topic_word.npy (when curating from a sparse topic_word.npz)')
     parser.add('--output',
                default='curation_inputs/',
                type=str,
@@ -26,16 +29,21 @@ if __name__ == "__main__":
     Path(args.output).mkdir(parents=True, exist_ok=True)
 
     print("Reading topic-word and doc-topic CSVs")
-    tw_df = pd.read_csv(args.topic_word)
+    tw_df = pd.read_csv(args.topic_word, usecols=['Word'] if args.skip_topic_word else None)
     td_df = pd.read_csv(args.doc_topic)
 
-    print("Writing topic_word.npy")
-    np.save(Path(args.output) / 'topic_word.npy', 
-            tw_df.iloc[:, 1:].to_numpy().T)
+    if not args.skip_topic_word:
+        print("Writing topic_word.npy")
+        np.save(Path(args.output) / 'topic_word.npy', 
+                tw_df.iloc[:, 1:].to_numpy().T)
+
+    # When documents live in a document store (see docstore.py), the doc-topic CSV
+    # has no trailing text column and there is no raw_documents.txt to write
+    has_text = 'text' in td_df.columns
 
     print("Writing doc_topic.npy")
     np.save(Path(args.output) / 'doc_topic.npy', 
-            td_df.iloc[:, 1:-1].to_numpy())
+            td_df.iloc[:, 1:-1].to_numpy() if has_text else td_df.iloc[:, 1:].to_numpy())
 
     print("Writing vocab.txt")
     vocab = list(tw_df['Word'])
@@ -45,13 +53,14 @@ if __name__ == "__main__":
             if i < len(vocab) - 1:
                 vocab_f.write('\n')
 
-    print("Writing raw_documents.txt")
-    docs = list(td_df['text'])
-    with open(Path(args.output) / 'raw_documents.txt', 'w') as docs_f:
-        for ind, text in tqdm(enumerate(docs)):
-            docs_f.write(str(text))
-            if ind < len(docs) - 1:
-                docs_f.write('\n')
+    if has_text:
+        print("Writing raw_documents.txt")
+        docs = list(td_df['text'])
+        with open(Path(args.output) / 'raw_documents.txt', 'w') as docs_f:
+            for ind, text in tqdm(enumerate(docs)):
+                docs_f.write(str(text))
+                if ind < len(docs) - 1:
+                    docs_f.write('\n')
                 
     print('Files created and saved.')
     
@@ -0,0 +1,317 @@
+################################################################
+#
+#  Streaming corpus profiler
+#
+#  One cheap pass over the raw and preprocessed documents, before modeling,
+#  to help choose granularities and vocabulary pruning thresholds. Reports
+#
+#    - document length distribution (raw characters, preprocessed terms)
+#    - documents emptied by preprocessing/the stoplist (rows with empty
+#      text never reach the document store, so there are no empty raw ones)
+#    - vocabulary growth, with a Heaps' law fit V = k * N^beta
+#    - most frequent types and phrases (phrases are the underscore-joined terms)
+#    - duplicate document rate
+#    - estimated document-frequency distribution, i.e. how many types and
+#      tokens a minimum document frequency cutoff would remove
+#
+#  Memory is bounded regardless of corpus size: distinct counts use
+#  HyperLogLog, frequencies a count-min sketch, length quantiles a reservoir
+#  sample, and document frequencies a hash-sampled subset of the vocabulary.
+#
+#  Example:
+#    python corpus_profile.py
+#    --raw_docs          /path/to/modeling/analysis_raw.txt
+#    --preprocessed_docs /path/to/modeling/processed/analysis_preprocessed.txt
+#    --output_json       /path/to/out/corpus_profile.json
+#    --output_txt        /path/to/out/corpus_profile.txt
+#
+#  The preprocessed file can be plain (one document per line) or in
+#  MALLET's docID<tab>label<tab>text format; line N of each file must be
+#  the same document.
+#
+################################################################
+import argparse
+import hashlib
+import heapq
+import json
+import random
+import sys
+
+import numpy as np
+
+
+def hash64(s):
+    # Stable 64-bit hash (Python's hash() is salted per process)
+    return int.from_bytes(hashlib.blake2b(s.encode('utf-8'), digest_size=8).digest(), 'little')
+
+def hash64_array(strings):
+    return np.fromiter((hash64(s) for s in strings), dtype=np.uint64, count=len(strings))
+
+
+class HyperLogLog:
+    # Approximate distinct count, standard error about 1.04/sqrt(2^p)
+    def __init__(self, p=14):
+        self.p         = p
+        self.m         = 1 << p
+        self.registers = np.zeros(self.m, dtype=np.uint8)
+
+    def add_hashes(self, hashes):
+        if len(hashes) == 0:
+            return
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        idx    = (hashes >> np.uint64(64 - self.p)).astype(np.int64)
+        rest   = (hashes << np.uint64(self.p)) | np.uint64(1 << (self.p - 1))  # sentinel bit caps the rank
+        # rank = position of the leftmost 1-bit in the remaining bits
+        rank   = (64 - np.floor(np.log2(rest.astype(np.float64)))).astype(np.uint8)
+        np.maximum.at(self.registers, idx, rank)
+
+    def count(self):
+        alpha    = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m * self.m / np.sum(np.power(2.0, -self.registers.astype(np.float64)))
+        zeros    = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * self.m and zeros > 0:
+            estimate = self.m * np.log(self.m / zeros)  # linear counting for small cardinalities
+        return int(round(estimate))
+
+
+class CountMinSketch:
+    # Approximate frequencies; estimates never undercount
+    def __init__(self, width=1 << 18, depth=4):
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width), dtype=np.int64)
+
+    def _indices(self, hashes):
+        h1 = (hashes & np.uint64(0xffffffff)).astype(np.int64)
+        h2 = (hashes >> np.uint64(32)).astype(np.int64)
+        return [(h1 + i * h2) % self.width for i in range(self.depth)]
+
+    def add(self, hashes, counts):
+        for row, idx in enumerate(self._indices(hashes)):
+            np.add.at(self.table[row], idx, counts)
+
+    def query(self, hashes):
+        return np.min([self.table[row][idx] for row, idx in enumerate(self._indices(hashes))], axis=0)
+
+
+class TopK:
+    # Heavy hitters: candidates ranked by count-min estimates, pruned when the candidate set doubles
+    def __init__(self, k):
+        self.k          = k
+        self.candidates = {}
+
+    def update(self, items, estimates):
+        for item, est in zip(items, estimates):
+            self.candidates[item] = int(est)
+        if len(self.candidates) > 2 * self.k:
+            self.candidates = dict(heapq.nlargest(self.k, self.candidates.items(), key=lambda x: x[1]))
+
+    def top(self):
+        return heapq.nlargest(self.k, self.candidates.items(), key=lambda x: x[1])
+
+
+class Reservoir:
+    # Uniform sample of a stream, for quantiles
+    def __init__(self, size, seed=13):
+        self.size   = size
+        self.sample = []
+        self.seen   = 0
+        self.rng    = random.Random(seed)
+
+    def add(self, value):
+        self.seen += 1
+        if len(self.sample) < self.size:
+            self.sample.append(value)
+        else:
+            j = self.rng.randrange(self.seen)
+            if j < self.size:
+                self.sample[j] = value
+
+    def summary(self):
+        if not self.sample:
+            return {}
+        values = np.asarray(self.sample)
+        q      = np.percentile(values, [0, 10, 25, 50, 75, 90, 99, 100])
+        return {'mean': float(values.mean()),
+                'min': float(q[0]), 'p10': float(q[1]), 'p25': float(q[2]), 'median': float(q[3]),
+                'p75': float(q[4]), 'p90': float(q[5]), 'p99': float(q[6]), 'max': float(q[7])}
+
+
+class SampledVocabulary:
+    '''
+    Exact term and document frequencies for the types whose hash falls in a
+    1/2^level sample of hash space; level goes up whenever the sample outgrows
+    max_types, so memory stays bounded. Counts of types are scaled back up by 2^level.
+    '''
+    def __init__(self, max_types=50000):
+        self.max_types = max_types
+        self.level     = 0
+        self.counts    = {}   # type -> [term frequency, document frequency]
+
+    def _sampled(self, h):
+        return (h & ((1 << self.level) - 1)) == 0
+
+    def add_document(self, types, hashes, counts):
+        for t, h, c in zip(types, hashes, counts):
+            if self._sampled(int(h)):
+                entry = self.counts.setdefault(t, [0, 0])
+                entry[0] += int(c)
+                entry[1] += 1
+        while len(self.counts) > self.max_types:
+            self.level += 1
+            self.counts = {t: v for t, v in self.counts.items() if self._sampled(hash64(t))}
+
+    def df_cutoffs(self, thresholds, total_tokens):
+        scale  = 1 << self.level
+        result = []
+        for min_df in thresholds:
+            types  = sum(1 for tf, df in self.counts.values() if df < min_df) * scale
+            tokens = sum(tf for tf, df in self.counts.values() if df < min_df) * scale
+            result.append({'min_df': min_df,
+                           'types_removed_est': types,
+                           'tokens_removed_est': tokens,
+                           'token_fraction_removed_est': tokens / total_tokens if total_tokens else 0.0})
+        return result
+
+
+def iter_texts(path):
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t', 2)
+            yield fields[2] if len(fields) == 3 else fields[0]
+
+
+def heaps_fit(points):
+    # Least-squares fit of log V = log k + beta log N over the vocabulary growth curve
+    points = [(n, v) for n, v in points if n > 0 and v > 0]
+    if len(points) < 3:
+        return None
+    x = np.log([n for n, _ in points])
+    y = np.log([v for _, v in points])
+    beta, logk = np.polyfit(x, y, 1)
+    return {'k': float(np.exp(logk)), 'beta': float(beta)}
+
+
+def profile(raw_docs, preprocessed_docs, top_n=50, reservoir_size=100000):
+    doc_hll      = HyperLogLog()
+    type_hll     = HyperLogLog()
+    cms          = CountMinSketch()
+    top_types    = TopK(top_n)
+    top_phrases  = TopK(top_n)
+    raw_lengths  = Reservoir(reservoir_size)
+    term_lengths = Reservoir(reservoir_size)
+    sampled      = SampledVocabulary()
+
+    n_docs = n_emptied = 0
+    n_tokens         = 0
+    growth           = []
+    next_checkpoint  = 1000
+
+    for raw, text in zip(iter_texts(raw_docs), iter_texts(preprocessed_docs)):
+        n_docs += 1
+        raw_stripped = ' '.join(raw.split())
+        raw_lengths.add(len(raw_stripped))
+        doc_hll.add_hashes([hash64(raw_stripped.lower())])
+
+        terms = text.split()
+        term_lengths.add(len(terms))
+        if raw_stripped and not terms:
+            n_emptied += 1
+        if not terms:
+            continue
+
+        types, counts = np.unique(np.asarray(terms, dtype=object), return_counts=True)
+        hashes        = hash64_array(types)
+        type_hll.add_hashes(hashes)
+        cms.add(hashes, counts)
+        estimates     = cms.query(hashes)
+        is_phrase     = np.fromiter(('_' in t for t in types), dtype=bool, count=len(types))
+        top_types.update(types[~is_phrase], estimates[~is_phrase])
+        top_phrases.update(types[is_phrase], estimates[is_phrase])
+        sampled.add_document(types, hashes, counts)
+
+        n_tokens += len(terms)
+        if n_tokens >= next_checkpoint:
+            growth.append((n_tokens, type_hll.count()))
+            next_checkpoint = int(next_checkpoint * 1.5)
+
+        if n_docs % 10000 == 0:
+            sys.stderr.write("{} ".format(n_docs))
+    sys.stderr.write("\n")
+
+    n_types = type_hll.count()
+    if not growth or growth[-1][0] != n_tokens:
+        growth.append((n_tokens, n_types))
+    distinct_docs = min(doc_hll.count(), n_docs)
+
+    return {
+        'documents':                   n_docs,
+        'documents_emptied_by_preprocessing': n_emptied,
+        'tokens':                      n_tokens,
+        'types_est':                   n_types,
+        'distinct_documents_est':      distinct_docs,
+        'duplicate_rate_est':          1.0 - distinct_docs / n_docs if n_docs else 0.0,
+        'raw_length_chars':            raw_lengths.summary(),
+        'preprocessed_length_terms':   term_lengths.summary(),
+        'heaps_law':                   heaps_fit(growth),
+        'vocabulary_growth':           [{'tokens': n, 'types_est': v} for n, v in growth],
+        'top_types':                   [{'term': t, 'count_est': c} for t, c in top_types.top()],
+        'top_phrases':                 [{'term': t, 'count_est': c} for t, c in top_phrases.top()],
+        'min_df_cutoffs':              sampled.df_cutoffs([2, 3, 5, 10, 20], n_tokens),
+        'vocabulary_sample_rate':      1.0 / (1 << sampled.level),
+    }
+
+
+def summary_text(report):
+    lines = []
+    add   = lines.append
+    add("Corpus profile")
+    add("==============")
+    add("Documents:                 {}".format(report['documents']))
+    add("Emptied by preprocessing:  {}".format(report['documents_emptied_by_preprocessing']))
+    add("Duplicate rate (est.):     {:.1%}".format(report['duplicate_rate_est']))
+    add("Tokens:                    {}".format(report['tokens']))
+    add("Types (est.):              {}".format(report['types_est']))
+    heaps = report['heaps_law']
+    if heaps:
+        add("Heaps' law fit:            V = {:.2f} * N^{:.3f}".format(heaps['k'], heaps['beta']))
+    for key, label in [('raw_length_chars', 'Raw length (chars)'), ('preprocessed_length_terms', 'Preprocessed length (terms)')]:
+        s = report[key]
+        if s:
+            add("{}: median {:.0f}, p10 {:.0f}, p90 {:.0f}, p99 {:.0f}, max {:.0f}".format(
+                label, s['median'], s['p10'], s['p90'], s['p99'], s['max']))
+    add("")
+    add("Estimated effect of a minimum document frequency:")
+    for c in report['min_df_cutoffs']:
+        add("  min_df {:>3}: removes ~{} types, ~{:.1%} of tokens".format(
+            c['min_df'], c['types_removed_est'], c['token_fraction_removed_est']))
+    add("")
+    add("Top types:   " + ", ".join("{} ({})".format(x['term'], x['count_est']) for x in report['top_types'][:20]))
+    add("Top phrases: " + ", ".join("{} ({})".format(x['term'], x['count_est']) for x in report['top_phrases'][:20]))
+    return "\n".join(lines) + "\n"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Streaming corpus profiler: one bounded-memory pass over raw and preprocessed documents')
+    parser.add_argument('-r','--raw_docs',
+                            help='File containing raw documents one per line',            dest='raw_docs',          default=None)
+    parser.add_argument('-d','--preprocessed_docs',
+                            help='Preprocessed documents, plain or docID<tab>label<tab>text', dest='preprocessed_docs', default=None)
+    parser.add_argument('-j','--output_json',
+                            help='Output JSON report',                                     dest='output_json',       default='corpus_profile.json')
+    parser.add_argument('-t','--output_txt',
+                            help='Output text summary',                                    dest='output_txt',        default='corpus_profile.txt')
+    parser.add_argument('-n','--top_n',
+                            help='Number of top types and phrases to report',              dest='top_n',             default=50, type=int)
+    args = parser.parse_args()
+    if args.raw_docs is None or args.preprocessed_docs is None:
+        parser.error('Required arguments: --raw_docs, --preprocessed_docs. Use -h to see detailed usage info.')
+
+    report = profile(args.raw_docs, args.preprocessed_docs, args.top_n)
+    with open(args.output_json, 'w') as f:
+        json.dump(report, f, indent=2)
+    text = summary_text(report)
+    with open(args.output_txt, 'w') as f:
+        f.write(text)
+    sys.stderr.write(text)
+    sys.stderr.write("Wrote {} and {}\n".format(args.output_json, args.output_txt))
@@ -18,6 +18,9 @@ import os
 
 from tqdm.auto import tqdm 
 
+from docstore import DocStore
+from sparse_topic_word import SparseTopicWord
+
 
 
 def rescale_to_probs_renorm(arr):
@@ -26,15 +29,17 @@ def rescale_to_probs_renorm(arr):
 def create_doc_topic_file_for_annotators(doc_topic,
                                          raw_texts,
                                          outpath,
-                                         top_doc_num_per_topic=500):
+                                         top_doc_num_per_topic=500,
+                                         doc_ids=None):
     '''
     Generates and saves the document-topic file for topic curation.
     
     Input:
     doc_topic: the document-topic probability vector (num_documents X num_topics) [2d numpy array]
-    raw_texts: the corresponding raw document texts [list]
+    raw_texts: the corresponding raw document texts [list, or a DocStore so only the selected texts are read]
     outpath: path to the directory for storing the generated file
     top_doc_num_per_topic: How many of the top documents (using doc_topic) per topic to include in the saved document-topic file. -1 means include all documents. 
+    doc_ids: original docIDs indexed by document row (e.g. DocStore.ids); if None, selected documents are numbered from 1
     
     '''
     
@@ -48,10 +53,13 @@ def create_doc_topic_file_for_annotators(doc_topic,
             topic_vals = topic_vals[:top_doc_num_per_topic]
         for ind, _ in topic_vals:
             all_top_doc_inds.add(ind)
-    all_top_doc_inds = list(all_top_doc_inds)
-    selected_raw_texts = [x for i,x in enumerate(raw_texts) if i in all_top_doc_inds]
+    all_top_doc_inds = sorted(all_top_doc_inds)
+    selected_raw_texts = [raw_texts[i] for i in all_top_doc_inds]
     #print(len(all_top_doc_inds))
-    out_df['docID'] = [i + 1 for i in range(len(all_top_doc_inds))]
+    if doc_ids is not None:
+        out_df['docID'] = [doc_ids[i] for i in all_top_doc_inds]
+    else:
+        out_df['docID'] = [i + 1 for i in range(len(all_top_doc_inds))]
     for topic_ind in tqdm(range(num_topics)):
         out_df['Topic ' + str(topic_ind + 1)] = list(doc_topic[all_top_doc_inds, topic_ind])
     out_df['text'] = selected_raw_texts
@@ -73,7 +81,7 @@ def create_topics_file_for_human_labeling_and_rating(topic_word,
     Input:
     topic_word: the topic-word probability vector (num_topics X vocab_size) [2d numpy array]
     doc_topic: (being input if few top docs should be shown in the topic_word file) (num_documents X num_topics) [2d numpy array]
-    raw_texts: (being input if few top docs should be shown in the topic_word file) [list]
+    raw_texts: (being input if few top docs should be shown in the topic_word file) [list or DocStore]
     vocab: the corresponding words in the vocabulary [list]
     outpath: path to the directory for storing the generated file
     num_top_words: How many of the top words (using topic_word) per topic to include in the saved topic-word file that gets shown. 
@@ -155,9 +163,10 @@ def create_topics_file_for_human_labeling_and_rating(topic_word,
                                                     'bg_color': '#FFFFEC'})
     issue_row = 3
     for k in tqdm(range(num_topics)):
-        top_word_inds = np.argsort(list(topic_word[k]))[::-1][:num_top_words]
+        topic_probs = np.asarray(topic_word[k])
+        top_word_inds = np.argsort(topic_probs)[::-1][:num_top_words]
         top_words = [vocab[i] for i in top_word_inds]
-        top_word_probs = [topic_word[k][i] for i in top_word_inds]
+        top_word_probs = [topic_probs[i] for i in top_word_inds]
         
         worksheet.write('A' + str(issue_row), 'Topic ' + str(k+1), border)
         worksheet.write('B' + str(issue_row), '', border)
@@ -390,9 +399,10 @@ def create_topic_word_clouds_file(topic_word,
         image_file_name  = outdir + label.replace(" ", "_") + ".pdf"
         temp_file_name   = outdir + "TEMP_" + label.replace(" ", "_") + ".pdf"
         
-        top_word_inds = np.argsort(list(topic_word[k]))[::-1][:num_words]
+        topic_probs = np.asarray(topic_word[k])
+        top_word_inds = np.argsort(topic_probs)[::-1][:num_words]
         top_words = [vocab[i] for i in top_word_inds]
-        top_word_probs = [topic_word[k][i] for i in top_word_inds]
+        top_word_probs = [topic_probs[i] for i in top_word_inds]
         
         word_prob_dic = dict(zip(top_words, top_word_probs))
         
@@ -428,7 +438,7 @@ if __name__ == "__main__":
     parser.add('--topic_word',
                default='example_data/topic_word.npy',
                type=str,
-               help='path to .npy file storing the topic-word 2-d numpy array (number of topics X vocab size)')
+               help='path to .npy file storing the topic-word 2-d numpy array (number of topics X vocab size), or a sparse topic_word.npz')
     parser.add('--doc_topic',
                default='example_data/doc_topic.npy',
                type=str,
@@ -437,6 +447,10 @@ if __name__ == "__main__":
                default='example_data/raw_documents.txt',
                type=str,
                help='path to .txt file storing the raw document texts, each line containing one document')
+    parser.add('--docstore',
+               default=None,
+               type=str,
+               help='path to a document store (see docstore.py) to fetch document texts and docIDs from; overrides --texts')
     parser.add('--vocab',
                default='example_data/vocab.txt',
                type=str,
@@ -471,19 +485,29 @@ if __name__ == "__main__":
     args = parser.parse_args()
     
     # load in the topic-word and document-topic distribution vectors
-    topic_word = np.load(args.topic_word)
+    # (a sparse topic_word.npz computes each topic's probabilities when it is used; see sparse_topic_word.py)
+    if args.topic_word.endswith('.npz'):
+        topic_word = SparseTopicWord.load(args.topic_word)
+    else:
+        topic_word = np.load(args.topic_word)
     doc_topic = np.load(args.doc_topic)
     
     #renormalize to probability vectors (if they are not already)
-    if int(topic_word.sum(1).sum()) != topic_word.shape[0]:
+    if isinstance(topic_word, np.ndarray) and int(topic_word.sum(1).sum()) != topic_word.shape[0]:
         topic_word = rescale_to_probs_renorm(topic_word)
         
     if int(doc_topic.sum(1).sum()) != doc_topic.shape[0]:
         doc_topic = rescale_to_probs_renorm(doc_topic)
         
-    # load the raw documents as a list of texts
-    raw_texts = open(args.texts).readlines()
-    raw_texts = list(map(lambda x:x.rstrip(), raw_texts))
+    # load the raw documents as a list of texts,
+    # or open the document store so that only the documents shown get read
+    if args.docstore:
+        raw_texts = DocStore(args.docstore)
+        doc_ids   = raw_texts.ids
+    else:
+        raw_texts = open(args.texts).readlines()
+        raw_texts = list(map(lambda x:x.rstrip(), raw_texts))
+        doc_ids   = None
     
     # load the vocabulary as a list of terms
     vocab = open(args.vocab).readlines()
@@ -495,7 +519,8 @@ if __name__ == "__main__":
     create_doc_topic_file_for_annotators(doc_topic,
                                          raw_texts,
                                          args.output,
-                                         args.num_top_docs)
+                                         args.num_top_docs,
+                                         doc_ids)
     print('Document-topic file created.')
 
     # create custom columns
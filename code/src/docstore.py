@@ -0,0 +1,176 @@
+################################################################
+#
+#  Offset-indexed document store shared by every stage of an analysis
+#
+#  A store consists of three files that sit side by side:
+#
+#    PATH              text blob, one document per line (this is the rawdocs file)
+#    PATH.idx.npy      int64 byte offsets, one per document plus a final end offset
+#    PATH.ids.npy      original CSV docIDs, fixed-width bytes, one per document
+#
+#  The offset and docID arrays are memory-mapped, so later stages can fetch
+#  the text of just the documents they show (by row, numbering from 0)
+#  instead of carrying copies of the whole collection around.
+#
+#  Example:  build a store from column 2 of a cleaned CSV, using column 1 as docID
+#    python docstore.py
+#    --csv       /path/to/clean.csv
+#    --textcol   2
+#    --docidcol  1
+#    --output    /path/to/modeling/analysis_raw.txt
+#
+#  Example:  use a store from another script in this directory
+#    from docstore import DocStore
+#    store = DocStore('/path/to/modeling/analysis_raw.txt')
+#    texts = store.texts([3, 17, 42])
+#    ids   = store.docids([3, 17, 42])
+#
+################################################################
+import argparse
+import csv
+import mmap
+import os
+import sys
+
+import numpy as np
+
+
+def index_file(path):
+    # Path of the memory-mapped offset index for store PATH
+    return path + '.idx.npy'
+
+def ids_file(path):
+    # Path of the memory-mapped docID array for store PATH
+    return path + '.ids.npy'
+
+def docstore_exists(path):
+    return os.path.exists(path) and os.path.exists(index_file(path)) and os.path.exists(ids_file(path))
+
+
+def write_docstore(records, path):
+    '''
+    Writes a document store at PATH from an iterable of (docID, text) pairs.
+    Each text is written on its own line; any embedded newlines are replaced
+    by spaces so that the blob can also be read line by line (e.g. by preprocessing).
+    Returns the number of documents written.
+    '''
+    offsets = [0]
+    docids  = []
+    with open(path, 'wb') as blob:
+        for docid, text in records:
+            data = (text.replace('\r', ' ').replace('\n', ' ') + '\n').encode('utf-8')
+            blob.write(data)
+            offsets.append(offsets[-1] + len(data))
+            docids.append(str(docid).encode('utf-8'))
+    np.save(index_file(path), np.asarray(offsets, dtype=np.int64))
+    np.save(ids_file(path),   np.asarray(docids,  dtype=np.bytes_) if docids else np.empty(0, dtype='S1'))
+    return len(docids)
+
+
+def write_docstore_from_csv(csv_file, textcol, path, docidcol=None):
+    '''
+    Builds a document store from a CSV file with a header row.
+    TEXTCOL and DOCIDCOL are 1-based column numbers, as in config.ini.
+    Rows with empty text are skipped (as the driver has always done for rawdocs);
+    if DOCIDCOL is None, the docID is the row's position in the CSV, counting data rows from 1.
+    '''
+    def records():
+        with open(csv_file, 'r', encoding='utf-8', newline='') as infile:
+            reader = csv.reader(infile)
+            next(reader, None)  # header
+            for rownum, row in enumerate(reader, start=1):
+                text = row[textcol - 1] if len(row) >= textcol else ''
+                if not text.strip():
+                    continue
+                if docidcol is None:
+                    docid = rownum
+                else:
+                    docid = row[docidcol - 1] if len(row) >= docidcol else rownum
+                yield docid, text
+    return write_docstore(records(), path)
+
+
+class DocStore:
+    '''
+    Read-only access to a document store written by write_docstore().
+    Rows are numbered from 0 in the order the documents were written,
+    which is also the line order of the text blob and of preprocessed output.
+    '''
+
+    def __init__(self, path):
+        self.path     = path
+        self.offsets  = np.load(index_file(path), mmap_mode='r')
+        self._docids  = np.load(ids_file(path),   mmap_mode='r')
+        self._fp      = open(path, 'rb')
+        # mmap refuses zero-length files
+        if os.path.getsize(path) > 0:
+            self._blob = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._blob = b''
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def text(self, row):
+        start, end = int(self.offsets[row]), int(self.offsets[row + 1])
+        return self._blob[start:end - 1].decode('utf-8', errors='replace')
+
+    def texts(self, rows):
+        return [self.text(int(row)) for row in rows]
+
+    # Lets a store stand in for the list of raw texts used by the curation code
+    __getitem__ = text
+
+    def docid(self, row):
+        return self._docids[int(row)].decode('utf-8')
+
+    def docids(self, rows=None):
+        if rows is None:
+            rows = range(len(self))
+        return [self.docid(row) for row in rows]
+
+    @property
+    def ids(self):
+        # Indexable view of the docIDs, so store.ids[row] mirrors store[row]
+        return _DocIDView(self)
+
+    def close(self):
+        if isinstance(self._blob, mmap.mmap):
+            self._blob.close()
+        self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _DocIDView:
+    def __init__(self, store):
+        self._store = store
+
+    def __len__(self):
+        return len(self._store)
+
+    def __getitem__(self, row):
+        return self._store.docid(row)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Builds an offset-indexed document store from a CSV file')
+    parser.add_argument('-c','--csv',
+                            help='Input CSV file with a header row',                     dest='csv',       default=None)
+    parser.add_argument('-t','--textcol',
+                            help='Column containing the text (numbering from 1)',       dest='textcol',   default=None, type=int)
+    parser.add_argument('-i','--docidcol',
+                            help='Column containing document IDs (numbering from 1). ' \
+                            'If omitted, docIDs are CSV row numbers',                   dest='docidcol',  default=None, type=int)
+    parser.add_argument('-o','--output',
+                            help='Path for the text blob; index files are written alongside it', dest='output', default=None)
+    args = parser.parse_args()
+    if args.csv is None or args.textcol is None or args.output is None:
+        parser.error('Required arguments: --csv, --textcol, --output. Use -h to see detailed usage info.')
+
+    n = write_docstore_from_csv(args.csv, args.textcol, args.output, args.docidcol)
+    sys.stderr.write("Wrote {} documents to {}\n".format(n, args.output))
@@ -0,0 +1,273 @@
+################################################################
+#
+#  Granularity sweep: recommend numbers of topics from held-out likelihood
+#
+#  Rather than picking granularities by hand, this trains a quick model
+#  for each of a range of K values and finds where adding topics stops
+#  paying off:
+#
+#    - a fraction of the documents (--heldout) is set aside, and a model
+#      for every K is trained on the rest with run_mallet.py, --jobs at a
+#      time, with a reduced iteration budget (--numiterations)
+#    - each model is scored by held-out log-likelihood per token, by
+#      document completion: each held-out document's topic proportions are
+#      inferred by fold-in (topic_model_io.fold_in) from every other token,
+#      and the remaining tokens are scored under those proportions
+#    - optionally (--coherence), each model's topics are also scored by
+#      UMass coherence of their top words over the training documents
+#    - kneed locates the knee of the likelihood curve, and the knee and its
+#      neighbours in the sweep (up to --recommend values, preferring the
+#      more coherent ones when coherence is scored) are recommended
+#
+#  Scoring works from the word-topic counts and topic keys, so it is the
+#  same for MALLET and the NumPy backends. Used by driver.py when the
+#  config sets sweep; can also be run on its own.
+#
+#  Example:
+#    python granularity_sweep.py
+#      --preprocessed_docs  /path/to/modeling/processed/analysis_preprocessed.txt
+#      --workdir            /path/to/modeling/granularity_sweep
+#      --modelname          analysis
+#      --run_mallet         /path/to/topcat/code/src/run_mallet.py
+#      --mallet_bin         /path/to/mallet/bin
+#      --granularities      5 10 15 20 30 40 50
+#      --output_json        /path/to/modeling/granularity_sweep/sweep.json
+#      --output_txt         /path/to/out/granularity_sweep.txt
+#
+################################################################
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from kneed import KneeLocator
+
+import topic_model_io
+
+default_beta  = 0.01
+num_top_words = 10
+batch_size    = 4096
+
+
+def split_documents(path, train_path, heldout_path, fraction, seed):
+    # Random held-out split of a docID<tab>label<tab>text file; documents with no tokens stay in training
+    rng = np.random.default_rng(seed)
+    num_heldout = 0
+    with open(path, encoding='utf-8', errors='replace') as f, \
+         open(train_path, 'w', encoding='utf-8') as train, open(heldout_path, 'w', encoding='utf-8') as heldout:
+        for line in f:
+            fields = line.rstrip('\r\n').split('\t', 2)
+            if len(fields) > 2 and fields[2].strip() and rng.random() < fraction:
+                heldout.write(line)
+                num_heldout += 1
+            else:
+                train.write(line)
+    return num_heldout
+
+
+def train_model(args, numtopics, train_path):
+    # A fresh run_mallet.py model for NUMTOPICS topics in its own workdir; returns its model directory, or None on failure
+    rundir   = os.path.join(args.workdir, "k{}".format(numtopics))
+    modeldir = os.path.join(rundir, "model")
+    if os.path.isdir(modeldir):
+        shutil.rmtree(modeldir)
+    os.makedirs(rundir, exist_ok=True)
+    cmd = ["python", args.run_mallet,
+           "--package", args.package,
+           "--workdir", rundir,
+           "--modeldir", modeldir,
+           "--modelname", args.modelname,
+           "--preprocessed_docs", train_path,
+           "--numtopics", str(numtopics),
+           "--numiterations", str(args.numiterations),
+           "--num_threads", str(args.num_threads),
+           "--output_profile", "curation",
+           "--model2csv", "",
+           "--extra_args", "--random-seed {}".format(args.random_seed)]
+    if args.mallet_bin:
+        cmd += ["--mallet_bin", args.mallet_bin]
+    with open(os.path.join(rundir, "run_mallet.log"), 'w') as log:
+        status = subprocess.run(cmd, stdout=log, stderr=subprocess.STDOUT).returncode
+    sys.stderr.write("K={}: {}\n".format(numtopics, "trained" if status == 0 else
+                                          "failed (exit {}), see {}".format(status, log.name)))
+    return modeldir if status == 0 else None
+
+
+def read_topics(modeldir, modelname, numtopics, beta=default_beta):
+    # Vocabulary, V x K word-topic counts, alpha (from the topic keys) and beta (last reported, see
+    # mallet_utils.TrainingMonitor, or else the one training started with: as recorded, or BETA)
+    vocab, nkw = topic_model_io.read_word_topic_counts(os.path.join(modeldir, modelname + '.word-topic-counts'), numtopics)
+    alpha = np.zeros(numtopics)
+    with open(os.path.join(modeldir, modelname + '.topic-keys'), encoding='utf-8') as f:
+        for line in f:
+            fields = line.split('\t')
+            if len(fields) > 1:
+                alpha[int(fields[0])] = float(fields[1])
+    metrics_file = os.path.join(modeldir, modelname + '.train-metrics.json')
+    if os.path.exists(metrics_file):
+        with open(metrics_file) as f:
+            metrics = json.load(f)
+        if metrics.get('hyperparameters'):
+            beta = metrics['hyperparameters'][-1]['beta']
+        elif metrics.get('beta') is not None:
+            beta = metrics['beta']
+    return vocab, nkw, alpha, beta
+
+
+def heldout_log_likelihood(heldout_path, vocab, nkw, alpha, beta):
+    '''
+    Document-completion log-likelihood of the documents in HELDOUT_PATH: proportions are
+    folded in from the even-numbered tokens of each document (those in the vocabulary),
+    and the odd-numbered ones are scored. Returns (total log-likelihood, tokens scored).
+    '''
+    index = {w: i for i, w in enumerate(vocab)}
+    phi   = ((nkw + beta) / (nkw.sum(axis=0) + len(vocab) * beta)).T
+    total, scored = 0.0, 0
+    docs = [np.array([index[t] for t in tokens if t in index], dtype=np.int64)
+            for _, tokens in topic_model_io.iter_documents(heldout_path)]
+    docs = [d for d in docs if len(d) > 1]
+    for start in range(0, len(docs), batch_size):
+        batch = docs[start:start + batch_size]
+        est   = [d[0::2] for d in batch]
+        ev    = [d[1::2] for d in batch]
+        rows  = np.repeat(np.arange(len(batch)), [len(d) for d in est])
+        X     = topic_model_io.count_matrix(rows, np.concatenate(est), len(batch), len(vocab))
+        theta = topic_model_io.doc_topic_proportions(topic_model_io.fold_in(X, phi, alpha), alpha)
+        rows  = np.repeat(np.arange(len(batch)), [len(d) for d in ev])
+        words = np.concatenate(ev)
+        total  += float(np.log(np.einsum('nk,kn->n', theta[rows], phi[:, words])).sum())
+        scored += len(words)
+    return total, scored
+
+
+def umass_coherence(train_path, topics_by_k):
+    '''
+    Mean UMass coherence of each model's topics (TOPICS_BY_K maps K to a list of top-word
+    lists, most probable first) over the documents in TRAIN_PATH, from one pass that
+    counts document co-occurrences among all the top words at once.
+    '''
+    words = sorted({w for topics in topics_by_k.values() for top in topics for w in top})
+    index = {w: i for i, w in enumerate(words)}
+    rows, cols, num_docs = [], [], 0
+    for _, tokens in topic_model_io.iter_documents(train_path):
+        ids = {index[t] for t in tokens if t in index}
+        rows.extend([num_docs] * len(ids))
+        cols.extend(ids)
+        num_docs += 1
+    X  = topic_model_io.count_matrix(rows, cols, num_docs, len(words))
+    co = (X.T @ X).toarray()
+    df = np.diag(co)
+    scores = {}
+    for k, topics in topics_by_k.items():
+        per_topic = []
+        for top in topics:
+            ids   = np.array([index[w] for w in top])
+            i, j  = np.triu_indices(len(ids), 1)
+            # log (D(w_j, w_i) + 1) / D(w_i), w_i ranked above w_j
+            per_topic.append(float(np.mean(np.log((co[ids[i], ids[j]] + 1) / np.maximum(df[ids[i]], 1)))))
+        scores[k] = float(np.mean(per_topic))
+    return scores
+
+
+def recommend(ks, ll_per_token, coherence=None, num=3):
+    # The knee of held-out likelihood against K, and up to NUM-1 of its neighbours in the sweep
+    knee = KneeLocator(ks, ll_per_token, curve='concave', direction='increasing').knee if len(ks) > 2 else None
+    if knee is None:
+        knee = ks[int(np.argmax(ll_per_token))]
+    i      = ks.index(knee)
+    window = [k for k in ks[max(0, i - num + 1):i + num] if k != knee]
+    window.sort(key=lambda k: (-coherence[k], abs(ks.index(k) - i)) if coherence else (abs(ks.index(k) - i), k))
+    return int(knee), sorted([int(knee)] + window[:num - 1])
+
+
+def summary_text(report):
+    lines = []
+    add   = lines.append
+    add("Granularity sweep ({} held-out documents, {} iterations per model)".format(report['heldout_documents'], report['numiterations']))
+    add("==================")
+    for r in report['results']:
+        coherence = "  coherence {:.3f}".format(r['coherence']) if r.get('coherence') is not None else ''
+        add("  K={:<4} held-out LL/token {:.4f}{}{}".format(r['numtopics'], r['ll_per_token'], coherence,
+                                                           "  <- knee" if r['numtopics'] == report['knee'] else ''))
+    add("")
+    add("Recommended granularities: {}".format(' '.join(map(str, report['recommended']))))
+    return "\n".join(lines) + "\n"
+
+
+def sweep(args):
+    os.makedirs(args.workdir, exist_ok=True)
+    train_path   = os.path.join(args.workdir, "train.txt")
+    heldout_path = os.path.join(args.workdir, "heldout.txt")
+    num_heldout  = split_documents(args.preprocessed_docs, train_path, heldout_path, args.heldout, args.random_seed)
+    if num_heldout == 0:
+        sys.stderr.write("Error: no documents held out; try a larger --heldout\n")
+        sys.exit(1)
+    ks = sorted(set(args.granularities))
+    sys.stderr.write("Training {} models (K = {}) on {} with {} held out, {} at a time\n".format(
+        len(ks), ' '.join(map(str, ks)), train_path, num_heldout, args.jobs))
+    with ThreadPoolExecutor(args.jobs) as pool:
+        modeldirs = dict(zip(ks, pool.map(lambda k: train_model(args, k, train_path), ks)))
+    failed = [k for k in ks if modeldirs[k] is None]
+    if failed:
+        sys.stderr.write("Error: training failed for K = {}\n".format(' '.join(map(str, failed))))
+        sys.exit(1)
+
+    results, topics_by_k = [], {}
+    for k in ks:
+        vocab, nkw, alpha, beta = read_topics(modeldirs[k], args.modelname, k)
+        total, scored = heldout_log_likelihood(heldout_path, vocab, nkw, alpha, beta)
+        results.append({'numtopics': k, 'll_per_token': round(total / max(1, scored), 6), 'tokens_scored': scored})
+        top = np.argsort(-nkw, axis=0, kind='stable')[:num_top_words]
+        topics_by_k[k] = [[vocab[v] for v in top[:, t]] for t in range(k)]
+        sys.stderr.write("K={}: held-out LL/token {:.4f}\n".format(k, results[-1]['ll_per_token']))
+    coherence = None
+    if args.coherence:
+        coherence = umass_coherence(train_path, topics_by_k)
+        for r in results:
+            r['coherence'] = round(coherence[r['numtopics']], 4)
+
+    knee, recommended = recommend(ks, [r['ll_per_token'] for r in results], coherence, args.recommend)
+    return {'granularities':     ks,
+            'heldout_fraction':  args.heldout,
+            'heldout_documents': num_heldout,
+            'numiterations':     args.numiterations,
+            'package':           args.package,
+            'results':           results,
+            'knee':              knee,
+            'recommended':       recommended}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Train a range of granularities on a held-out split and recommend a few by knee detection')
+    parser.add_argument('--preprocessed_docs', required=True, help='Preprocessed docID<tab>label<tab>text file')
+    parser.add_argument('--workdir',           required=True, help='Directory for the split and the sweep models')
+    parser.add_argument('--modelname',         default='model')
+    parser.add_argument('--run_mallet',        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run_mallet.py'))
+    parser.add_argument('--package',           default='mallet', help='As for run_mallet.py')
+    parser.add_argument('--mallet_bin',        default=None)
+    parser.add_argument('--granularities',     nargs='+', type=int, required=True, help='Numbers of topics to try')
+    parser.add_argument('--numiterations',     type=int,   default=200, help='Iterations per sweep model (fewer than a full run)')
+    parser.add_argument('--heldout',           type=float, default=0.1, help='Fraction of documents held out')
+    parser.add_argument('--jobs',              type=int,   default=0, help='Models trained at once (0 = one per core, up to the number of K values)')
+    parser.add_argument('--num_threads',       type=int,   default=1, help='Threads per model')
+    parser.add_argument('--random_seed',       type=int,   default=0)
+    parser.add_argument('--coherence',         action='store_true', help='Also score UMass coherence, and prefer coherent neighbours of the knee')
+    parser.add_argument('--recommend',         type=int,   default=3, help='Number of granularities to recommend')
+    parser.add_argument('--output_json',       required=True)
+    parser.add_argument('--output_txt',        required=True)
+    args = parser.parse_args()
+    if args.jobs <= 0:
+        args.jobs = min(len(args.granularities), os.cpu_count() or 1)
+
+    report = sweep(args)
+    with open(args.output_json, 'w') as f:
+        json.dump(report, f, indent=2)
+    text = summary_text(report)
+    with open(args.output_txt, 'w') as f:
+        f.write(text)
+    sys.stderr.write(text)
+    sys.stderr.write("Wrote {} and {}\n".format(args.output_json, args.output_txt))
@@ -0,0 +1,230 @@
+################################################################
+#
+#  Successive-halving search over alpha, beta and the optimize interval
+#
+#  MALLET's alpha and beta priors and how often they are re-optimized
+#  (--optimize-interval) affect topic quality, but trying every setting
+#  with a full training budget is expensive. This starts every candidate
+#  configuration on a small iteration budget and keeps only the best
+#  ones for further training:
+#
+#    - each round trains the surviving configurations for
+#      --round_iterations more iterations, --jobs at a time; after the
+#      first round each continues from its own saved state (run_mallet.py
+#      --warm_start) rather than starting over
+#    - after each round, configurations are ranked by held-out
+#      log-likelihood per token (document completion, as in
+#      granularity_sweep.py) or by training LL/token (--metric ll), and
+#      the best --keep fraction survive
+#    - rounds continue until one configuration is left, which is the winner
+#
+#  Candidates are the grid of --alphas x --betas x --optimize_intervals,
+#  or a random sample of --max_configs of them. The winner is recorded in
+#  --output_json under 'best', for driver.py to use in the full run.
+#  mallet and gibbs only (the backends that can continue from a state).
+#
+#  Example:
+#    python hyperparameter_search.py
+#      --preprocessed_docs  /path/to/modeling/processed/analysis_preprocessed.txt
+#      --workdir            /path/to/modeling/hyperparameter_search
+#      --modelname          analysis
+#      --mallet_bin         /path/to/mallet/bin
+#      --numtopics          20
+#      --output_json        /path/to/modeling/hyperparameter_search/search.json
+#      --output_txt         /path/to/out/hyperparameter_search.txt
+#
+################################################################
+import argparse
+import itertools
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import granularity_sweep
+
+default_alphas             = [1.0, 5.0, 20.0, 50.0]
+default_betas              = [0.005, 0.01, 0.05, 0.1]
+default_optimize_intervals = [0, 10, 50]
+
+
+def candidate_configs(alphas, betas, intervals, max_configs, seed):
+    # The grid of settings, or a random sample of MAX_CONFIGS of them
+    grid = [{'alpha': a, 'beta': b, 'optimize_interval': i} for a, b, i in itertools.product(alphas, betas, intervals)]
+    if max_configs and len(grid) > max_configs:
+        rng  = np.random.default_rng(seed)
+        grid = [grid[i] for i in sorted(rng.choice(len(grid), max_configs, replace=False))]
+    return grid
+
+
+def config_dir(workdir, index):
+    return os.path.join(workdir, "config_{}".format(index + 1))
+
+
+def train_round(args, index, config, round_number, train_path):
+    '''
+    Trains configuration INDEX for one round, continuing from its previous round's state if
+    there was one. Returns the round's model directory, or None on failure.
+    '''
+    rundir   = config_dir(args.workdir, index)
+    modeldir = os.path.join(rundir, "round_{}".format(round_number))
+    if os.path.isdir(modeldir):
+        shutil.rmtree(modeldir)
+    os.makedirs(rundir, exist_ok=True)
+    extra = "--random-seed {} --alpha {} --beta {}".format(args.random_seed, config['alpha'], config['beta'])
+    cmd   = ["python", args.run_mallet,
+             "--package", args.package,
+             "--workdir", rundir,
+             "--modeldir", modeldir,
+             "--modelname", args.modelname,
+             "--preprocessed_docs", train_path,
+             "--numtopics", str(args.numtopics),
+             "--numiterations", str(args.round_iterations),
+             "--optimize_interval", str(config['optimize_interval']),
+             "--num_threads", str(args.num_threads),
+             "--output_profile", "full",
+             "--model2csv", ""]
+    if round_number == 1:
+        # Let optimization start within the first round's budget (MALLET's default burn-in is 200)
+        extra += " --optimize-burn-in {}".format(min(200, args.round_iterations // 2))
+    else:
+        previous = os.path.join(rundir, "round_{}".format(round_number - 1))
+        cmd     += ["--warm_start", os.path.join(previous, args.modelname + '.topic-state.gz'),
+                    "--warm_start_iterations", str(args.round_iterations)]
+    cmd += ["--extra_args", extra]
+    if args.mallet_bin:
+        cmd += ["--mallet_bin", args.mallet_bin]
+    with open(os.path.join(rundir, "round_{}.log".format(round_number)), 'w') as log:
+        status = subprocess.run(cmd, stdout=log, stderr=subprocess.STDOUT).returncode
+    if status != 0:
+        sys.stderr.write("Config {}: round {} failed (exit {}), see {}\n".format(index + 1, round_number, status, log.name))
+        return None
+    if round_number > 1:
+        # Only the latest state is needed to continue
+        shutil.rmtree(os.path.join(rundir, "round_{}".format(round_number - 1)))
+    return modeldir
+
+
+def score(args, modeldir, heldout_path, config):
+    # Higher is better: held-out or training log-likelihood per token, with the configuration's beta
+    # unless MALLET optimized it
+    if args.metric == 'll':
+        with open(os.path.join(modeldir, args.modelname + '.train-metrics.json')) as f:
+            series = json.load(f)['series']
+        return series[-1]['ll_per_token'] if series else -math.inf
+    vocab, nkw, alpha, beta = granularity_sweep.read_topics(modeldir, args.modelname, args.numtopics, config['beta'])
+    total, scored = granularity_sweep.heldout_log_likelihood(heldout_path, vocab, nkw, alpha, beta)
+    return total / max(1, scored)
+
+
+def search(args):
+    os.makedirs(args.workdir, exist_ok=True)
+    train_path, heldout_path = args.preprocessed_docs, None
+    if args.metric == 'heldout':
+        train_path   = os.path.join(args.workdir, "train.txt")
+        heldout_path = os.path.join(args.workdir, "heldout.txt")
+        if granularity_sweep.split_documents(args.preprocessed_docs, train_path, heldout_path, args.heldout, args.random_seed) == 0:
+            sys.stderr.write("Error: no documents held out; try a larger --heldout\n")
+            sys.exit(1)
+
+    configs   = candidate_configs(args.alphas, args.betas, args.optimize_intervals, args.max_configs, args.random_seed)
+    for c in configs:
+        c['scores'] = []
+    surviving = list(range(len(configs)))
+    rounds    = 0
+    while True:
+        rounds += 1
+        sys.stderr.write("Round {}: training {} configurations for {} iterations, {} at a time\n".format(
+            rounds, len(surviving), args.round_iterations, args.jobs))
+        with ThreadPoolExecutor(args.jobs) as pool:
+            modeldirs = list(pool.map(lambda i: train_round(args, i, configs[i], rounds, train_path), surviving))
+        for i, modeldir in zip(surviving, modeldirs):
+            configs[i]['scores'].append(score(args, modeldir, heldout_path, configs[i]) if modeldir else -math.inf)
+            configs[i]['modeldir'] = modeldir
+        ranked = sorted(surviving, key=lambda i: -configs[i]['scores'][-1])
+        for i in ranked:
+            c = configs[i]
+            sys.stderr.write("  alpha {:<6} beta {:<6} optimize-interval {:<4} {}\n".format(
+                c['alpha'], c['beta'], c['optimize_interval'], c['scores'][-1]))
+        if all(configs[i]['modeldir'] is None for i in ranked):
+            break
+        surviving = ranked[:max(1, min(len(ranked) - 1, int(math.ceil(len(ranked) * args.keep))))]
+        for i in ranked[len(surviving):]:
+            shutil.rmtree(config_dir(args.workdir, i), ignore_errors=True)
+        # The last one left is the winner, with no need to train it further
+        if len(surviving) == 1:
+            break
+
+    best = configs[ranked[0]]
+    if best['modeldir'] is None:
+        sys.stderr.write("Error: every configuration failed\n")
+        sys.exit(1)
+    return {'package':          args.package,
+            'numtopics':        args.numtopics,
+            'metric':           args.metric,
+            'round_iterations': args.round_iterations,
+            'rounds':           rounds,
+            'keep':             args.keep,
+            'configs':          [{key: c[key] for key in ('alpha', 'beta', 'optimize_interval', 'scores')} for c in configs],
+            'best':             {key: best[key] for key in ('alpha', 'beta', 'optimize_interval')},
+            'best_score':       best['scores'][-1],
+            'best_iterations':  args.round_iterations * rounds}
+
+
+def summary_text(report):
+    lines = []
+    add   = lines.append
+    add("Hyperparameter search: {} configurations, {} rounds of {} iterations, K={}".format(
+        len(report['configs']), report['rounds'], report['round_iterations'], report['numtopics']))
+    add("======================")
+    add("Score: {}".format("held-out LL/token" if report['metric'] == 'heldout' else "training LL/token"))
+    for c in sorted(report['configs'], key=lambda c: (-len(c['scores']), -c['scores'][-1])):
+        add("  alpha {:<6} beta {:<6} optimize-interval {:<4} rounds {}  last score {:.4f}".format(
+            c['alpha'], c['beta'], c['optimize_interval'], len(c['scores']), c['scores'][-1]))
+    best = report['best']
+    add("")
+    add("Best: alpha {} beta {} optimize-interval {}".format(best['alpha'], best['beta'], best['optimize_interval']))
+    return "\n".join(lines) + "\n"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Successive-halving search over alpha, beta and optimize interval')
+    parser.add_argument('--preprocessed_docs',  required=True, help='Preprocessed docID<tab>label<tab>text file')
+    parser.add_argument('--workdir',            required=True, help='Directory for the candidate models')
+    parser.add_argument('--modelname',          default='model')
+    parser.add_argument('--run_mallet',         default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run_mallet.py'))
+    parser.add_argument('--package',            default='mallet', choices=['mallet', 'gibbs'])
+    parser.add_argument('--mallet_bin',         default=None)
+    parser.add_argument('--numtopics',          type=int,   required=True)
+    parser.add_argument('--alphas',             type=float, nargs='+', default=default_alphas, help='Alpha (sum over topics) values to try')
+    parser.add_argument('--betas',              type=float, nargs='+', default=default_betas)
+    parser.add_argument('--optimize_intervals', type=int,   nargs='+', default=default_optimize_intervals, help='0 = no optimization')
+    parser.add_argument('--max_configs',        type=int,   default=0, help='Try a random sample of this many settings (0 = all)')
+    parser.add_argument('--round_iterations',   type=int,   default=100, help='Iterations added per round')
+    parser.add_argument('--keep',               type=float, default=0.5, help='Fraction of configurations kept after each round')
+    parser.add_argument('--metric',             default='heldout', choices=['heldout', 'll'])
+    parser.add_argument('--heldout',            type=float, default=0.1, help='Fraction of documents held out (--metric heldout)')
+    parser.add_argument('--jobs',               type=int,   default=0, help='Configurations trained at once (0 = one per core)')
+    parser.add_argument('--num_threads',        type=int,   default=1, help='Threads per model')
+    parser.add_argument('--random_seed',        type=int,   default=0)
+    parser.add_argument('--output_json',        required=True)
+    parser.add_argument('--output_txt',         required=True)
+    args = parser.parse_args()
+    if args.jobs <= 0:
+        args.jobs = os.cpu_count() or 1
+    if not 0 < args.keep < 1:
+        parser.error('--keep must be a fraction in (0, 1)')
+
+    report = search(args)
+    with open(args.output_json, 'w') as f:
+        json.dump(report, f, indent=2)
+    text = summary_text(report)
+    with open(args.output_txt, 'w') as f:
+        f.write(text)
+    sys.stderr.write(text)
+    sys.stderr.write("Wrote {} and {}\n".format(args.output_json, args.output_txt))
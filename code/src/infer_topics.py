@@ -0,0 +1,251 @@
+################################################################
+#
+#  Topic inference for new or held-out documents, in parallel shards
+#
+#  Scores documents that were not used in training under a trained
+#  model, so a model can be trained on a representative subset and then
+#  applied to the full collection. The documents come from a document
+#  store (see docstore.py), are split into --shards contiguous ranges,
+#  and each shard is preprocessed with the same script and stoplist as
+#  the training data and then inferred, --jobs shards at a time:
+#
+#    --package mallet   mallet import-file --use-pipe-from the training
+#                       instances (same alphabet), then mallet
+#                       infer-topics with the model's .inferencer
+#    other packages     fold-in under the topics in MODELNAME.model
+#                       (topic_model_io.fold_in), in-process
+#
+#  Preprocessed shards are kept in --shard_dir and reused by later runs
+#  on the same store (e.g. for other granularities), each with the
+#  preprocessing script's messages in shard_N.txt.log. The inferred rows
+#  are appended, in document store order, to a copy of the training
+#  documents' document_topics CSV, with the store's docIDs.
+#
+#  Example:
+#    python infer_topics.py
+#      --docstore              /path/to/modeling/analysis_infer_raw.txt
+#      --preprocessing         /path/to/topcat/code/src/preprocessing_en.py
+#      --stoplist              /path/to/mallet/stoplists/en.txt
+#      --modeldir              /path/to/modeling/model_k20/mallet_output
+#      --modelname             analysis
+#      --training_instances    /path/to/modeling/analysis.mallet
+#      --mallet_bin            /path/to/mallet/bin
+#      --shard_dir             /path/to/modeling/infer_shards
+#      --document_topics_file  /path/to/modeling/model_k20/curation/document_topics.csv
+#      --output                /path/to/modeling/model_k20/curation/document_topics_all.csv
+#
+################################################################
+import argparse
+import csv
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+import mallet_utils
+import topic_model_io
+from docstore import DocStore
+
+default_infer_iterations = 100
+default_infer_burnin     = 10
+
+
+def shard_ranges(num_docs, num_shards):
+    # NUM_SHARDS contiguous (start, stop) row ranges of about equal size, none empty
+    cuts = np.unique(np.linspace(0, num_docs, max(1, min(num_shards, num_docs)) + 1).astype(int))
+    return list(zip(cuts[:-1].tolist(), cuts[1:].tolist()))
+
+
+def preprocess_shard(preprocessing, stoplist, label, rawfile, outfile):
+    # Runs the preprocessing script on one shard, with its messages in OUTFILE.log; returns the exit status
+    with open(outfile + '.log', 'w') as log:
+        return subprocess.run(["python", preprocessing, "--stoplist", stoplist, "--infile", rawfile,
+                               "--outfile", outfile, "--label", label], stderr=log).returncode
+
+
+def preprocess_shards(docstore, preprocessing, stoplist, label, shard_dir, num_shards, jobs):
+    '''
+    Splits the documents in DOCSTORE into shards and preprocesses them, JOBS at a time, into
+    SHARD_DIR/shard_N.txt (docID<tab>LABEL<tab>text, docIDs numbered from 1 within each shard).
+    Each shard's preprocessing messages go to SHARD_DIR/shard_N.txt.log.
+    Reuses earlier results when SHARD_DIR's manifest says they are for this store and script.
+    Returns the list of (start, stop, preprocessed file).
+    '''
+    stat     = os.stat(docstore)
+    manifest = {'docstore': os.path.abspath(docstore), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                'preprocessing': os.path.abspath(preprocessing), 'stoplist': os.path.abspath(stoplist),
+                'label': label, 'num_shards': num_shards}
+    manifest_file = os.path.join(shard_dir, 'manifest.json')
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            previous = json.load(f)
+        if previous['settings'] == manifest:
+            sys.stderr.write("Reusing preprocessed shards in {}\n".format(shard_dir))
+            return [tuple(s) for s in previous['shards']]
+
+    os.makedirs(shard_dir, exist_ok=True)
+    with DocStore(docstore) as store:
+        ranges  = shard_ranges(len(store), num_shards)
+        offsets = [int(store.offsets[start]) for start, _ in ranges] + [int(store.offsets[-1])]
+    shards = []
+    with open(docstore, 'rb') as blob:
+        for i, (start, stop) in enumerate(ranges):
+            # The store's offsets give each shard's lines as one byte range of the blob
+            rawfile = os.path.join(shard_dir, "shard_{}.raw.txt".format(i + 1))
+            with open(rawfile, 'wb') as f:
+                blob.seek(offsets[i])
+                f.write(blob.read(offsets[i + 1] - offsets[i]))
+            shards.append((start, stop, rawfile, os.path.join(shard_dir, "shard_{}.txt".format(i + 1))))
+
+    sys.stderr.write("Preprocessing {} documents in {} shards with {} workers\n".format(
+        ranges[-1][1] if ranges else 0, len(shards), jobs))
+    with ThreadPoolExecutor(jobs) as pool:
+        statuses = list(pool.map(lambda s: preprocess_shard(preprocessing, stoplist, label, s[2], s[3]), shards))
+    failed = [s[3] + '.log' for s, status in zip(shards, statuses) if status != 0]
+    if failed:
+        sys.stderr.write("Error: preprocessing failed; see {}\n".format(' '.join(failed)))
+        sys.exit(1)
+    for _, _, rawfile, _ in shards:
+        os.remove(rawfile)
+
+    shards = [(start, stop, outfile) for start, stop, _, outfile in shards]
+    with open(manifest_file, 'w') as f:
+        json.dump({'settings': manifest, 'shards': shards}, f, indent=2)
+    return shards
+
+
+def infer_mallet_shard(mallet_bin, preprocessed, training_instances, inferencer, output, seed, memory):
+    # Import with the training data's pipe (so word indices agree), then sample topics for the shard
+    instances = output + '.mallet'
+    cmds = ["{}/mallet import-file --input {} --output {} --use-pipe-from {} --token-regex '\\S+' --preserve-case "
+            "--keep-sequence".format(mallet_bin, preprocessed, instances, training_instances),
+            "{}/mallet infer-topics --inferencer {} --input {} --output-doc-topics {} --num-iterations {} "
+            "--burn-in {} --random-seed {}".format(mallet_bin, inferencer, instances, output,
+                                                   default_infer_iterations, default_infer_burnin, seed)]
+    for cmd in cmds:
+        if mallet_utils.run_mallet_command(cmd, memory) != 0:
+            return False
+    os.remove(instances)
+    return True
+
+
+def infer_numpy_shard(model_file, preprocessed, output):
+    # Fold-in under the saved model's topics, for the NumPy backends
+    model   = topic_model_io.load_model(model_file)
+    weights = model['nkw'] + model['beta']
+    phi     = (weights / weights.sum(axis=0)).T
+    topic_model_io.fold_in_doc_topics(output, preprocessed, model['vocab'], phi, model['alpha'])
+    return True
+
+
+def read_doc_topics(path):
+    # Topic proportions from a doc-topics file, one row per document in file order (MALLET's '#' header skipped)
+    rows = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.startswith('#') or not line.strip():
+                continue
+            rows.append([float(x) for x in line.rstrip('\r\n').split('\t')[2:]])
+    return np.array(rows)
+
+
+def merge_document_topics(existing, output, docids, theta, store=None):
+    '''
+    Copies the document_topics CSV EXISTING to OUTPUT and appends a row for each inferred
+    document, with the same columns: docID, the topic proportions, and (if EXISTING has
+    one) the text, fetched from STORE.
+    '''
+    with open(existing, newline='', encoding='utf-8') as f:
+        header = next(csv.reader(f))
+    topics = [i for i, name in enumerate(header) if name.startswith('Topic ')]
+    if len(topics) != theta.shape[1]:
+        sys.stderr.write("Error: {} has {} topic columns but the inferred documents have {} topics\n".format(
+            existing, len(topics), theta.shape[1]))
+        sys.exit(1)
+    with open(existing, 'rb') as src, open(output, 'wb') as dst:
+        for block in iter(lambda: src.read(1 << 20), b''):
+            dst.write(block)
+    with open(output, 'a', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        for row, (docid, probs) in enumerate(zip(docids, theta.tolist())):
+            values = {'docID': docid}
+            if 'text' in header and store is not None:
+                values['text'] = store.text(row)
+            for i, p in zip(topics, probs):
+                values[header[i]] = repr(p)
+            writer.writerow([values.get(name, '') for name in header])
+    sys.stderr.write("Wrote {} ({} inferred documents added)\n".format(output, len(docids)))
+
+
+def infer(args):
+    needed = os.path.join(args.modeldir, args.modelname + ('.inferencer' if args.package == 'mallet' else '.model'))
+    if not os.path.exists(needed):
+        sys.stderr.write("Error: no {}; train with run_mallet.py --output_profile inference or full\n".format(needed))
+        sys.exit(1)
+    shards = preprocess_shards(args.docstore, args.preprocessing, args.stoplist, args.modelname,
+                               args.shard_dir, args.shards, args.jobs)
+    # Per-run scratch directory, so runs for several models can share SHARD_DIR at once
+    scratch = tempfile.mkdtemp(dir=args.shard_dir)
+    outputs = [os.path.join(scratch, "shard_{}.doc-topics".format(i + 1)) for i in range(len(shards))]
+    sys.stderr.write("Inferring topics for {} shards with {} workers\n".format(len(shards), args.jobs))
+
+    if args.package == 'mallet':
+        inferencer = os.path.join(args.modeldir, args.modelname + '.inferencer')
+        memory     = (args.mallet_memory or os.environ.get('MALLET_MEMORY') or
+                      mallet_utils.auto_memory(max(os.path.getsize(pre) for _, _, pre in shards)))
+        with ThreadPoolExecutor(args.jobs) as pool:
+            done = list(pool.map(lambda i: infer_mallet_shard(args.mallet_bin, shards[i][2], args.training_instances,
+                                                              inferencer, outputs[i], args.random_seed, memory),
+                                 range(len(shards))))
+    else:
+        model_file = os.path.join(args.modeldir, args.modelname + '.model')
+        with ProcessPoolExecutor(args.jobs) as pool:
+            done = list(pool.map(infer_numpy_shard, [model_file] * len(shards), [pre for _, _, pre in shards], outputs))
+    if not all(done):
+        sys.stderr.write("Error: inference failed for {} of {} shards\n".format(done.count(False), len(shards)))
+        sys.exit(1)
+
+    theta = []
+    for (start, stop, _), output in zip(shards, outputs):
+        rows = read_doc_topics(output)
+        if len(rows) != stop - start:
+            sys.stderr.write("Error: {} has {} rows for {} documents\n".format(output, len(rows), stop - start))
+            sys.exit(1)
+        theta.append(rows)
+    shutil.rmtree(scratch)
+    theta = np.vstack(theta)
+    with DocStore(args.docstore) as store:
+        merge_document_topics(args.document_topics_file, args.output, store.docids(), theta, store)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Infer topics for new documents in parallel shards and merge them into document_topics')
+    parser.add_argument('--docstore',             required=True, help='Document store (see docstore.py) holding the new documents')
+    parser.add_argument('--preprocessing',        required=True, help='Preprocessing script used for the training data')
+    parser.add_argument('--stoplist',             required=True, help='Stoplist used for the training data')
+    parser.add_argument('--modeldir',             required=True, help='Trained model directory (run_mallet.py --modeldir)')
+    parser.add_argument('--modelname',            required=True)
+    parser.add_argument('--package',              default='mallet', help='Package the model was trained with')
+    parser.add_argument('--training_instances',   default=None, help='MALLET instance file the model was trained on (mallet only)')
+    parser.add_argument('--mallet_bin',           default=None, help='Path to mallet bin (mallet only)')
+    parser.add_argument('--mallet_memory',        default=None, help='JVM heap per shard (default: $MALLET_MEMORY if set, else sized to the shard)')
+    parser.add_argument('--shard_dir',            required=True, help='Directory for preprocessed shards, reused across runs')
+    parser.add_argument('--shards',               type=int, default=0, help='Number of shards (default: one per worker)')
+    parser.add_argument('--jobs',                 type=int, default=0, help='Shards processed at once (0 = one per core)')
+    parser.add_argument('--random_seed',          type=int, default=0)
+    parser.add_argument('--document_topics_file', required=True, help='document_topics CSV for the training documents')
+    parser.add_argument('--output',               required=True, help='Merged document_topics CSV to write')
+    args = parser.parse_args()
+
+    if args.jobs <= 0:
+        args.jobs = mallet_utils.available_cores()
+    if args.shards <= 0:
+        args.shards = args.jobs
+    if args.package == 'mallet' and (args.training_instances is None or args.mallet_bin is None):
+        parser.error('--package mallet needs --training_instances and --mallet_bin')
+    infer(args)
@@ -0,0 +1,238 @@
+################################################################
+#
+#  Anchor-word (spectral) topic model (Arora et al. 2013, "A practical
+#  algorithm for topic modeling with provable guarantees")
+#
+#  For fast granularity sweeps. The corpus is read once to build the
+#  word co-occurrence matrix Q over the most frequent --max-vocab words.
+#  Q's leading eigenvectors are cached (--cooccurrence-cache) and reused
+#  by every later run on the same corpus, so everything after the first
+#  run costs time in the vocabulary size and K, not the corpus size:
+#
+#    denoising  Q is replaced by its best rank-K approximation (the exact
+#               Q of a K-topic model has rank K; sampling noise otherwise
+#               makes rare words look like extreme points), and the rows
+#               of the row-normalized Q are handled in K-dimensional
+#               eigenvector coordinates.
+#    anchors    greedy farthest-point search: the candidate row farthest
+#               from the origin, then repeatedly the row farthest from the
+#               span of the anchors so far. Candidates are words in at
+#               least --min-anchor-docs documents.
+#    recovery   each word's row is written as a convex combination of the
+#               anchors' rows (least squares on the simplex, solved by
+#               exponentiated gradient for all words at once), which by
+#               Bayes' rule gives p(word | topic).
+#
+#  Documents get topic proportions by fold-in under the recovered topics
+#  (topic_model_io.fold_in). Takes the same options as `mallet train-topics`
+#  that TOPCAT uses and writes the same files (see topic_model_io.py), so it
+#  can be used as run_mallet.py --package anchor. word-topic-counts are
+#  expected counts over the capped vocabulary; there is no state file and
+#  --num-iterations is ignored.
+#
+#  Example:
+#    python lda_anchor.py --input corpus.txt --num-topics 30 --max-vocab 5000
+#        --cooccurrence-cache work/m.anchor-cooccurrence.npz
+#        --output-doc-topics model/m.doc-topics --word-topic-counts-file model/m.word-topic-counts
+#        --topic-word-weights-file model/m.topic-word-weights --output-topic-keys model/m.topic-keys
+#
+################################################################
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import scipy.sparse as sp
+
+import topic_model_io
+
+default_alpha_sum       = 5.0
+default_beta            = 0.01
+default_max_vocab       = 5000
+default_min_anchor_docs = 10
+cached_rank             = 500
+recover_iterations      = 500
+batch_size              = 4096
+
+
+def select_vocabulary(path, max_vocab):
+    # Most frequent MAX_VOCAB words by document frequency, kept in first-occurrence order
+    df = {}
+    for _, tokens in topic_model_io.iter_documents(path):
+        for t in set(tokens):
+            df[t] = df.get(t, 0) + 1
+    words = list(df)
+    freq  = np.array([df[w] for w in words])
+    keep  = np.sort(np.argsort(-freq, kind='stable')[:max_vocab])
+    return [words[i] for i in keep], freq[keep]
+
+
+def build_cooccurrence(path, vocab):
+    '''
+    Q[i,j] = average over documents of the probability that two distinct tokens drawn
+    from the document are words i and j. Returns Q and the number of vocabulary tokens.
+    '''
+    index  = {w: i for i, w in enumerate(vocab)}
+    Q      = np.zeros((len(vocab), len(vocab)))
+    ndocs  = 0
+    tokens = 0
+    for _, X in topic_model_io.iter_batches(path, index, batch_size):
+        n       = np.asarray(X.sum(axis=1)).ravel()
+        tokens += n.sum()
+        X       = X[n >= 2]
+        n       = n[n >= 2]
+        weights = 1.0 / (n * (n - 1))
+        scaled  = sp.diags(np.sqrt(weights)) @ X
+        Q      += (scaled.T @ scaled).toarray()
+        Q[np.diag_indices_from(Q)] -= X.T @ weights
+        ndocs  += X.shape[0]
+    return Q / max(1, ndocs), int(tokens)
+
+
+def load_cache(path, input_path, max_vocab):
+    # Cached co-occurrence statistics, if they are for this version of the input and this vocabulary cap
+    if not path or not os.path.exists(path):
+        return None
+    stat = os.stat(input_path)
+    with np.load(path) as npz:
+        cache = {key: npz[key] for key in npz.files}
+    if (int(cache['input_size']) != stat.st_size or int(cache['input_mtime']) != stat.st_mtime_ns
+            or int(cache['max_vocab']) != max_vocab):
+        sys.stderr.write("Ignoring co-occurrence cache {}: it is for a different corpus or vocabulary size\n".format(path))
+        return None
+    sys.stderr.write("Using co-occurrence cache {}\n".format(path))
+    cache['vocab'] = cache['vocab'].tolist()
+    return cache
+
+
+def save_cache(path, cache):
+    # Several granularities may be trained at once; each writes its own temporary file and renames it
+    tmpname = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmpname, 'wb') as f:
+        np.savez(f, **{key: (np.array(value, dtype=str) if key == 'vocab' else value) for key, value in cache.items()})
+    os.replace(tmpname, path)
+
+
+def find_anchors(M, candidates, num_anchors):
+    '''
+    Greedy anchor search over the rows of M: the candidate row farthest from the origin,
+    then repeatedly the row farthest from the span of the anchors found so far (after
+    translating the first anchor to the origin). Returns row indices, in the order found.
+    '''
+    R       = M[candidates].copy()
+    anchors = [int(np.argmax((R ** 2).sum(axis=1)))]
+    R      -= R[anchors[0]]
+    for _ in range(1, num_anchors):
+        norms = (R ** 2).sum(axis=1)
+        norms[anchors] = -1
+        best  = int(np.argmax(norms))
+        anchors.append(best)
+        basis = R[best] / np.sqrt(norms[best])
+        R    -= np.outer(R @ basis, basis)
+    return candidates[anchors]
+
+
+def recover(M, anchors, iterations=recover_iterations):
+    '''
+    For every row w of M at once, C[w] = argmin over the simplex of ||M[w] - C[w] M[anchors]||^2,
+    by exponentiated gradient with a step size set from the problem's curvature.
+    '''
+    X    = M[anchors]
+    G    = X @ X.T
+    B    = M @ X.T
+    step = 1.0 / (2 * np.linalg.eigvalsh(G)[-1])
+    C    = np.full((M.shape[0], len(anchors)), 1.0 / len(anchors))
+    for _ in range(iterations):
+        grad = 2 * (C @ G - B)
+        C   *= np.exp(-step * (grad - grad.min(axis=1, keepdims=True)))
+        C   /= C.sum(axis=1, keepdims=True)
+    C[anchors] = np.eye(len(anchors))
+    return C
+
+
+def cooccurrence_statistics(path, max_vocab, num_topics, cache_path=None):
+    # Vocabulary, document frequencies, word probabilities and leading eigenpairs of Q, from the cache if possible
+    cache = load_cache(cache_path, path, max_vocab)
+    if cache is not None and len(cache['eigenvalues']) >= num_topics:
+        return cache
+    vocab, df = select_vocabulary(path, max_vocab)
+    sys.stderr.write("Building co-occurrence matrix over {} word types\n".format(len(vocab)))
+    Q, tokens = build_cooccurrence(path, vocab)
+    values, vectors = np.linalg.eigh(Q)
+    top   = np.argsort(-values)[:max(num_topics, min(len(vocab), cached_rank))]
+    stat  = os.stat(path)
+    cache = {'vocab': vocab, 'df': df, 'p_word': Q.sum(axis=1), 'tokens': tokens,
+             'eigenvalues': values[top], 'eigenvectors': vectors[:, top],
+             'max_vocab': max_vocab, 'input_size': stat.st_size, 'input_mtime': stat.st_mtime_ns}
+    if cache_path:
+        save_cache(cache_path, cache)
+    return cache
+
+
+def train(path, num_topics, max_vocab=default_max_vocab, min_anchor_docs=default_min_anchor_docs, cache_path=None):
+    '''
+    Returns (vocab, nkw) with NKW the V x K expected word-topic counts over the capped vocabulary.
+    '''
+    started = time.time()
+    stats   = cooccurrence_statistics(path, max_vocab, num_topics, cache_path)
+    vocab   = stats['vocab']
+    sys.stderr.write("total tokens: {}\n".format(int(stats['tokens'])))
+
+    # Rows of the rank-K approximation of Q, in eigenvector coordinates, normalized by the row sums
+    U      = stats['eigenvectors'][:, :num_topics]
+    coords = U * stats['eigenvalues'][:num_topics]
+    row_sums = coords @ U.sum(axis=0)
+    usable = row_sums > 1e-12 * row_sums.max()
+    M      = coords / np.where(usable, row_sums, 1)[:, None]
+
+    candidates = np.flatnonzero(usable & (stats['df'] >= min_anchor_docs))
+    if len(candidates) < num_topics:
+        candidates = np.flatnonzero(usable)
+    if len(candidates) < num_topics:
+        sys.stderr.write("Error: only {} candidate anchor words for {} topics\n".format(len(candidates), num_topics))
+        sys.exit(1)
+    anchors = find_anchors(M, candidates, num_topics)
+    sys.stderr.write("Anchor words: {}\n".format(' '.join(vocab[a] for a in anchors)))
+
+    C      = recover(M, anchors)
+    C[~usable] = 1.0 / num_topics
+    p_word = stats['p_word'] / stats['p_word'].sum()
+    nkw    = stats['tokens'] * p_word[:, None] * C
+    sys.stderr.write("\nTotal time: {:.0f} seconds\n".format(time.time() - started))
+    return vocab, nkw
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Anchor-word topic model; accepts the mallet train-topics options TOPCAT uses')
+    parser.add_argument('--input',               required=True, help='docID<tab>label<tab>text file')
+    parser.add_argument('--num-topics',          type=int,   default=10)
+    parser.add_argument('--max-vocab',           type=int,   default=default_max_vocab, help='Words (by document frequency) in the model')
+    parser.add_argument('--min-anchor-docs',     type=int,   default=default_min_anchor_docs, help='Documents a word must appear in to be an anchor')
+    parser.add_argument('--cooccurrence-cache',  default=None, help='.npz file caching the co-occurrence statistics')
+    parser.add_argument('--alpha',               type=float, default=default_alpha_sum, help='Sum of the Dirichlet prior used for fold-in')
+    parser.add_argument('--beta',                type=float, default=default_beta, help='Smoothing added to expected counts')
+    parser.add_argument('--random-seed',         type=int,   default=0, help='Ignored: the method is deterministic')
+    parser.add_argument('--num-iterations',      type=int,   default=None, help='Ignored')
+    parser.add_argument('--optimize-interval',   type=int,   default=0, help='Ignored')
+    parser.add_argument('--num-threads',         type=int,   default=1, help='Ignored')
+    parser.add_argument('--output-model')
+    parser.add_argument('--output-doc-topics')
+    parser.add_argument('--output-topic-keys')
+    parser.add_argument('--output-state',        help='Ignored: there are no per-token topic assignments')
+    parser.add_argument('--word-topic-counts-file')
+    parser.add_argument('--topic-word-weights-file')
+    parser.add_argument('--inferencer-filename', help='Ignored: fold-in inference uses --output-model')
+    args = parser.parse_args()
+
+    vocab, nkw = train(args.input, args.num_topics, args.max_vocab, args.min_anchor_docs, args.cooccurrence_cache)
+    alpha   = np.full(args.num_topics, args.alpha / args.num_topics)
+    weights = nkw + args.beta
+    outputs = {'output-model':            args.output_model,
+               'output-topic-keys':       args.output_topic_keys,
+               'word-topic-counts-file':  args.word_topic_counts_file,
+               'topic-word-weights-file': args.topic_word_weights_file}
+    topic_model_io.write_mallet_outputs(outputs, vocab, nkw, alpha, args.beta, weights=weights)
+    if args.output_doc_topics:
+        phi = (weights / weights.sum(axis=0)).T
+        topic_model_io.fold_in_doc_topics(args.output_doc_topics, args.input, vocab, phi, alpha)
@@ -0,0 +1,377 @@
+################################################################
+#
+#  In-process LDA by collapsed Gibbs sampling, in NumPy
+#
+#  An alternative to MALLET that needs no JVM. Takes the same options
+#  as `mallet train-topics` that TOPCAT uses and writes the same output
+#  files (see topic_model_io.py), so run_mallet.py --package gibbs can
+#  use it in place of MALLET and model2csv.py reads the results unchanged.
+#  The one difference: --input is the docID<tab>label<tab>text file
+#  itself, since there is no separate import step. --input-state resumes
+#  from a state file, as in MALLET.
+#
+#  Sampling is blocked and vectorized: each sweep visits the tokens in
+#  random order in blocks of --block-size, and all tokens in a block are
+#  resampled at once from counts that exclude each token's own assignment
+#  (but not the others in its block), with counts updated after the block.
+#  With --num-threads N > 1 the documents are split into N shards sampled
+#  in separate processes against a shared snapshot of the word-topic
+#  counts, merged after every sweep (approximate distributed LDA, AD-LDA).
+#
+#  Hyperparameters are optimized as in MALLET: after --optimize-burn-in
+#  iterations and every --optimize-interval iterations, an asymmetric
+#  alpha and a symmetric beta are re-estimated with Minka's fixed-point
+#  updates from histograms of the counts. Progress is logged in MALLET's
+#  format ('<10> LL/token: -8.123', '[beta: 0.0123]').
+#
+#  With --convergence-tolerance T, LL/token is checked every
+#  --convergence-interval iterations and sampling stops early, before
+#  --num-iterations, once it changes by less than T (relative) between
+#  checks; 'Converged after N iterations' is logged.
+#
+#  Example:
+#    python lda_gibbs.py --input corpus.txt --num-topics 20 --num-iterations 1000
+#        --optimize-interval 10 --random-seed 13 --num-threads 4
+#        --output-doc-topics model/m.doc-topics --word-topic-counts-file model/m.word-topic-counts
+#        --topic-word-weights-file model/m.topic-word-weights --output-topic-keys model/m.topic-keys
+#
+################################################################
+import argparse
+import multiprocessing
+import sys
+import time
+
+import numpy as np
+from scipy.special import digamma, gammaln
+
+import topic_model_io
+
+# MALLET's defaults
+default_alpha_sum            = 5.0
+default_beta                 = 0.01
+default_burnin               = 200
+ll_interval                  = 10
+default_block_size           = 16384
+default_convergence_interval = 100
+
+
+class Shard:
+    '''
+    A contiguous range of documents with their tokens' topic assignments (Z)
+    and doc-topic counts (NDK). Word-topic counts are passed in to sweep().
+    Z starts out random unless given.
+    '''
+    def __init__(self, words, doc_ptr, num_topics, seed, z=None):
+        self.words   = words
+        self.doc_ptr = doc_ptr - doc_ptr[0]
+        self.docs    = np.repeat(np.arange(len(doc_ptr) - 1, dtype=np.int32), np.diff(self.doc_ptr))
+        self.rng     = np.random.default_rng(seed)
+        if z is None:
+            self.z   = self.rng.integers(num_topics, size=len(words), dtype=np.int32)
+        else:
+            self.z   = np.array(z, dtype=np.int32)
+        self.ndk     = np.zeros((len(doc_ptr) - 1, num_topics), dtype=np.int32)
+        np.add.at(self.ndk, (self.docs, self.z), 1)
+
+    def add_counts(self, nkw):
+        np.add.at(nkw, (self.words, self.z), 1)
+
+    def sweep(self, nkw, nk, alpha, beta, block_size):
+        # One pass over all tokens, updating Z, NDK, NKW and NK in place
+        num_topics = len(alpha)
+        vbeta      = nkw.shape[0] * beta
+        order      = self.rng.permutation(len(self.words))
+        for start in range(0, len(order), block_size):
+            idx   = order[start:start + block_size]
+            w     = self.words[idx]
+            d     = self.docs[idx]
+            z_old = self.z[idx]
+            rows  = np.arange(len(idx))
+
+            # Counts with each token's own assignment removed
+            dk    = self.ndk[d].astype(np.float64)
+            wk    = nkw[w].astype(np.float64)
+            dk[rows, z_old] -= 1
+            wk[rows, z_old] -= 1
+            denom = nk + vbeta
+            p     = (dk + alpha) * (wk + beta) / denom
+            p[rows, z_old] *= denom[z_old] / (denom[z_old] - 1)
+
+            cum   = np.cumsum(p, axis=1)
+            u     = self.rng.random(len(idx)) * cum[:, -1]
+            z_new = np.minimum((cum < u[:, None]).sum(axis=1), num_topics - 1).astype(np.int32)
+
+            changed = z_new != z_old
+            if not changed.any():
+                continue
+            w, d, z_old, z_new = w[changed], d[changed], z_old[changed], z_new[changed]
+            moves = np.concatenate([np.full(len(w), -1, dtype=np.int32), np.ones(len(w), dtype=np.int32)])
+            np.add.at(self.ndk, (np.concatenate([d, d]), np.concatenate([z_old, z_new])), moves)
+            np.add.at(nkw,      (np.concatenate([w, w]), np.concatenate([z_old, z_new])), moves)
+            nk -= np.bincount(z_old, minlength=num_topics)
+            nk += np.bincount(z_new, minlength=num_topics)
+            self.z[idx[changed]] = z_new
+
+    def histograms(self):
+        # (topic, count, number of docs) for nonzero doc-topic counts, and (doc length, number of docs)
+        num_topics  = self.ndk.shape[1]
+        d, k        = np.nonzero(self.ndk)
+        keys, ndocs = np.unique(self.ndk[d, k].astype(np.int64) * num_topics + k, return_counts=True)
+        lengths, lcounts = np.unique(np.diff(self.doc_ptr), return_counts=True)
+        return keys % num_topics, keys // num_topics, ndocs, lengths, lcounts
+
+    def doc_log_likelihood(self, alpha):
+        d, k = np.nonzero(self.ndk)
+        lengths = np.diff(self.doc_ptr)
+        return (gammaln(self.ndk[d, k] + alpha[k]).sum() - gammaln(alpha[k]).sum()
+                + len(lengths) * gammaln(alpha.sum()) - gammaln(lengths + alpha.sum()).sum())
+
+
+def optimize_alpha(alpha, topics, counts, ndocs, lengths, lcounts, iterations=5):
+    # Minka's fixed-point update for an asymmetric Dirichlet, from count histograms
+    for _ in range(iterations):
+        alpha_sum = alpha.sum()
+        denom = (lcounts * (digamma(lengths + alpha_sum) - digamma(alpha_sum))).sum()
+        numer = np.bincount(topics, weights=ndocs * (digamma(counts + alpha[topics]) - digamma(alpha[topics])),
+                            minlength=len(alpha))
+        alpha = np.maximum(alpha * numer / denom, 1e-10)
+    return alpha
+
+
+def optimize_beta(beta, nkw, nk, iterations=5):
+    # Minka's fixed-point update for a symmetric Dirichlet over words; only nonzero counts contribute
+    values, freq = np.unique(nkw[nkw > 0], return_counts=True)
+    num_types    = nkw.shape[0]
+    for _ in range(iterations):
+        numer = (freq * (digamma(values + beta) - digamma(beta))).sum()
+        denom = num_types * (digamma(nk + num_types * beta) - digamma(num_types * beta)).sum()
+        beta  = beta * numer / denom
+    return float(beta)
+
+
+def topic_log_likelihood(nkw, nk, beta):
+    num_types = nkw.shape[0]
+    nonzero   = nkw[nkw > 0]
+    return (gammaln(nonzero + beta).sum() - len(nonzero) * gammaln(beta)
+            + len(nk) * gammaln(num_types * beta) - gammaln(nk + num_types * beta).sum())
+
+
+def merge_histograms(parts):
+    # Histograms from several shards; repeated keys are fine, since every use sums over them
+    return tuple(np.concatenate(x) for x in zip(*parts))
+
+
+################################################################
+# Shards in worker processes (AD-LDA)
+################################################################
+
+def _worker(conn, shard, nkw_buf, delta_buf, shape):
+    nkw   = np.frombuffer(nkw_buf,   dtype=np.int32).reshape(shape)
+    delta = np.frombuffer(delta_buf, dtype=np.int32).reshape(shape)
+    while True:
+        msg = conn.recv()
+        if msg[0] == 'sweep':
+            _, alpha, beta, block_size = msg
+            local = nkw.copy()
+            shard.sweep(local, local.sum(axis=0), alpha, beta, block_size)
+            np.subtract(local, nkw, out=delta)
+            conn.send(None)
+        elif msg[0] == 'histograms':
+            conn.send(shard.histograms())
+        elif msg[0] == 'loglik':
+            conn.send(shard.doc_log_likelihood(msg[1]))
+        elif msg[0] == 'result':
+            conn.send((shard.z, shard.ndk))
+        else:
+            conn.close()
+            return
+
+
+class LocalShards:
+    # All shards sampled in this process, one after another
+    def __init__(self, shards, nkw):
+        self.shards = shards
+        self.nkw    = nkw
+        self.nk     = nkw.sum(axis=0)
+
+    def sweep(self, alpha, beta, block_size):
+        for shard in self.shards:
+            shard.sweep(self.nkw, self.nk, alpha, beta, block_size)
+
+    def histograms(self):
+        return merge_histograms([s.histograms() for s in self.shards])
+
+    def doc_log_likelihood(self, alpha):
+        return sum(s.doc_log_likelihood(alpha) for s in self.shards)
+
+    def result(self):
+        return (np.concatenate([s.z for s in self.shards]), np.concatenate([s.ndk for s in self.shards]))
+
+    def close(self):
+        pass
+
+
+class ProcessShards:
+    # One worker process per shard, sharing the word-topic counts through shared memory
+    def __init__(self, shards, nkw):
+        shape       = nkw.shape
+        self.nkw_buf = multiprocessing.RawArray('i', nkw.size)
+        self.nkw    = np.frombuffer(self.nkw_buf, dtype=np.int32).reshape(shape)
+        self.nkw[:] = nkw
+        self.deltas = []
+        self.conns  = []
+        self.procs  = []
+        for shard in shards:
+            delta_buf = multiprocessing.RawArray('i', nkw.size)
+            parent, child = multiprocessing.Pipe()
+            proc = multiprocessing.Process(target=_worker, args=(child, shard, self.nkw_buf, delta_buf, shape), daemon=True)
+            proc.start()
+            self.deltas.append(np.frombuffer(delta_buf, dtype=np.int32).reshape(shape))
+            self.conns.append(parent)
+            self.procs.append(proc)
+        self.nk = self.nkw.sum(axis=0)
+
+    def _ask(self, *msg):
+        for conn in self.conns:
+            conn.send(msg)
+        return [conn.recv() for conn in self.conns]
+
+    def sweep(self, alpha, beta, block_size):
+        self._ask('sweep', alpha, beta, block_size)
+        for delta in self.deltas:
+            self.nkw += delta
+        self.nk = self.nkw.sum(axis=0)
+
+    def histograms(self):
+        return merge_histograms(self._ask('histograms'))
+
+    def doc_log_likelihood(self, alpha):
+        return sum(self._ask('loglik', alpha))
+
+    def result(self):
+        parts = self._ask('result')
+        return (np.concatenate([z for z, _ in parts]), np.concatenate([ndk for _, ndk in parts]))
+
+    def close(self):
+        for conn in self.conns:
+            conn.send(('stop',))
+        for proc in self.procs:
+            proc.join()
+
+
+def make_shards(corpus, num_topics, num_shards, seed, z=None):
+    # Split documents into NUM_SHARDS contiguous ranges with about the same number of tokens
+    cuts  = np.searchsorted(corpus.doc_ptr, np.linspace(0, corpus.num_tokens, num_shards + 1)[1:-1])
+    cuts  = np.unique(np.concatenate([[0], cuts, [corpus.num_docs]]))
+    return [Shard(corpus.words[corpus.doc_ptr[a]:corpus.doc_ptr[b]], corpus.doc_ptr[a:b + 1], num_topics, [seed, i],
+                  None if z is None else z[corpus.doc_ptr[a]:corpus.doc_ptr[b]])
+            for i, (a, b) in enumerate(zip(cuts[:-1], cuts[1:]))]
+
+
+def initial_state(corpus, path):
+    '''
+    Topic assignments and hyperparameters from a state file for CORPUS (e.g. a previous
+    run's --output-state), as for MALLET's --input-state. Returns (z, alpha, beta).
+    '''
+    state = topic_model_io.read_state(path)
+    index = {w: i for i, w in enumerate(corpus.vocab)}
+    words = np.array([index.get(w, -1) for w in state['vocab']], dtype=np.int64)[state['word']]
+    if len(words) != corpus.num_tokens or not np.array_equal(words, corpus.words):
+        sys.stderr.write("Error: state file {} does not match the tokens of the input\n".format(path))
+        sys.exit(1)
+    return state['topic'], state['alpha'], state['beta']
+
+
+def train(corpus, num_topics, num_iterations, alpha_sum=default_alpha_sum, beta=default_beta,
+          optimize_interval=0, optimize_burnin=default_burnin, num_workers=1, block_size=default_block_size, seed=0,
+          convergence_tolerance=0, convergence_interval=default_convergence_interval, z=None):
+    '''
+    Trains LDA on CORPUS (a topic_model_io.Corpus). Returns (nkw, ndk, z, alpha, beta)
+    with NKW the V x K word-topic counts and NDK the D x K doc-topic counts.
+    Sampling starts from the topic assignments Z, if given (ALPHA_SUM may then
+    be an array, the per-topic alpha it was left with).
+    With CONVERGENCE_TOLERANCE, stops once LL/token changes by less than that
+    fraction between checks CONVERGENCE_INTERVAL iterations apart.
+    '''
+    alpha  = np.full(num_topics, alpha_sum / num_topics) if np.isscalar(alpha_sum) else np.array(alpha_sum)
+    shards = make_shards(corpus, num_topics, max(1, num_workers), seed, z)
+    nkw    = np.zeros((len(corpus.vocab), num_topics), dtype=np.int32)
+    for shard in shards:
+        shard.add_counts(nkw)
+    sampler = ProcessShards(shards, nkw) if len(shards) > 1 else LocalShards(shards, nkw)
+
+    sys.stderr.write("LDA (NumPy Gibbs): {} topics, {} shard(s)\n".format(num_topics, len(shards)))
+    sys.stderr.write("total tokens: {}\n".format(corpus.num_tokens))
+    started = time.time()
+    checked = None
+    try:
+        for iteration in range(1, num_iterations + 1):
+            sampler.sweep(alpha, beta, block_size)
+            if optimize_interval and iteration > optimize_burnin and iteration % optimize_interval == 0:
+                alpha = optimize_alpha(alpha, *sampler.histograms())
+                beta  = optimize_beta(beta, sampler.nkw, sampler.nk)
+                sys.stderr.write("[beta: {:.5f}] \n".format(beta))
+            check = convergence_tolerance and iteration % convergence_interval == 0
+            if iteration % ll_interval == 0 or check:
+                ll = sampler.doc_log_likelihood(alpha) + topic_log_likelihood(sampler.nkw, sampler.nk, beta)
+                ll = ll / max(1, corpus.num_tokens)
+                sys.stderr.write("<{}> LL/token: {:.5f}\n".format(iteration, ll))
+            if check:
+                if checked is not None and abs(ll - checked) <= convergence_tolerance * abs(checked):
+                    sys.stderr.write("Converged after {} iterations\n".format(iteration))
+                    break
+                checked = ll
+        z, ndk = sampler.result()
+        nkw    = np.array(sampler.nkw)
+    finally:
+        sampler.close()
+    sys.stderr.write("\nTotal time: {:.0f} seconds\n".format(time.time() - started))
+    return nkw, ndk, z, alpha, beta
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='LDA by collapsed Gibbs sampling; accepts the mallet train-topics options TOPCAT uses')
+    parser.add_argument('--input',             required=True, help='docID<tab>label<tab>text file')
+    parser.add_argument('--num-topics',        type=int,   default=10)
+    parser.add_argument('--num-iterations',    type=int,   default=1000)
+    parser.add_argument('--alpha',             type=float, default=default_alpha_sum, help='Sum of the Dirichlet prior over topics')
+    parser.add_argument('--beta',              type=float, default=default_beta)
+    parser.add_argument('--optimize-interval', type=int,   default=0)
+    parser.add_argument('--optimize-burn-in',  type=int,   default=default_burnin)
+    parser.add_argument('--random-seed',       type=int,   default=0)
+    parser.add_argument('--num-threads',       type=int,   default=1, help='Worker processes (document shards)')
+    parser.add_argument('--block-size',        type=int,   default=default_block_size, help='Tokens resampled together')
+    parser.add_argument('--convergence-tolerance', type=float, default=0,
+                        help='Stop once LL/token changes by less than this fraction between checks (0: never)')
+    parser.add_argument('--convergence-interval',  type=int,   default=default_convergence_interval,
+                        help='Iterations between convergence checks')
+    parser.add_argument('--input-state',       help='Start from the topic assignments and hyperparameters in this state file')
+    parser.add_argument('--output-model')
+    parser.add_argument('--output-doc-topics')
+    parser.add_argument('--output-topic-keys')
+    parser.add_argument('--output-state')
+    parser.add_argument('--word-topic-counts-file')
+    parser.add_argument('--topic-word-weights-file')
+    parser.add_argument('--inferencer-filename', help='Ignored: fold-in inference uses --output-model')
+    args = parser.parse_args()
+
+    corpus = topic_model_io.read_corpus(args.input)
+    sys.stderr.write("Read {} documents, {} word types from {}\n".format(corpus.num_docs, len(corpus.vocab), args.input))
+    z, alpha, beta = None, args.alpha, args.beta
+    if args.input_state:
+        z, alpha, beta = initial_state(corpus, args.input_state)
+        if len(alpha) != args.num_topics:
+            sys.stderr.write("Error: state file {} has {} topics, not {}\n".format(args.input_state, len(alpha), args.num_topics))
+            sys.exit(1)
+    nkw, ndk, z, alpha, beta = train(corpus, args.num_topics, args.num_iterations, alpha, beta,
+                                     args.optimize_interval, args.optimize_burn_in, args.num_threads,
+                                     args.block_size, args.random_seed,
+                                     args.convergence_tolerance, args.convergence_interval, z)
+    outputs = {'output-model':            args.output_model,
+               'output-doc-topics':       args.output_doc_topics,
+               'output-topic-keys':       args.output_topic_keys,
+               'output-state':            args.output_state,
+               'word-topic-counts-file':  args.word_topic_counts_file,
+               'topic-word-weights-file': args.topic_word_weights_file}
+    topic_model_io.write_mallet_outputs(outputs, corpus.vocab, nkw, alpha, beta,
+                                        names=corpus.names, ndk=ndk, corpus=corpus, z=z)
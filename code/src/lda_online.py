@@ -0,0 +1,226 @@
+################################################################
+#
+#  Online (minibatch) variational Bayes for LDA (Hoffman, Blei & Bach 2010)
+#
+#  For corpora too large for MALLET's in-memory instance list. Documents
+#  are streamed from the docID<tab>label<tab>text file in minibatches, so
+#  memory is bounded by the vocabulary times the number of topics (the
+#  topic-word parameters, lambda) plus one minibatch, not by corpus size.
+#
+#  Takes the same options as `mallet train-topics` that TOPCAT uses, and
+#  writes the same output files (see topic_model_io.py), so it can be used
+#  as run_mallet.py --package online. Differences from MALLET:
+#
+#    --input           the docID<tab>label<tab>text file itself (no import step)
+#    --passes          passes over the corpus; --num-iterations is ignored
+#    --batch-size      documents per minibatch
+#    --checkpoint F    save lambda to F (.npz) every --checkpoint-interval
+#                      minibatches and at the end of each pass; if F exists
+#                      when training starts with the same corpus and settings,
+#                      resume from it; it is removed once the outputs are written
+#    --output-state    not written: there are no per-token topic assignments
+#
+#  word-topic-counts are the expected counts (lambda - beta), rounded, and
+#  topic-word-weights are lambda, the analogue of MALLET's beta + count.
+#  doc-topics are the normalized variational parameters (gamma) from a
+#  final streaming pass. The LL/token logged after each pass is the
+#  average per-token log likelihood term of the variational bound.
+#
+#  Example:
+#    python lda_online.py --input corpus.txt --num-topics 50 --passes 2
+#        --batch-size 2048 --checkpoint work/m.k50.online-checkpoint.npz
+#        --output-doc-topics model/m.doc-topics --word-topic-counts-file model/m.word-topic-counts
+#        --topic-word-weights-file model/m.topic-word-weights --output-topic-keys model/m.topic-keys
+#
+################################################################
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import scipy.sparse as sp
+from scipy.special import psi
+
+import topic_model_io
+
+default_alpha_sum  = 5.0
+default_beta       = 0.01
+default_batch_size = 1024
+default_tau0       = 1.0
+default_kappa      = 0.7
+estep_iterations   = 100
+estep_tolerance    = 1e-3
+
+
+def dirichlet_expectation(x):
+    # E[log p] under Dirichlet(x), for each row
+    return psi(x) - psi(x.sum(axis=-1, keepdims=True))
+
+
+def scan_vocabulary(path):
+    # First streaming pass: vocabulary in first-occurrence order (as in a MALLET alphabet), document and token counts
+    index      = {}
+    num_docs   = 0
+    num_tokens = 0
+    for _, tokens in topic_model_io.iter_documents(path):
+        for t in tokens:
+            if t not in index:
+                index[t] = len(index)
+        num_docs   += 1
+        num_tokens += len(tokens)
+    return index, num_docs, num_tokens
+
+
+def e_step(X, exp_elog_beta, alpha, rng):
+    '''
+    Fits variational parameters gamma for the documents in X, all documents at once.
+    Returns gamma, the sufficient statistics for the words in X (K x V, nonzero only
+    in X's columns), and the summed log likelihood term sum c_dw log phinorm_dw.
+    '''
+    num_docs   = X.shape[0]
+    num_topics = exp_elog_beta.shape[0]
+    cols       = np.unique(X.indices)
+    Xb         = X[:, cols]
+    Eb         = exp_elog_beta[:, cols]
+    doc_of_nnz = np.repeat(np.arange(num_docs), np.diff(Xb.indptr))
+
+    gamma      = rng.gamma(100., 1. / 100., (num_docs, num_topics))
+    exp_elog_t = np.exp(dirichlet_expectation(gamma))
+    for _ in range(estep_iterations):
+        last      = gamma
+        phinorm   = np.einsum('nk,kn->n', exp_elog_t[doc_of_nnz], Eb[:, Xb.indices]) + 1e-100
+        S         = sp.csr_matrix((Xb.data / phinorm, Xb.indices, Xb.indptr), shape=Xb.shape)
+        gamma     = alpha + exp_elog_t * (S @ Eb.T)
+        exp_elog_t = np.exp(dirichlet_expectation(gamma))
+        if np.mean(np.abs(gamma - last)) < estep_tolerance:
+            break
+
+    phinorm = np.einsum('nk,kn->n', exp_elog_t[doc_of_nnz], Eb[:, Xb.indices]) + 1e-100
+    S       = sp.csr_matrix((Xb.data / phinorm, Xb.indices, Xb.indptr), shape=Xb.shape)
+    sstats  = np.zeros_like(exp_elog_beta)
+    sstats[:, cols] = (S.T @ exp_elog_t).T * Eb
+    return gamma, sstats, float((Xb.data * np.log(phinorm)).sum())
+
+
+def save_checkpoint(path, lam, updates, position, fingerprint):
+    # Written to a temporary file and renamed, so a crash mid-write never leaves a broken checkpoint
+    tmpname = path + '.tmp'
+    with open(tmpname, 'wb') as f:
+        np.savez(f, lam=lam, updates=updates, position=position, fingerprint=fingerprint)
+    os.replace(tmpname, path)
+
+
+def training_fingerprint(path, num_topics, passes, batch_size, alpha_sum, beta, tau0, kappa, seed):
+    # Everything lambda depends on: every setting, and the corpus by size and modification time
+    stat = os.stat(path)
+    return np.array([repr(x) for x in (stat.st_size, stat.st_mtime_ns, num_topics, passes, batch_size,
+                                       alpha_sum, beta, tau0, kappa, seed)])
+
+
+def load_checkpoint(path, fingerprint):
+    if not path or not os.path.exists(path):
+        return None
+    with np.load(path) as npz:
+        if not np.array_equal(npz['fingerprint'], fingerprint):
+            sys.stderr.write("Ignoring checkpoint {}: it is for a different corpus or settings\n".format(path))
+            return None
+        sys.stderr.write("Resuming from checkpoint {}\n".format(path))
+        return npz['lam'], int(npz['updates']), int(npz['position'])
+
+
+def train(path, num_topics, passes=1, batch_size=default_batch_size, alpha_sum=default_alpha_sum, beta=default_beta,
+          tau0=default_tau0, kappa=default_kappa, seed=0, checkpoint=None, checkpoint_interval=100):
+    '''
+    Online VB over the documents in PATH. Returns (vocab, lam, alpha, index) with
+    LAM the K x V variational topic-word parameters and INDEX mapping words to columns.
+    '''
+    index, num_docs, num_tokens = scan_vocabulary(path)
+    num_types       = len(index)
+    alpha           = np.full(num_topics, alpha_sum / num_topics)
+    rng             = np.random.default_rng(seed)
+    fingerprint     = training_fingerprint(path, num_topics, passes, batch_size, alpha_sum, beta, tau0, kappa, seed)
+    sys.stderr.write("LDA (online VB): {} topics, {} documents, {} word types, batches of {}\n".format(
+        num_topics, num_docs, num_types, batch_size))
+    sys.stderr.write("total tokens: {}\n".format(num_tokens))
+
+    resumed = load_checkpoint(checkpoint, fingerprint)
+    if resumed is None:
+        lam, updates, position = rng.gamma(100., 1. / 100., (num_topics, num_types)), 0, 0
+    else:
+        lam, updates, position = resumed
+    batches_per_pass = -(-num_docs // batch_size)
+
+    started = time.time()
+    while position < passes * num_docs:
+        pass_num, skip = divmod(position, num_docs)
+        loglik, tokens = 0.0, 0
+        for names, X in topic_model_io.iter_batches(path, index, batch_size, skip):
+            exp_elog_beta = np.exp(dirichlet_expectation(lam))
+            _, sstats, ll = e_step(X, exp_elog_beta, alpha, rng)
+            rho  = (tau0 + updates) ** -kappa
+            lam  = (1 - rho) * lam + rho * (beta + num_docs * sstats / X.shape[0])
+            updates  += 1
+            position += X.shape[0]
+            loglik   += ll
+            tokens   += X.sum()
+            if checkpoint and updates % checkpoint_interval == 0:
+                save_checkpoint(checkpoint, lam, updates, position, fingerprint)
+        sys.stderr.write("<{}> LL/token: {:.5f}\n".format(pass_num + 1, loglik / max(1, tokens)))
+        if checkpoint:
+            save_checkpoint(checkpoint, lam, updates, position, fingerprint)
+    sys.stderr.write("{} minibatch updates ({} per pass)\n".format(updates, batches_per_pass))
+    sys.stderr.write("\nTotal time: {:.0f} seconds\n".format(time.time() - started))
+    return list(index), lam, alpha, index
+
+
+def write_doc_topics(path, corpus_path, index, lam, alpha, batch_size, seed):
+    # Final streaming pass: fit gamma for every document under the trained topics
+    rng           = np.random.default_rng(seed)
+    exp_elog_beta = np.exp(dirichlet_expectation(lam))
+    start         = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        for names, X in topic_model_io.iter_batches(corpus_path, index, batch_size):
+            gamma, _, _ = e_step(X, exp_elog_beta, alpha, rng)
+            topic_model_io.append_doc_topics(f, start, names, gamma / gamma.sum(axis=1, keepdims=True))
+            start += len(names)
+    sys.stderr.write("Wrote {}\n".format(path))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='LDA by online variational Bayes; accepts the mallet train-topics options TOPCAT uses')
+    parser.add_argument('--input',               required=True, help='docID<tab>label<tab>text file')
+    parser.add_argument('--num-topics',          type=int,   default=10)
+    parser.add_argument('--num-iterations',      type=int,   default=None, help='Ignored; see --passes')
+    parser.add_argument('--passes',              type=int,   default=1, help='Passes over the corpus')
+    parser.add_argument('--batch-size',          type=int,   default=default_batch_size, help='Documents per minibatch')
+    parser.add_argument('--tau0',                type=float, default=default_tau0, help='Learning rate delay')
+    parser.add_argument('--kappa',               type=float, default=default_kappa, help='Learning rate decay, in (0.5, 1]')
+    parser.add_argument('--alpha',               type=float, default=default_alpha_sum, help='Sum of the Dirichlet prior over topics')
+    parser.add_argument('--beta',                type=float, default=default_beta)
+    parser.add_argument('--random-seed',         type=int,   default=0)
+    parser.add_argument('--checkpoint',          default=None, help='Checkpoint file for lambda; resumed from if it exists')
+    parser.add_argument('--checkpoint-interval', type=int,   default=100, help='Minibatches between checkpoints')
+    parser.add_argument('--optimize-interval',   type=int,   default=0, help='Ignored: hyperparameters stay fixed')
+    parser.add_argument('--num-threads',         type=int,   default=1, help='Ignored')
+    parser.add_argument('--output-model')
+    parser.add_argument('--output-doc-topics')
+    parser.add_argument('--output-topic-keys')
+    parser.add_argument('--output-state',        help='Ignored: online VB has no per-token topic assignments')
+    parser.add_argument('--word-topic-counts-file')
+    parser.add_argument('--topic-word-weights-file')
+    parser.add_argument('--inferencer-filename', help='Ignored: fold-in inference uses --output-model')
+    args = parser.parse_args()
+
+    vocab, lam, alpha, index = train(args.input, args.num_topics, args.passes, args.batch_size, args.alpha, args.beta,
+                                     args.tau0, args.kappa, args.random_seed, args.checkpoint, args.checkpoint_interval)
+    outputs = {'output-model':            args.output_model,
+               'output-topic-keys':       args.output_topic_keys,
+               'word-topic-counts-file':  args.word_topic_counts_file,
+               'topic-word-weights-file': args.topic_word_weights_file}
+    topic_model_io.write_mallet_outputs(outputs, vocab, np.maximum(lam - args.beta, 0).T, alpha, args.beta, weights=lam.T)
+    if args.output_doc_topics:
+        write_doc_topics(args.output_doc_topics, args.input, index, lam, alpha, args.batch_size, args.random_seed)
+    # Only needed to resume an interrupted run
+    if args.checkpoint and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
@@ -0,0 +1,319 @@
+################################################################
+#
+#  Helpers for running MALLET: sizing threads and JVM heap to the
+#  machine and corpus, and running MALLET commands with retry when
+#  the JVM runs out of memory.
+#
+#  MALLET's bin/mallet script reads the heap size from the
+#  MALLET_MEMORY environment variable (default 1g), so the heap is
+#  set per command through the environment. A scheduler running several
+#  JVMs (batch.py) sets MALLET_MAX_MEMORY to the heap it reserved for
+#  each, and neither auto-sizing nor out-of-memory retries go beyond it.
+#
+#  Example (from run_mallet.py):
+#    threads = auto_threads(corpus_bytes)
+#    memory  = auto_memory(corpus_bytes, numtopics)
+#    run_mallet_command(cmd, memory)
+#
+#  run_mallet_with_input feeds a command's standard input from a
+#  generator, for `mallet import-file --input -` reading documents as
+#  preprocessing produces them.
+#
+#  TrainingMonitor follows train-topics output (MALLET's, or the NumPy
+#  backends', which log the same way) through run_mallet_command's
+#  on_line hook: it prints a progress line with throughput and ETA at
+#  each LL/token report and keeps the time series in a metrics file.
+#  has_converged is the early-stopping test for training in segments.
+#
+################################################################
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+# Rough sizing constants for MALLET's in-memory InstanceList and Gibbs sampler state
+bytes_per_token_on_disk = 6      # average preprocessed token plus separator
+jvm_bytes_per_token     = 48     # feature sequence, topic assignment and object overhead
+jvm_base_bytes          = 512 * 1024 * 1024
+tokens_per_thread       = 200000 # below this per thread, extra threads cost more than they save
+max_auto_threads        = 16     # MALLET's parallel sampler stops scaling well around here
+max_ram_fraction        = 0.75   # never size the heap beyond this share of physical memory
+
+OOM_PATTERN = re.compile(r'OutOfMemoryError|GC overhead limit exceeded|Java heap space')
+
+# train-topics log lines: 'total tokens: 123456' once the data is loaded,
+# '<120> LL/token: -8.51234' every few iterations, '[beta: 0.01234]' after hyperparameter optimization
+TOKENS_PATTERN = re.compile(r'total tokens: (\d+)')
+LL_PATTERN     = re.compile(r'<(\d+)> LL/token: (-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)')
+BETA_PATTERN   = re.compile(r'\[beta: (\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)\]')
+# Logged by the NumPy Gibbs backend when it stops early
+CONVERGED_PATTERN = re.compile(r'Converged after (\d+) iterations')
+
+
+def available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def physical_memory_bytes():
+    # Total and available RAM in bytes, from /proc/meminfo where there is one
+    try:
+        info = {}
+        with open('/proc/meminfo') as f:
+            for line in f:
+                key, value = line.split(':', 1)
+                info[key] = int(value.split()[0]) * 1024
+        return info['MemTotal'], info.get('MemAvailable', info['MemTotal'])
+    except (OSError, KeyError, ValueError):
+        total = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        return total, total
+
+
+def parse_memory(spec):
+    # '4g', '512m', '2G' -> bytes
+    m = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([kKmMgG]?)\s*', str(spec))
+    if m is None:
+        raise ValueError("Can't parse memory size '{}' (expected e.g. 512m or 4g)".format(spec))
+    scale = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}[m.group(2).lower()]
+    return int(float(m.group(1)) * scale)
+
+
+def format_memory(nbytes):
+    # Bytes -> MALLET_MEMORY string, rounded up to whole megabytes or gigabytes
+    mb = -(-nbytes // 1024 ** 2)
+    return "{}g".format(mb // 1024) if mb % 1024 == 0 else "{}m".format(mb)
+
+
+def max_memory():
+    # The largest heap to give one JVM: a share of RAM, or less if a scheduler set MALLET_MAX_MEMORY
+    total, _ = physical_memory_bytes()
+    cap      = int(total * max_ram_fraction)
+    if os.environ.get('MALLET_MAX_MEMORY'):
+        cap = min(cap, parse_memory(os.environ['MALLET_MAX_MEMORY']))
+    return cap
+
+
+def auto_threads(corpus_bytes):
+    '''Threads for train-topics: one per core, but no more than the corpus size can keep busy.'''
+    tokens = corpus_bytes // bytes_per_token_on_disk
+    return max(1, min(available_cores(), max_auto_threads, tokens // tokens_per_thread))
+
+
+def auto_memory(corpus_bytes, numtopics=0):
+    '''JVM heap for a corpus of CORPUS_BYTES (preprocessed), capped by available RAM.'''
+    tokens = corpus_bytes // bytes_per_token_on_disk
+    # Sampler keeps per-document topic counts, which grow with K for long documents
+    wanted = jvm_base_bytes + tokens * (jvm_bytes_per_token + 2 * int(numtopics) // 10)
+    _, available = physical_memory_bytes()
+    cap = min(max_memory(), max(available, 1024 ** 3))
+    return format_memory(max(1024 ** 3, min(wanted, cap)))
+
+
+def run_mallet_command(cmd, memory, max_retries=3, on_line=None):
+    '''
+    Runs the MALLET shell command CMD with MALLET_MEMORY set to MEMORY, echoing its
+    output to stderr (and passing each line to ON_LINE, if given). If the JVM runs
+    out of memory the heap is doubled, up to max_memory(), and the command rerun;
+    if it still fails, exits with an explanation. Returns the exit status.
+    With MEMORY None (a backend that isn't MALLET) the command is just run once.
+    '''
+    cap = max_memory()
+    for attempt in range(max_retries + 1):
+        if memory is None:
+            env = None
+            sys.stderr.write("Running: {}\n".format(cmd))
+        else:
+            env = dict(os.environ, MALLET_MEMORY=memory)
+            sys.stderr.write("Running (MALLET_MEMORY={}): {}\n".format(memory, cmd))
+        proc = subprocess.Popen(cmd, shell=True, env=env,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                text=True, bufsize=1, errors='replace')
+        out_of_memory = False
+        for line in proc.stdout:
+            sys.stderr.write(line)
+            if OOM_PATTERN.search(line):
+                out_of_memory = True
+            if on_line is not None:
+                on_line(line)
+        returncode = proc.wait()
+        if not out_of_memory or memory is None:
+            return returncode
+
+        current = parse_memory(memory)
+        if current >= cap or attempt == max_retries:
+            if os.environ.get('MALLET_MAX_MEMORY'):
+                limit = "MALLET_MAX_MEMORY={}, the heap reserved for each run, is".format(os.environ['MALLET_MAX_MEMORY'])
+            else:
+                limit = "{:.0f}% of this machine's RAM is".format(100 * max_ram_fraction)
+            sys.exit("Error: MALLET ran out of memory with MALLET_MEMORY={} ({} the limit for retries).\n"
+                     "Try a machine with more memory, fewer documents, or a smaller vocabulary, or set "
+                     "malletmemory (or batch.py's --mallet_heap_gb) explicitly.".format(memory, limit))
+        memory = format_memory(min(2 * current, cap))
+        sys.stderr.write("MALLET ran out of memory; retrying with MALLET_MEMORY={}\n".format(memory))
+    return returncode
+
+
+def run_mallet_with_input(cmd, memory, lines):
+    '''
+    Runs the MALLET shell command CMD with MALLET_MEMORY set to MEMORY, writing each
+    string from the iterable LINES to its standard input. Its output goes straight to
+    stderr. There is no retry, since LINES can only be consumed once: if the command
+    fails, LINES is still consumed to the end and the exit status returned, so the
+    caller can rerun it from a file with run_mallet_command.
+    '''
+    env = None if memory is None else dict(os.environ, MALLET_MEMORY=memory)
+    sys.stderr.write("Running (MALLET_MEMORY={}): {}\n".format(memory or 'default', cmd))
+    proc = subprocess.Popen(cmd, shell=True, env=env, stdin=subprocess.PIPE, stdout=sys.stderr,
+                            text=True, encoding='utf-8')
+    stdin = proc.stdin
+    for line in lines:
+        if stdin is None:
+            continue
+        try:
+            stdin.write(line)
+        except BrokenPipeError:
+            # The command exited early; keep draining LINES for the caller
+            stdin = None
+    try:
+        proc.stdin.close()
+    except BrokenPipeError:
+        pass
+    return proc.wait()
+
+
+def has_converged(previous_ll, current_ll, tolerance):
+    '''True if LL/token changed by less than TOLERANCE, relative to its size, between two checks.'''
+    if previous_ll is None or current_ll is None:
+        return False
+    return abs(current_ll - previous_ll) <= tolerance * abs(previous_ll)
+
+
+def format_duration(seconds):
+    # 3725 -> '1h02m', 192 -> '3m12s', 45 -> '45s'
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return "{}h{:02d}m".format(seconds // 3600, seconds % 3600 // 60)
+    if seconds >= 60:
+        return "{}m{:02d}s".format(seconds // 60, seconds % 60)
+    return "{}s".format(seconds)
+
+
+class TrainingMonitor:
+    '''
+    Callable for run_mallet_command's ON_LINE. Parses train-topics output for the
+    token count, LL/token reports and beta updates; at each LL/token report prints
+    a progress line headed LABEL (iteration, tokens/sec, ETA out of TOTAL_ITERATIONS
+    if known) and rewrites the JSON file METRICS_PATH, if given, with the series so
+    far. Call finish() with the exit status when the command is done.
+
+    Training run in segments (several commands, each continuing from the last
+    one's state) is followed by calling start_segment() before each command, so
+    that iteration numbers continue from where the previous segment stopped.
+
+    BETA, the beta training starts from, is recorded alongside the updates, since
+    train-topics only reports beta when it optimizes it.
+    '''
+    def __init__(self, label, total_iterations=None, metrics_path=None, beta=None):
+        self.label            = label
+        self.total_iterations = total_iterations
+        self.metrics_path     = metrics_path
+        self.beta             = beta
+        self.started          = time.time()
+        self.sampling_started = self.started
+        self.offset           = 0
+        self.total_tokens     = None
+        self.iteration        = 0
+        self.series           = []
+        self.hyperparameters  = []
+        self.converged        = None
+        self.exit_status      = None
+
+    def start_segment(self, offset):
+        # The next command's iteration 1 is iteration OFFSET + 1 overall
+        self.offset           = offset
+        self.iteration        = offset
+        self.sampling_started = time.time()
+
+    def restart_segment(self):
+        # A new attempt at the current segment (e.g. after an out-of-memory retry) replaces the last one's reports
+        self.series           = [p for p in self.series if p['iteration'] <= self.offset]
+        self.hyperparameters  = [p for p in self.hyperparameters if p['iteration'] <= self.offset]
+        self.start_segment(self.offset)
+
+    def last_ll_per_token(self):
+        return self.series[-1]['ll_per_token'] if self.series else None
+
+    def __call__(self, line):
+        m = TOKENS_PATTERN.search(line)
+        if m:
+            self.restart_segment()
+            self.total_tokens = int(m.group(1))
+        m = CONVERGED_PATTERN.search(line)
+        if m:
+            self.converged = True
+            self.iteration = self.offset + int(m.group(1))
+        m = BETA_PATTERN.search(line)
+        if m:
+            self.hyperparameters.append({'iteration': self.iteration, 'elapsed_seconds': round(self.elapsed(), 3),
+                                         'beta': float(m.group(1))})
+        m = LL_PATTERN.search(line)
+        if m:
+            self.record(int(m.group(1)), float(m.group(2)))
+
+    def elapsed(self):
+        return time.time() - self.sampling_started
+
+    def record(self, segment_iteration, ll_per_token):
+        iteration      = self.offset + segment_iteration
+        self.iteration = iteration
+        elapsed        = self.elapsed()
+        rate           = None
+        if self.total_tokens and segment_iteration > 0 and elapsed > 0:
+            rate = round(self.total_tokens * segment_iteration / elapsed)
+        point = {'iteration': iteration, 'elapsed_seconds': round(elapsed, 3), 'll_per_token': ll_per_token,
+                 'tokens_per_second': rate}
+        self.series.append(point)
+        sys.stderr.write(self.progress_line(point) + "\n")
+        self.save()
+
+    def progress_line(self, point):
+        iteration = point['iteration']
+        if self.total_iterations:
+            parts = ["iteration {}/{} ({:.0f}%)".format(iteration, self.total_iterations, 100.0 * iteration / self.total_iterations)]
+        else:
+            parts = ["iteration {}".format(iteration)]
+        parts.append("LL/token {:.4f}".format(point['ll_per_token']))
+        if point['tokens_per_second']:
+            parts.append("{:,} tokens/sec".format(point['tokens_per_second']))
+        if self.total_iterations and self.offset < iteration <= self.total_iterations:
+            remaining = point['elapsed_seconds'] / (iteration - self.offset) * (self.total_iterations - iteration)
+            parts.append("ETA {}".format(format_duration(remaining)))
+        return "[{}] {}".format(self.label, ', '.join(parts))
+
+    def finish(self, exit_status):
+        self.exit_status = exit_status
+        self.save()
+
+    def metrics(self):
+        return {'label':            self.label,
+                'total_iterations': self.total_iterations,
+                'iterations':       self.iteration,
+                'converged':        self.converged,
+                'total_tokens':     self.total_tokens,
+                'elapsed_seconds':  round(time.time() - self.started, 3),
+                'exit_status':      self.exit_status,
+                'series':           self.series,
+                'beta':             self.beta,
+                'hyperparameters':  self.hyperparameters}
+
+    def save(self):
+        if not self.metrics_path:
+            return
+        tmpname = self.metrics_path + '.tmp'
+        with open(tmpname, 'w') as f:
+            json.dump(self.metrics(), f, indent=2)
+        os.replace(tmpname, self.metrics_path)
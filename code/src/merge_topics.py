@@ -0,0 +1,220 @@
+################################################################
+#
+#  Coarser granularities by merging the topics of the finest model
+#
+#  Modeling K = 10, 20 and 30 costs three full trainings. Instead, this
+#  takes the curation CSVs of one fine model and derives coarser ones
+#  from it by agglomerative merging:
+#
+#    - every topic starts as its own cluster, weighted by its total
+#      document-topic mass
+#    - the two clusters whose word distributions are closest in
+#      Jensen-Shannon distance are merged; the merged word distribution
+#      is the mass-weighted mixture of the two, and only the new
+#      cluster's distances need computing before the next merge
+#    - at each requested --numtopics, the clusters become a coarse
+#      model: word_topics.csv has the mixed word distributions, and
+#      document_topics.csv (and document_topics_all.csv, for inferred
+#      documents, if there is one) sums each document's proportions
+#      over the fine topics in a cluster
+#
+#  The output files have the same layout as run_mallet.py's, so the
+#  usual curation steps run on them unchanged. The merge tree (which fine
+#  topics make up each coarse one, and at what distance each merge
+#  happened) is written to --output_json and --output_txt.
+#
+#  Example:
+#    python merge_topics.py
+#      --input_dir    /path/to/modeling/model_k30/curation
+#      --numtopics    10 20
+#      --output_dirs  /path/to/modeling/model_k10/curation /path/to/modeling/model_k20/curation
+#      --output_json  /path/to/modeling/model_k30/merge_tree.json
+#      --output_txt   /path/to/out/topic_merge_tree.txt
+#
+################################################################
+import argparse
+import csv
+import json
+import os
+import sys
+
+import numpy as np
+
+from topic_ensemble import read_word_topics
+
+num_top_words = 10
+doc_topic_files = ['document_topics.csv', 'document_topics_all.csv']
+
+
+def topic_columns(header):
+    return [i for i, name in enumerate(header) if name.startswith('Topic ')]
+
+
+def topic_mass(path):
+    # Total proportion of each topic over the documents in a document_topics.csv
+    with open(path, newline='', encoding='utf-8') as f:
+        reader  = csv.reader(f)
+        columns = topic_columns(next(reader))
+        mass    = np.zeros(len(columns))
+        for row in reader:
+            mass += np.array([float(row[i]) for i in columns])
+    return mass
+
+
+def entropy(P):
+    # Entropy in bits of each column of P
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return -np.where(P > 0, P * np.log2(P), 0).sum(axis=0)
+
+
+def js_distances(p, Q, h_p, h_Q):
+    # Jensen-Shannon distance between distribution P and each column of Q, given their entropies
+    M  = (p[:, None] + Q) / 2
+    js = entropy(M) - (h_p + h_Q) / 2
+    return np.sqrt(np.maximum(js, 0))
+
+
+def merge_tree(topic_word, mass, targets):
+    '''
+    Agglomerative merging of the columns of TOPIC_WORD (V x K) down to min(TARGETS) clusters.
+    Returns the merges, in the order made, and for each target number of topics its clusters
+    (lists of 0-based fine topics), ordered by their smallest fine topic.
+    '''
+    K        = topic_word.shape[1]
+    dists    = topic_word / np.maximum(topic_word.sum(axis=0), 1e-300)
+    weights  = np.maximum(mass.astype(float), 1e-12)
+    h        = entropy(dists)
+    members  = {k: [k] for k in range(K)}     # node id -> fine topics; nodes K, K+1, ... are merges
+    slot     = list(range(K))                 # node id in each column of DISTS
+    distance = np.full((K, K), np.inf)
+    for k in range(K):
+        distance[k, k + 1:] = js_distances(dists[:, k], dists[:, k + 1:], h[k], h[k + 1:])
+    distance = np.minimum(distance, distance.T)
+
+    merges   = []
+    clusters = {}
+    active   = np.ones(K, dtype=bool)
+    for n in range(K, min(targets) - 1, -1):
+        if n in targets:
+            clusters[n] = sorted((sorted(members[slot[j]]) for j in np.flatnonzero(active)), key=lambda c: c[0])
+        if n == min(targets):
+            break
+        a, b = np.unravel_index(np.argmin(distance), distance.shape)
+        a, b = min(a, b), max(a, b)
+        node = K + len(merges)
+        merges.append({'node':      node + 1,
+                       'children':  [slot[a] + 1, slot[b] + 1],
+                       'distance':  round(float(distance[a, b]), 6),
+                       'topics':    [t + 1 for t in sorted(members[slot[a]] + members[slot[b]])]})
+        # The merged cluster takes column A; column B drops out
+        members[node] = members[slot[a]] + members[slot[b]]
+        dists[:, a]   = (weights[a] * dists[:, a] + weights[b] * dists[:, b]) / (weights[a] + weights[b])
+        weights[a]   += weights[b]
+        h[a]          = entropy(dists[:, [a]])[0]
+        slot[a]       = node
+        active[b]     = False
+        distance[b, :] = distance[:, b] = np.inf
+        others        = np.flatnonzero(active)
+        others        = others[others != a]
+        distance[a, others] = distance[others, a] = js_distances(dists[:, a], dists[:, others], h[a], h[others])
+    return merges, clusters
+
+
+def merged_word_topics(topic_word, mass, clusters):
+    # V x len(CLUSTERS) word distributions: mass-weighted mixtures of the fine topics' distributions
+    dists = topic_word / np.maximum(topic_word.sum(axis=0), 1e-300)
+    return np.column_stack([dists[:, c] @ mass[c] / max(mass[c].sum(), 1e-300) for c in clusters])
+
+
+def write_merged_doc_topics(path, outputs):
+    # Sums each row's fine topic proportions over each cluster, for every (path, clusters) in OUTPUTS, in one pass
+    with open(path, newline='', encoding='utf-8') as f:
+        reader  = csv.reader(f)
+        header  = next(reader)
+        columns = topic_columns(header)
+        first   = columns[0]
+        files   = [open(out, 'w', newline='', encoding='utf-8') for out, _ in outputs]
+        try:
+            writers = [csv.writer(out) for out in files]
+            # Topic columns are contiguous in run_mallet.py's outputs; other columns are kept as they are
+            for writer, (_, clusters) in zip(writers, outputs):
+                writer.writerow(header[:first] + ["Topic {}".format(k + 1) for k in range(len(clusters))] + header[columns[-1] + 1:])
+            for row in reader:
+                props = np.array([float(row[i]) for i in columns])
+                for writer, (_, clusters) in zip(writers, outputs):
+                    writer.writerow(row[:first] + [repr(float(props[c].sum())) for c in clusters] + row[columns[-1] + 1:])
+        finally:
+            for out in files:
+                out.close()
+
+
+def summary_text(report, vocab, merged):
+    lines = []
+    add   = lines.append
+    add("Topics merged from the {} topic model".format(report['fine_topics']))
+    add("===================================")
+    for k in sorted(report['granularities'], key=int):
+        add("")
+        add("{} topics:".format(k))
+        for i, topics in enumerate(report['granularities'][k]):
+            top = np.argsort(-merged[int(k)][:, i])[:num_top_words]
+            add("  Topic {:>3} <- fine topics {}: {}".format(i + 1, ' '.join(map(str, topics)), ' '.join(vocab[w] for w in top)))
+    add("")
+    add("Merges (node = merged cluster, numbered after the fine topics; distance = Jensen-Shannon distance):")
+    for m in report['merges']:
+        add("  {:>4} <- {:>4} + {:<4} distance {:.4f}".format(m['node'], m['children'][0], m['children'][1], m['distance']))
+    return "\n".join(lines) + "\n"
+
+
+def merge(input_dir, targets, output_dirs):
+    vocab, topic_word = read_word_topics(os.path.join(input_dir, 'word_topics.csv'))
+    topic_word = topic_word.astype(np.float64)
+    fine       = topic_word.shape[1]
+    bad        = [k for k in targets if not 0 < k < fine]
+    if bad:
+        sys.stderr.write("Error: can only derive 1 to {} topics from {} topics, not {}\n".format(fine - 1, fine, ' '.join(map(str, bad))))
+        sys.exit(1)
+    mass = topic_mass(os.path.join(input_dir, 'document_topics.csv'))
+    merges, clusters = merge_tree(topic_word, mass, set(targets))
+
+    merged = {}
+    for k, outdir in zip(targets, output_dirs):
+        os.makedirs(outdir, exist_ok=True)
+        merged[k] = merged_word_topics(topic_word, mass, clusters[k])
+        with open(os.path.join(outdir, 'word_topics.csv'), 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(['Word'] + ["Topic {}".format(i + 1) for i in range(k)])
+            for w, row in zip(vocab, merged[k]):
+                writer.writerow([w] + [repr(float(x)) for x in row])
+    for name in doc_topic_files:
+        if os.path.exists(os.path.join(input_dir, name)):
+            write_merged_doc_topics(os.path.join(input_dir, name),
+                                    [(os.path.join(outdir, name), clusters[k]) for k, outdir in zip(targets, output_dirs)])
+
+    report = {'input_dir':     os.path.abspath(input_dir),
+              'fine_topics':   fine,
+              # granularities[K][i]: the fine topics (1-based) merged into topic i+1 of the K topic model
+              'granularities': {str(k): [[t + 1 for t in c] for c in clusters[k]] for k in targets},
+              'merges':        merges}
+    return report, vocab, merged
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Derive coarser topic models by agglomeratively merging the topics of a fine one')
+    parser.add_argument('--input_dir',   required=True, help='Directory with the fine model\'s word_topics.csv and document_topics.csv')
+    parser.add_argument('--numtopics',   type=int, nargs='+', required=True, help='Numbers of topics to derive')
+    parser.add_argument('--output_dirs', nargs='+', required=True, help='Output directory for each of --numtopics')
+    parser.add_argument('--output_json', required=True)
+    parser.add_argument('--output_txt',  required=True)
+    args = parser.parse_args()
+    if len(args.output_dirs) != len(args.numtopics):
+        parser.error('--output_dirs needs one directory for each of --numtopics')
+
+    report, vocab, merged = merge(args.input_dir, args.numtopics, args.output_dirs)
+    with open(args.output_json, 'w') as f:
+        json.dump(report, f, indent=2)
+    text = summary_text(report, vocab, merged)
+    with open(args.output_txt, 'w') as f:
+        f.write(text)
+    sys.stderr.write(text)
+    sys.stderr.write("Wrote {} and {}\n".format(args.output_json, args.output_txt))
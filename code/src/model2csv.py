@@ -25,80 +25,166 @@
 #    --modeldir  /path/to/mallet_model_output/
 #    --vocabfile /path/to/mallet_model_output/model.word-topic-counts
 #
+#  For Mallet, the topic-word distributions come from MODELNAME.topic-word-weights
+#  if the model has one. Models trained with run_mallet.py --output_profile
+#  curation or inference don't, and they are computed from the word-topic
+#  counts instead, smoothed with the last beta in MODELNAME.train-metrics.json
+#  (or the #beta line of MODELNAME.topic-state.gz, or MALLET's default of 0.01).
+#
+#  For Mallet, --topic_word_npz also saves the topic-word distributions in
+#  sparse form, as word-topic counts plus per-topic beta (see
+#  sparse_topic_word.py), for curation without the dense matrix.
+#
+#  --npy_dir DIR also writes the curation inputs that convert_csv_to_npy.py
+#  would make from the CSVs (topic_word.npy, doc_topic.npy, vocab.txt, and
+#  raw_documents.txt when there is no document store) straight from the
+#  model files, so nothing has to parse the CSVs back. With --skip_csv the
+#  CSVs are not written at all.
+#
+#  Scholar and Segan documents are converted a block at a time: Scholar's
+#  jsonlines are parsed and written out alongside the matching rows of
+#  theta, and Segan's topic proportions are joined to their documents by
+#  docID lookup and written out block by block, so no copy of the whole
+#  corpus joined with theta is built.
+#
+#  For Mallet, --docstore /path/to/rawdocs can be given instead of --docfile
+#  (see docstore.py). The document-topics CSV then carries the original docIDs
+#  and no text column; later stages fetch text from the store by row.
+#
 ################################################################
 from traceback_with_variables import activate_by_import
 import argparse
 import pandas as pd
 import numpy as np
 import json
+import gzip
 import os
 import sys
 import csv
 from collections import defaultdict
-from tqdm import tqdm
+from docstore import DocStore
+from sparse_topic_word import from_word_topic_counts
+from topic_state import ArrayWriter
+
+block_rows = 10000
 
 
 def softmax_rows_in_2d_array(X):
-    # Converts rows of unnormalized logits (e.g. Scholar's beta/phi matrix) to probability distributions
-    # Adapted from https://nolanbconaway.github.io/blog/2017/softmax-numpy
+    # Converts rows of unnormalized logits (e.g. Scholar's beta/phi matrix) to probability distributions,
+    # a block of rows at a time. Subtracting each row's maximum first keeps exp() from overflowing.
     sys.stderr.write("Normalizing...\n")
     result = np.empty(X.shape)
-    for i in tqdm(range(X.shape[0])):
-        result[i,:]  = np.exp(X[i,:])
-        result[i,:] /= np.sum(result[i,:])
-    return result 
+    for start in range(0, X.shape[0], block_rows):
+        block  = np.asarray(X[start:start + block_rows], dtype=np.float64)
+        block  = np.exp(block - block.max(axis=1, keepdims=True))
+        result[start:start + block_rows] = block / block.sum(axis=1, keepdims=True)
+    return result
+
+
+def write_word_topics(word_topics_file, vocab, topic_word, labels):
+    # Word-topic CSV ('Word', then a column per topic) from the K x V TOPIC_WORD, a block of words at a time
+    with open(word_topics_file, 'w', newline='', encoding='utf-8') as f:
+        for start in range(0, max(1, len(vocab)), block_rows):
+            block = pd.DataFrame(topic_word[:, start:start + block_rows].T, columns=labels)
+            block.insert(0, 'Word', vocab[start:start + block_rows])
+            block.to_csv(f, index=False, header=(start == 0))
+    sys.stderr.write("Wrote {}\n".format(word_topics_file))
+
+
+class CurationArrays:
+    '''
+    The curation inputs convert_csv_to_npy.py makes from the CSVs, written directly to NPY_DIR:
+    topic_word.npy (K x V, skipped if TOPIC_WORD is None), vocab.txt, and doc_topic.npy (D x K)
+    and, if WITH_TEXT, raw_documents.txt, which grow by a block of documents per add().
+    '''
+
+    def __init__(self, npy_dir, vocab, topic_word, num_topics, with_text=False):
+        os.makedirs(npy_dir, exist_ok=True)
+        self.npy_dir = npy_dir
+        if topic_word is not None:
+            np.save(os.path.join(npy_dir, 'topic_word.npy'), topic_word)
+        with open(os.path.join(npy_dir, 'vocab.txt'), 'w') as f:
+            f.write('\n'.join(str(w) for w in vocab))
+        self.doc_topic = ArrayWriter(os.path.join(npy_dir, 'doc_topic.npy'), np.float64, (num_topics,))
+        self.texts     = open(os.path.join(npy_dir, 'raw_documents.txt'), 'w') if with_text else None
+
+    def add(self, doc_topic, texts=None):
+        if self.texts is not None:
+            # Newline-separated, with none after the last document
+            self.texts.write(('\n' if self.doc_topic.length else '') + '\n'.join(str(text) for text in texts))
+        self.doc_topic.write(doc_topic)
+
+    def close(self):
+        self.doc_topic.close()
+        if self.texts is not None:
+            self.texts.close()
+        sys.stderr.write("Wrote curation arrays to {}\n".format(self.npy_dir))
+
 
-def convert_scholar(modeldir, docfile, vocabfile, word_topics_file):
+def write_curation_arrays(npy_dir, vocab, topic_word, doc_topic, texts=None):
+    # All of the curation inputs at once, for converters that have the whole document-topic matrix
+    arrays = CurationArrays(npy_dir, vocab, topic_word, doc_topic.shape[1], texts is not None)
+    arrays.add(doc_topic, texts)
+    arrays.close()
+
+
+def convert_scholar(modeldir, docfile, vocabfile, word_topics_file, document_topics_file, npy_dir=None, skip_csv=False):
     
-    # Read in original documents and the vocabulary file
-    docs_df = pd.read_json(docfile, lines=True)
+    # Read in the vocabulary file; the documents are read a block at a time below
     with open(vocabfile) as f:
         vocab_list = json.load(f)
 
     # Load beta matrix (topic-word unnormalized logit weights),
     # convert to topic-word distributions,
-    # transpose to get word-topic matrix,
-    # convert to a dataframe with 'Word' as the first column,
-    # output to CSV file.
+    # output to CSV file with 'Word' as the first column and a column per topic.
     beta          = np.load(os.path.join(modeldir, 'beta.npz'))['beta']
     beta_distrib  = softmax_rows_in_2d_array(beta)
-    betaT         = np.transpose(beta_distrib)
-    V, K          = betaT.shape
+    K, V          = beta_distrib.shape
     labels        = ["Topic {}".format(str(i+1)) for i in range(K)]
-    betaT_df      = pd.DataFrame(betaT, columns = labels)
-    betaT_df.insert(0, 'Word', vocab_list)
-    betaT_df.to_csv(word_topics_file, index=False)
-    sys.stderr.write("Wrote {}\n".format(word_topics_file))
+    if not skip_csv:
+        write_word_topics(word_topics_file, vocab_list, beta_distrib, labels)
 
     # Load theta (document-topic proportions) matrix (training docs only, not dev/test),
-    # and document jsonlines.
+    # whose rows are the first documents of the jsonlines file, in order.
     npz   = np.load(os.path.join(modeldir, 'theta.train.npz')) 
-    ids   = npz['ids']
     theta = npz['theta']
     n_docs, n_topics = theta.shape
-    with open(docfile) as f:
-        doc_jsonl = f.readlines()
+    arrays = CurationArrays(npy_dir, vocab_list, beta_distrib, n_topics, with_text=True) if npy_dir else None
     
-    # For CSV output header and one row per document
-    with open(document_topics_file, 'w', encoding="utf-8", errors="replace") as csvfile:
+    # For CSV output header and one row per document, parsing the jsonlines a block of documents at a time
+    with open(document_topics_file if not skip_csv else os.devnull, 'w', encoding="utf-8", errors="replace") as csvfile:
         writer = csv.writer(csvfile, dialect='excel', delimiter=',', quoting=csv.QUOTE_ALL)
-        row = ['docID'] + labels + ['text']
-        writer.writerow(row)
-        for i in range(n_docs):
-            doc         = json.loads(doc_jsonl[i])
-            text        = doc['text'].replace("\n", " ")
-            row         = [doc['id']] + list(theta[i]) + [text]
-            writer.writerow(row)
-    sys.stderr.write("Wrote {}\n".format(document_topics_file))
+        writer.writerow(['docID'] + labels + ['text'])
+        done   = 0
+        for docs in pd.read_json(docfile, lines=True, chunksize=block_rows, dtype=False, convert_dates=False,
+                                 keep_default_dates=False, precise_float=True):
+            docs   = docs.iloc[:n_docs - done]
+            block  = theta[done:done + len(docs)]
+            texts  = [text.replace("\n", " ") for text in docs['text']]
+            # Proportions formatted as str() would, as the csv module does: Python floats' repr is the same
+            # as str() for float64, and astype(str) keeps float32's shorter form
+            if not skip_csv:
+                props  = block.tolist() if block.dtype == np.float64 else block.astype(str).tolist()
+                writer.writerows([docid] + p + [text] for docid, p, text in zip(docs['id'].tolist(), props, texts))
+            if arrays:
+                arrays.add(block, texts)
+            done  += len(docs)
+            if done == n_docs:
+                break
+    if done < n_docs:
+        sys.stderr.write("Error: {} has {} documents, but theta.train.npz has {} rows\n".format(docfile, done, n_docs))
+        sys.exit(1)
+    if not skip_csv:
+        sys.stderr.write("Wrote {}\n".format(document_topics_file))
+    if arrays:
+        arrays.close()
 
 
-def convert_segan(modeldir, docfile, vocabfile, word_topics_file, docinfo_file):
+def convert_segan(modeldir, docfile, vocabfile, word_topics_file, document_topics_file, docinfo_file, npy_dir=None, skip_csv=False):
     
     # Read in original documents, vocabulary file, and document IDs for the documents that were included in the modeling
     # (Noting that for segan some documents are excluded on import, e.g. if document is empty because all tokens were stopwords)
-    with open(docfile) as f:
-        # docs_df = pd.read_csv(docfile, sep=',', encoding='utf-8', engine='python', warn_bad_lines=True, error_bad_lines=False)
-        docs_df = pd.read_csv(docfile, sep=',', encoding='utf-8', engine='python', on_bad_lines='warn')
+    docs_df = pd.read_csv(docfile, sep=',', encoding='utf-8', engine='c', dtype={'docID': str}, on_bad_lines='warn')
     with open(vocabfile) as f:
         vocab_list = [s.rstrip() for s in f.readlines()]
     with open(docinfo_file) as f:
@@ -108,43 +194,46 @@ def convert_segan(modeldir, docfile, vocabfile, word_topics_file, docinfo_file):
     #   - Calling it beta below for consistency with scholar
     #   - Skipping first row (which is number of topics)
     #   - Dropping first column (which is size of vocabulary, repeated in each row)
-    #     See https://stackoverflow.com/questions/13411544/delete-column-from-pandas-dataframe
-    # transpose to get word-topic matrix,
-    # convert to a dataframe with 'Word' as the first column,
-    # output to CSV file.
-    #
-    # beta_df       = pd.read_csv(os.path.join(modeldir,'phis.txt'), sep='\t', encoding='utf-8', engine='python', header=None, skiprows=[0],
-    #                         warn_bad_lines=True, error_bad_lines=False)
-    beta_df       = pd.read_csv(os.path.join(modeldir,'phis.txt'), sep='\t', encoding='utf-8', engine='python', header=None, skiprows=[0], on_bad_lines='warn')
-
-    beta_distrib  = beta_df.drop(beta_df.columns[[0]], axis=1).to_numpy()
-    betaT         = np.transpose(beta_distrib)
-    V, K          = betaT.shape
+    # output to CSV file with 'Word' as the first column and a column per topic.
+    beta_distrib  = pd.read_csv(os.path.join(modeldir,'phis.txt'), sep='\t', encoding='utf-8', engine='c', header=None, skiprows=[0],
+                                on_bad_lines='warn').to_numpy()[:, 1:]
+    K, V          = beta_distrib.shape
     labels        = ["Topic {}".format(str(i+1)) for i in range(K)]
-    betaT_df      = pd.DataFrame(betaT, columns = labels)
-    betaT_df.insert(0, 'Word', vocab_list)
-    betaT_df.to_csv(word_topics_file, index=False)
-    sys.stderr.write("Wrote {}\n".format(word_topics_file))
+    if not skip_csv:
+        write_word_topics(word_topics_file, vocab_list, beta_distrib, labels)
 
     # Load theta (document-topic proportions) matrix
     # Skip first row (number of documents included), remove first column (number of topics, repeated each row)
-    # Add column names to dataframe and insert docID column with document IDs for docs that were included in the model
-    # Merge/join topic posteriors (theta_df) with the text documents themselves (docs_df)
-    # See https://stackoverflow.com/questions/64385747/valueerror-you-are-trying-to-merge-on-object-and-int64-columns-when-use-pandas
-    #  for use of astype(str), which ensures that docID column is interpreted as a string for purposes of the merge (join) in both dfs.
-    #
-    # theta_df         = pd.read_csv(os.path.join(modeldir,'thetas.txt'), sep='\t', encoding='utf-8', engine='python', header=None, skiprows=[0],
-    #                          warn_bad_lines=True, error_bad_lines=False)
-    theta_df         = pd.read_csv(os.path.join(modeldir,'thetas.txt'), sep='\t', encoding='utf-8', engine='python', header=None, skiprows=[0], on_bad_lines='warn')
-    theta_df         = theta_df.drop(beta_df.columns[[0]], axis=1)
-    theta_df.columns = labels
-    theta_df.insert(0, 'docID', docid_list)
-    theta_df['docID'] = theta_df['docID'].astype(str)
-    docs_df['docID']  = docs_df['docID'].astype(str)
-    theta_merged_df   = pd.merge(theta_df, docs_df, on='docID')
-    n_docs, _         = theta_merged_df.shape
-    theta_merged_df.to_csv(document_topics_file, index=False)
-    sys.stderr.write("Wrote {}\n".format(document_topics_file))
+    # Join the topic posteriors, whose rows are the docIDs in the docinfo file, with the text documents
+    # themselves (docs_df) by looking up each docID's row, and write the joined rows a block at a time.
+    # As in an inner join, documents missing from docs_df are left out.
+    theta         = pd.read_csv(os.path.join(modeldir,'thetas.txt'), sep='\t', encoding='utf-8', engine='c', header=None, skiprows=[0],
+                                on_bad_lines='warn').to_numpy()[:, 1:]
+    duplicated    = docs_df['docID'].duplicated()
+    if duplicated.any():
+        sys.stderr.write("Warning: {} repeated docIDs in {}; using the first document for each\n".format(int(duplicated.sum()), docfile))
+        docs_df   = docs_df[~duplicated]
+    doc_rows      = pd.Index(docs_df['docID']).get_indexer(docid_list)
+    theta_rows    = np.flatnonzero(doc_rows >= 0)
+    if len(theta_rows) < len(docid_list):
+        sys.stderr.write("Warning: {} of the {} modeled documents are not in {}\n".format(len(docid_list) - len(theta_rows), len(docid_list), docfile))
+    other_columns = docs_df.drop(columns='docID')
+    with_text     = 'text' in other_columns.columns
+    arrays        = CurationArrays(npy_dir, vocab_list, beta_distrib, K, with_text) if npy_dir else None
+    with open(document_topics_file if not skip_csv else os.devnull, 'w', newline='', encoding='utf-8') as f:
+        for start in range(0, max(1, len(theta_rows)), block_rows):
+            rows  = theta_rows[start:start + block_rows]
+            block = pd.DataFrame(theta[rows], columns=labels)
+            block.insert(0, 'docID', [docid_list[i] for i in rows])
+            docs  = other_columns.iloc[doc_rows[rows]].reset_index(drop=True)
+            if not skip_csv:
+                pd.concat([block, docs], axis=1).to_csv(f, index=False, header=(start == 0))
+            if arrays:
+                arrays.add(theta[rows], docs['text'] if with_text else None)
+    if not skip_csv:
+        sys.stderr.write("Wrote {}\n".format(document_topics_file))
+    if arrays:
+        arrays.close()
     
 
 #  Example for Mallet:
@@ -155,16 +244,63 @@ def convert_segan(modeldir, docfile, vocabfile, word_topics_file, docinfo_file):
 #    --vocabfile /path/to/mallet_model_output/model.word-topic-counts
 #    --modelname fold_0.k25
 
-def convert_mallet(modeldir, docfile, vocabfile, word_topics_file, document_topics_file, modelname):
+default_mallet_beta = 0.01
+
+def mallet_beta(modeldir, modelname):
+    # Beta at the end of training, as train-topics last reported it (see mallet_utils.TrainingMonitor),
+    # or, if it was never optimized, the beta run_mallet.py recorded training starting from
+    metrics_file = os.path.join(modeldir, modelname + '.train-metrics.json')
+    if os.path.exists(metrics_file):
+        with open(metrics_file) as f:
+            metrics = json.load(f)
+        if metrics.get('hyperparameters'):
+            return metrics['hyperparameters'][-1]['beta']
+        if metrics.get('beta') is not None:
+            return metrics['beta']
+    # Older models' metrics don't record it, but the state file has the beta it was trained with
+    state_file = os.path.join(modeldir, modelname + '.topic-state.gz')
+    if os.path.exists(state_file):
+        with gzip.open(state_file, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if line.startswith('#beta :'):
+                    return float(line.split(':', 1)[1])
+                if not line.startswith('#'):
+                    break
+    return default_mallet_beta
+
+def word_topic_probs_from_counts(vocabfile, num_topics, beta):
+    # V x K topic-word distributions from a word-topic-counts file: (count + beta) / (topic total + V * beta)
+    return from_word_topic_counts(vocabfile, beta, num_topics).to_dense().T
+
+def read_topic_word_weights(weights_file, num_types):
+    '''
+    K x V array of the weights in a topic-word-weights file (topic<tab>word<tab>weight). MALLET writes
+    a row for every word in every topic, topic by topic, with words in vocabulary order, so the
+    weights column is the K x V matrix in row-major order. Read with pandas' C parser, skipping the words.
+    '''
+    table   = pd.read_csv(weights_file, sep='\t', encoding='utf-8', engine='c', header=None,
+                          names=['topicnum', 'word', 'weight'], usecols=['topicnum', 'weight'],
+                          dtype={'topicnum': np.int32, 'weight': np.float64}, quoting=csv.QUOTE_NONE, na_filter=False)
+    topics  = table['topicnum'].to_numpy()
+    K       = int(topics[-1]) + 1 if len(topics) else 0
+    if len(topics) != K * num_types or (topics != np.repeat(np.arange(K, dtype=topics.dtype), num_types)).any():
+        sys.stderr.write("Error: {} does not have {} words for each topic, topic by topic\n".format(weights_file, num_types))
+        sys.exit(1)
+    return table['weight'].to_numpy().reshape(K, num_types)
+
+def convert_mallet(modeldir, docfile, vocabfile, word_topics_file, document_topics_file, modelname, docstore=None, topic_word_npz=None,
+                   npy_dir=None, skip_csv=False):
     
     # Read in original documents (mallet format is docID<tab>label<tab>text)
     # We only want the docID and text columns, hence usecols.
-    sys.stderr.write("Reading {}\n".format(docfile))
-    with open(docfile) as f:
-        # docs_df = pd.read_csv(docfile, sep='\t', encoding='utf-8', engine='python', usecols = [0,2],
-        #                          names=['docID','label','text'], warn_bad_lines=True, error_bad_lines=False)
-        docs_df = pd.read_csv(docfile, sep='\t', encoding='utf-8', engine='python', usecols = [0,2],
-                                  names=['docID','label','text'], on_bad_lines='warn')
+    # Not needed when the text is in a document store.
+    if docstore is None:
+        sys.stderr.write("Reading {}\n".format(docfile))
+        with open(docfile) as f:
+            # docs_df = pd.read_csv(docfile, sep='\t', encoding='utf-8', engine='python', usecols = [0,2],
+            #                          names=['docID','label','text'], warn_bad_lines=True, error_bad_lines=False)
+            docs_df = pd.read_csv(docfile, sep='\t', encoding='utf-8', engine='python', usecols = [0,2],
+                                      names=['docID','label','text'], on_bad_lines='warn')
 
     # Read in vocabulary file (the word-topic-counts file contains word in second space-separated column)
     sys.stderr.write("Reading {}\n".format(vocabfile))
@@ -178,80 +314,122 @@ def convert_mallet(modeldir, docfile, vocabfile, word_topics_file, document_topi
     # Normalize and turn these into columns of word-topic matrix
     # where vocabulary ('Word') is the first column, topics are columns; then
     # output to CSV file.
-    sys.stderr.write("Creating {}\n".format(word_topics_file))
-    betaT_df       = pd.DataFrame(vocab_lines, columns = ['Word'])
-    sys.stderr.write("Reading topic-word weights.\n")
-    betaT_df       = pd.DataFrame(vocab_lines, columns = ['Word'])
-    # beta_input_df  = pd.read_csv(os.path.join(modeldir, modelname + '.topic-word-weights'), sep='\t', encoding='utf-8', engine='python', header=None, 
-    #                          names = ['topicnum', 'word', 'weight'], warn_bad_lines=True, error_bad_lines=False)
-    beta_input_df  = pd.read_csv(os.path.join(modeldir, modelname + '.topic-word-weights'), sep='\t', encoding='utf-8', engine='python', header=None, 
-                              names = ['topicnum', 'word', 'weight'], on_bad_lines='warn')
-
-    groups         = beta_input_df.groupby('topicnum')
-    for topicnum, group_df in tqdm(groups):
-        weights = group_df['weight'].values
-        total   = weights.sum()
-        probs   = weights / total
-        # print("DEBUG: weights has length {}, probs has length {}, betaT_df is...".format(len(weights),len(probs)))
-        # print(betaT_df)
-        betaT_df.loc[:,"Topic {}".format(topicnum+1)] = probs  # https://re-thought.com/how-to-add-new-columns-in-a-dataframe-in-pandas/
-    betaT_df.to_csv(word_topics_file, index=False)
-    sys.stderr.write("Wrote {}\n".format(word_topics_file))
+    weights_file   = os.path.join(modeldir, modelname + '.topic-word-weights')
+    if os.path.exists(weights_file):
+        sys.stderr.write("Reading topic-word weights.\n")
+        weights    = read_topic_word_weights(weights_file, len(vocab_lines))
+        num_topics = weights.shape[0]
+        probs      = (weights / weights.sum(axis=1, keepdims=True)).T
+        # Weights are beta + count, so each topic's smallest weight is its beta (some word always has no count)
+        beta       = weights.min(axis=1)
+    else:
+        # No weights file (run_mallet.py --output_profile curation or inference): the weights are beta + count
+        with open(os.path.join(modeldir, modelname + '.topic-keys')) as f:
+            num_topics = sum(1 for line in f if line.strip())
+        beta  = mallet_beta(modeldir, modelname)
+        sys.stderr.write("No {}; computing topic-word distributions from word-topic counts with beta {}\n".format(weights_file, beta))
+        probs = word_topic_probs_from_counts(vocabfile, num_topics, beta)
+    topic_cols = ["Topic {}".format(k+1) for k in range(num_topics)]
+    if not skip_csv:
+        sys.stderr.write("Creating {}\n".format(word_topics_file))
+        betaT_df = pd.concat([pd.DataFrame(vocab_lines, columns = ['Word']), pd.DataFrame(probs, columns=topic_cols)], axis=1)
+        betaT_df.to_csv(word_topics_file, index=False)
+        sys.stderr.write("Wrote {}\n".format(word_topics_file))
+    if topic_word_npz:
+        from_word_topic_counts(vocabfile, beta, num_topics).save(topic_word_npz)
+        sys.stderr.write("Wrote {}\n".format(topic_word_npz))
     
     # Load theta (document-topic proportions) matrix
     # Drop document number column
     # Output to CSV file
-    sys.stderr.write("Creating {}\n".format(document_topics_file))
-    cols             = ['docnum','docID'] + betaT_df.columns.values.tolist()[1:]
+    cols             = ['docnum','docID'] + topic_cols
     # theta_df         = pd.read_csv(os.path.join(modeldir,modelname + '.doc-topics'), sep='\t', encoding='utf-8', engine='python', header=None,
     #                                   names=cols, warn_bad_lines=True, error_bad_lines=False)
-    theta_df         = pd.read_csv(os.path.join(modeldir,modelname + '.doc-topics'), sep='\t', encoding='utf-8', engine='python', header=None,
+    theta_df         = pd.read_csv(os.path.join(modeldir,modelname + '.doc-topics'), sep='\t', encoding='utf-8', engine='c', header=None,
                                       names=cols, on_bad_lines='warn')
 
     theta_df         = theta_df.drop(theta_df.columns[[0]], axis=1)
-    theta_merged_df  = pd.merge(theta_df, docs_df, on='docID')
-    theta_merged_df.to_csv(document_topics_file, index=False)
-    sys.stderr.write("Wrote {}\n".format(document_topics_file))
+    texts            = None
+    if docstore is not None:
+        # Mallet docIDs are sequential line numbers (from 1) in the document store.
+        # Put rows in store order and replace them with the original docIDs.
+        store            = DocStore(docstore)
+        theta_df         = theta_df.sort_values('docID')
+        rows             = theta_df['docID'].to_numpy() - 1
+        if len(rows) != len(store) or (rows != np.arange(len(store))).any():
+            sys.stderr.write("Error: doc-topics rows do not line up with the {} documents in {}\n".format(len(store), docstore))
+            sys.exit(1)
+        theta_df['docID'] = store.docids(rows)
+        store.close()
+    else:
+        theta_df         = pd.merge(theta_df, docs_df, on='docID')
+        texts            = theta_df['text']
+    if not skip_csv:
+        sys.stderr.write("Creating {}\n".format(document_topics_file))
+        theta_df.to_csv(document_topics_file, index=False)
+        sys.stderr.write("Wrote {}\n".format(document_topics_file))
+
+    # Straight from the model files, rather than parsing the CSVs back (convert_csv_to_npy.py);
+    # the sparse topic_word.npz stands in for a dense topic_word.npy when there is one
+    if npy_dir:
+        write_curation_arrays(npy_dir, vocab_lines, None if topic_word_npz else probs.T,
+                              theta_df[topic_cols].to_numpy(), texts)
 
     
-# Handle command line
-parser = argparse.ArgumentParser(description='Converts topic model output into a uniform format using CSV files')
-parser.add_argument('-p','--package',
-                        help='Topic model package: scholar, mallet, segan',                        dest='package',      default='scholar')
-parser.add_argument('-m','--modeldir',
-                        help='Directory containing model output',                                  dest='modeldir',     default=None)
-parser.add_argument('-d','--docfile',
-                        help='File containing input documents',                                    dest='docfile',      default=None)
-parser.add_argument('-v','--vocabfile',
-                        help='File containing vocabulary',                                         dest='vocabfile',    default=None)
-parser.add_argument('-i','--docinfo',
-                        help='Docinfo file containing docIDs (segan only)',                        dest='docinfo_file', default=None)
-parser.add_argument('-M','--modelname',
-                        help='Name of model, M, where M.model is the output-model (mallet only)',  dest='modelname',    default='mallet')
-parser.add_argument('-w','--word_topics_file',
-                        help='Output CSV file for topic-words distribution',  dest='word_topics_file',     default="word_topics.csv")
-parser.add_argument('-D','--document_topics_file',
-                        help='Output CSV filefor doc-topics distribution',    dest='document_topics_file', default="document_topics.csv")
-args = vars(parser.parse_args())
-if args['modeldir'] is None  or args['docfile'] is None  or args['vocabfile'] is None:
-    parser.error('Required arguments: --modeldir, --docfile, --vocabfile. Use -h to see detailed usage info.')
-
-package              = args['package']
-modeldir             = args['modeldir']
-docfile              = args['docfile']
-vocabfile            = args['vocabfile']
-docinfo_file         = args['docinfo_file']
-modelname            = args['modelname']
-word_topics_file     = args['word_topics_file']
-document_topics_file = args['document_topics_file']
-
-
-# Convert according to package
-if (package == 'scholar'):
-    convert_scholar(modeldir, docfile, vocabfile, word_topics_file)
-elif (package == 'segan'):
-    convert_segan(modeldir, docfile, vocabfile, word_topics_file, docinfo_file)
-elif (package == 'mallet'):
-    convert_mallet(modeldir, docfile, vocabfile, word_topics_file, document_topics_file, modelname)
-else:
-    sys.stderr.write("Not yet handling package '{}'\n".format(package))
+if __name__ == "__main__":
+    # Handle command line
+    parser = argparse.ArgumentParser(description='Converts topic model output into a uniform format using CSV files')
+    parser.add_argument('-p','--package',
+                            help='Topic model package: scholar, mallet, segan',                        dest='package',      default='scholar')
+    parser.add_argument('-m','--modeldir',
+                            help='Directory containing model output',                                  dest='modeldir',     default=None)
+    parser.add_argument('-d','--docfile',
+                            help='File containing input documents',                                    dest='docfile',      default=None)
+    parser.add_argument('-v','--vocabfile',
+                            help='File containing vocabulary',                                         dest='vocabfile',    default=None)
+    parser.add_argument('-S','--docstore',
+                            help='Document store to take docIDs and text from instead of DOCFILE (mallet only)', dest='docstore', default=None)
+    parser.add_argument('-i','--docinfo',
+                            help='Docinfo file containing docIDs (segan only)',                        dest='docinfo_file', default=None)
+    parser.add_argument('-M','--modelname',
+                            help='Name of model, M, where M.model is the output-model (mallet only)',  dest='modelname',    default='mallet')
+    parser.add_argument('-w','--word_topics_file',
+                            help='Output CSV file for topic-words distribution',  dest='word_topics_file',     default="word_topics.csv")
+    parser.add_argument('-D','--document_topics_file',
+                            help='Output CSV filefor doc-topics distribution',    dest='document_topics_file', default="document_topics.csv")
+    parser.add_argument('-Z','--topic_word_npz',
+                            help='Also save sparse topic-word distributions to this .npz (mallet only)', dest='topic_word_npz', default=None)
+    parser.add_argument('-B','--npy_dir',
+                            help='Also write topic_word.npy, doc_topic.npy, vocab.txt (and raw_documents.txt) here', dest='npy_dir', default=None)
+    parser.add_argument('--skip_csv', action='store_true',
+                            help='With --npy_dir, write only the binary outputs, not the CSV files', dest='skip_csv')
+    args = vars(parser.parse_args())
+    if args['modeldir'] is None  or (args['docfile'] is None and args['docstore'] is None)  or args['vocabfile'] is None:
+        parser.error('Required arguments: --modeldir, --docfile (or --docstore), --vocabfile. Use -h to see detailed usage info.')
+
+    package              = args['package']
+    modeldir             = args['modeldir']
+    docfile              = args['docfile']
+    docstore             = args['docstore']
+    vocabfile            = args['vocabfile']
+    docinfo_file         = args['docinfo_file']
+    modelname            = args['modelname']
+    word_topics_file     = args['word_topics_file']
+    document_topics_file = args['document_topics_file']
+    topic_word_npz       = args['topic_word_npz']
+    npy_dir              = args['npy_dir']
+    skip_csv             = args['skip_csv']
+    if skip_csv and not npy_dir:
+        parser.error('--skip_csv needs --npy_dir')
+
+
+    # Convert according to package
+    if (package == 'scholar'):
+        convert_scholar(modeldir, docfile, vocabfile, word_topics_file, document_topics_file, npy_dir, skip_csv)
+    elif (package == 'segan'):
+        convert_segan(modeldir, docfile, vocabfile, word_topics_file, document_topics_file, docinfo_file, npy_dir, skip_csv)
+    elif (package == 'mallet'):
+        convert_mallet(modeldir, docfile, vocabfile, word_topics_file, document_topics_file, modelname, docstore, topic_word_npz,
+                       npy_dir, skip_csv)
+    else:
+        sys.stderr.write("Not yet handling package '{}'\n".format(package))
@@ -0,0 +1,206 @@
+################################################################
+#
+#  Content-addressed store of trained topic models, shared across analyses
+#
+#  Re-running the same docket under a new modelname or rootdir would
+#  otherwise retrain identical MALLET models from scratch. run_mallet.py
+#  keys each trained model by a hash of the imported corpus and the
+#  training parameters; on a hit it links (or copies) the stored outputs
+#  into the model directory instead of calling train-topics.
+#
+#  Layout of the store directory:
+#
+#    STORE/.lock              lock file (fcntl.flock) guarding every change to the store
+#    STORE/objects/KEY/       one entry per trained model, files named MODELNAME-independently
+#    STORE/objects/KEY/meta.json   parameters, size in bytes, last-used time
+#    STORE/tmp/               staging area for entries being added, KEY.HOST.PID
+#
+#  The store is capped in size; when an insertion takes it over the cap,
+#  least-recently-used entries are evicted. Staging directories left by runs
+#  that died before publishing their entry are removed at the same time: those
+#  of this host whose process is gone, and any older than a day.
+#
+#  Example (from run_mallet.py):
+#    key = model_key(preprocessed_docs, {'numtopics': 20, 'numiterations': 1000, ...})
+#    if lookup(store, key, modeldir, modelname):
+#        ... skip training ...
+#    else:
+#        ... train into modeldir ...
+#        insert(store, key, modeldir, modelname, params, max_bytes)
+#
+################################################################
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import socket
+import sys
+import time
+
+# Stored files are named with this placeholder in place of the modelname
+STORE_MODELNAME = 'model'
+
+# Staging directories older than this are abandoned, whichever host made them
+stale_staging_seconds = 24 * 3600
+
+
+def model_key(preprocessed_docs, params):
+    '''
+    Returns a hex digest identifying a trained model: a hash of the corpus as MALLET
+    imports it (docID and text columns of the docID<tab>label<tab>text file; the label
+    is the modelname, which doesn't affect training) and of the training parameters.
+    '''
+    h = hashlib.sha256()
+    with open(preprocessed_docs, 'rb') as f:
+        for line in f:
+            fields = line.rstrip(b'\r\n').split(b'\t', 2)
+            h.update(fields[0])
+            h.update(b'\t')
+            h.update(fields[2] if len(fields) > 2 else b'')
+            h.update(b'\n')
+    h.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+    return h.hexdigest()
+
+
+@contextlib.contextmanager
+def _locked(store):
+    # Exclusive lock on the whole store; held only for bookkeeping and linking, never during training
+    os.makedirs(os.path.join(store, 'objects'), exist_ok=True)
+    os.makedirs(os.path.join(store, 'tmp'), exist_ok=True)
+    with open(os.path.join(store, '.lock'), 'a') as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+def _read_meta(entry):
+    with open(os.path.join(entry, 'meta.json')) as f:
+        return json.load(f)
+
+def _write_meta(entry, meta):
+    tmpname = os.path.join(entry, 'meta.json.tmp')
+    with open(tmpname, 'w') as f:
+        json.dump(meta, f, indent=2, sort_keys=True)
+    os.replace(tmpname, os.path.join(entry, 'meta.json'))
+
+
+def _link_or_copy(src, dst):
+    # Hard links cost nothing and survive eviction of the entry; fall back to copying across filesystems
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def lookup(store, key, modeldir, modelname):
+    '''
+    If STORE has an entry for KEY, links its files into MODELDIR (renamed for MODELNAME),
+    marks the entry as recently used, and returns True. Otherwise returns False.
+    '''
+    entry = os.path.join(store, 'objects', key)
+    with _locked(store):
+        if not os.path.isfile(os.path.join(entry, 'meta.json')):
+            return False
+        meta = _read_meta(entry)
+        os.makedirs(modeldir, exist_ok=True)
+        for name in meta['files']:
+            target = modelname + name[len(STORE_MODELNAME):]
+            _link_or_copy(os.path.join(entry, name), os.path.join(modeldir, target))
+        meta['last_used'] = time.time()
+        meta['hits']      = meta.get('hits', 0) + 1
+        _write_meta(entry, meta)
+    sys.stderr.write("Model store hit {} in {}\n".format(key[:12], store))
+    return True
+
+
+def insert(store, key, modeldir, modelname, params, max_bytes=None):
+    '''
+    Adds the MODELNAME.* files in MODELDIR to STORE under KEY, then evicts
+    least-recently-used entries until the store is no larger than MAX_BYTES.
+    Files are staged outside the lock and published with an atomic rename,
+    so concurrent runs never see a partial entry.
+    '''
+    staging = os.path.join(store, 'tmp', "{}.{}.{}".format(key, socket.gethostname(), os.getpid()))
+    os.makedirs(staging, exist_ok=True)
+    files = []
+    size  = 0
+    for filename in sorted(os.listdir(modeldir)):
+        if not filename.startswith(modelname + '.'):
+            continue
+        name = STORE_MODELNAME + filename[len(modelname):]
+        _link_or_copy(os.path.join(modeldir, filename), os.path.join(staging, name))
+        files.append(name)
+        size += os.path.getsize(os.path.join(staging, name))
+    now  = time.time()
+    meta = {'key': key, 'params': params, 'files': files, 'bytes': size,
+            'created': now, 'last_used': now, 'hits': 0}
+    _write_meta(staging, meta)
+
+    entry = os.path.join(store, 'objects', key)
+    with _locked(store):
+        if os.path.exists(entry):
+            # Another run stored the same model first
+            shutil.rmtree(staging)
+        else:
+            os.rename(staging, entry)
+            sys.stderr.write("Stored model {} ({:.1f} MB) in {}\n".format(key[:12], size / 1e6, store))
+        if max_bytes is not None:
+            _evict(store, max_bytes, keep=key)
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _remove_stale_staging(store):
+    # Called with the lock held. Removes staging directories whose run died before publishing them.
+    staging_dir = os.path.join(store, 'tmp')
+    if not os.path.isdir(staging_dir):
+        return
+    host = socket.gethostname()
+    now  = time.time()
+    for name in os.listdir(staging_dir):
+        path = os.path.join(staging_dir, name)
+        _, _, rest = name.partition('.')
+        owner, _, pid = rest.rpartition('.')
+        try:
+            age = now - os.path.getmtime(path)
+        except OSError:
+            continue
+        dead = owner == host and pid.isdigit() and not _process_alive(int(pid))
+        if dead or age > stale_staging_seconds:
+            sys.stderr.write("Removing abandoned staging directory {}\n".format(path))
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def _evict(store, max_bytes, keep=None):
+    # Called with the lock held. Removes abandoned staging directories, then least-recently-used entries until under MAX_BYTES.
+    _remove_stale_staging(store)
+    objects = os.path.join(store, 'objects')
+    entries = []
+    for key in os.listdir(objects):
+        entry = os.path.join(objects, key)
+        try:
+            meta = _read_meta(entry)
+        except (OSError, ValueError):
+            continue
+        entries.append((meta['last_used'], meta['bytes'], key))
+    total = sum(size for _, size, _ in entries)
+    for last_used, size, key in sorted(entries):
+        if total <= max_bytes:
+            break
+        if key == keep:
+            continue
+        sys.stderr.write("Evicting model {} from {}\n".format(key[:12], store))
+        shutil.rmtree(os.path.join(objects, key))
+        total -= size
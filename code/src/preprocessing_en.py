@@ -4,14 +4,23 @@
 #         --infile     in.txt
 #         --emptyline  "output to use if line is empty, default is blank line"
 #         --model      "en_core_web_sm"
+#         --outfile    out.txt     (optional, default is stdout)
+#         --label      LABEL       (optional, see below)
+#         --jobs       jobs.tsv    (optional, see below)
 #
 # Preprocessing that tokenizes and applies a stoplist and lowercases,
 # and  also identifies and appends phrases to the tokenized text.
 #
 # Input in --infile: one string per line
 #
-#  Output to stdout: 
+#  Output to stdout (or --outfile): 
 #    Same as input but with texts converted to tokens + phrases
+#    With --label, each line is instead in MALLET's 3-column import format,
+#    docID<tab>label<tab>text, numbering docIDs sequentially from 1.
+#
+#  With --jobs, several files are preprocessed with a single spaCy startup.
+#  Each line of the jobs file is infile<tab>outfile[<tab>label], and
+#  --infile/--outfile/--label are ignored.
 #
 #  Example:
 #    Input:  This is a really big test of the amazing system written by John Smith and his dog
@@ -44,6 +53,30 @@ max_chunk_length = 3
 sys.stderr = io.TextIOWrapper(open(sys.stderr.fileno(), 'wb', 0), write_through=True)
 
 
+def preprocess_file(nlp, infile, out, stoplist, emptyline=None, label=None):
+    # Preprocesses each line of infile, writing one output line per input line to out
+    count = 0
+    with codecs.open(infile, 'r', encoding='utf-8', errors='ignore') as fp:
+        for line in fp:
+            count = count + 1
+            if (count % 100) == 0:
+                sys.stderr.write("{} ".format(count))
+            if (count % 1000) == 0:
+                sys.stderr.write("\n".format(count))
+            terms = tokenize_string_adding_phrases(nlp, line, stoplist, max_chunk_length)
+            if len(terms) > 0:
+                text = " ".join(terms)
+            elif emptyline is not None:
+                text = "{}".format(emptyline)
+            else:
+                text = ""
+            if label is not None:
+                out.write("{}\t{}\t{}\n".format(count, label, text))
+            else:
+                out.write(text + "\n")
+    return count
+
+
 if __name__ == '__main__':
 
     # Handle command line
@@ -56,14 +89,24 @@ if __name__ == '__main__':
                         help='stopwords or stop phrases, one per line')
     parser.add_argument('--model',      dest='model', default="en_core_web_sm",
                         help='spaCy model to use')
+    parser.add_argument('--outfile',    dest='outfile', default=None,
+                        help='output file (default is stdout)')
+    parser.add_argument('--label',      dest='label', default=None,
+                        help='write docID<tab>LABEL<tab>text lines for MALLET import')
+    parser.add_argument('--jobs',       dest='jobs', default=None,
+                        help='file listing infile<tab>outfile[<tab>label] lines to preprocess with one spaCy startup')
 
     args = parser.parse_args()
 
-    if args.infile is None:
+    if args.jobs is not None:
+        with open(args.jobs) as fp:
+            jobs = [line.rstrip('\n').split('\t') for line in fp if line.strip()]
+        jobs = [(job[0], job[1], job[2] if len(job) > 2 else None) for job in jobs]
+    elif args.infile is None:
         print("Missing required --infile argument")
         sys.exit(1)
     else:
-        infile = args.infile
+        jobs = [(args.infile, args.outfile, args.label)]
         
     if args.stoplist is not None:
         stoplist = load_wordlist(args.stoplist)
@@ -78,27 +121,11 @@ if __name__ == '__main__':
     # Initialize spacy
     nlp = spacy.load(model)
 
-    # Main loop through input lines, output going to stdout
-    count = 0
-    with codecs.open(infile, 'r', encoding='utf-8', errors='ignore') as fp:
-        for line in fp:
-            count = count + 1
-            if (count % 100) == 0:
-                sys.stderr.write("{} ".format(count))
-            if (count % 1000) == 0:
-                sys.stderr.write("\n".format(count))
-            terms = tokenize_string_adding_phrases(nlp, line, stoplist, max_chunk_length)
-            if len(terms) > 0:
-                print(" ".join(terms))
-            elif args.emptyline is not None:
-                print("{}".format(args.emptyline))
-            else:
-                print("")
-            
-
-
-    
-
-
-
-
+    # Main loop through input files, output going to stdout unless an output file is given
+    for infile, outfile, label in jobs:
+        if outfile is None:
+            preprocess_file(nlp, infile, sys.stdout, stoplist, args.emptyline, label)
+        else:
+            sys.stderr.write("Preprocessing {} into {}\n".format(infile, outfile))
+            with open(outfile, 'w', encoding='utf-8') as out:
+                preprocess_file(nlp, infile, out, stoplist, args.emptyline, label)
@@ -0,0 +1,144 @@
+################################################################
+#
+#  Document-frequency vocabulary pruning, between preprocessing and import
+#
+#  Preprocessing appends phrases to every document (see
+#  phrase_tokenization_subs.py), and most of them occur once in the whole
+#  corpus. Sampling time, the topic-word weights and the curation
+#  matrices all grow with the vocabulary, so this drops terms that
+#
+#    - occur in fewer than --min_df documents
+#    - occur in more than --max_df (a fraction) of the documents
+#    - are not among the --max_vocab most frequent remaining terms
+#
+#  Document frequencies and token counts are gathered in one streaming
+#  pass over the preprocessed file, and a second pass writes the pruned
+#  file, keeping every line (a document may become empty) so that rows
+#  still line up with the document store. The number of types and tokens
+#  removed by each criterion is written to --report and printed.
+#
+#  The corpus profile (corpus_profile.py) estimates the effect of
+#  min_df cutoffs, to help choose one.
+#
+#  Example:
+#    python prune_vocabulary.py
+#      --input    /path/to/modeling/processed/analysis_preprocessed.txt
+#      --output   /path/to/modeling/processed/analysis_pruned.txt
+#      --min_df   2
+#      --max_df   0.5
+#      --report   /path/to/modeling/processed/analysis_pruned.json
+#
+################################################################
+import argparse
+import json
+import os
+import sys
+from collections import Counter
+
+
+def count_terms(path):
+    # Document frequency and token count of every term, and the number of documents, in one pass
+    df     = Counter()
+    counts = Counter()
+    docs   = 0
+    with open(path, encoding='utf-8', errors='replace') as f:
+        for line in f:
+            fields = line.rstrip('\r\n').split('\t', 2)
+            tokens = fields[2].split() if len(fields) > 2 else []
+            counts.update(tokens)
+            df.update(set(tokens))
+            docs  += 1
+    return df, counts, docs
+
+
+def choose_vocabulary(df, counts, num_docs, min_df=1, max_df=1.0, max_vocab=0):
+    '''
+    The terms to keep, and a report of the types and tokens each criterion removes
+    (applied in order: min_df, then max_df, then the max_vocab cap on what is left).
+    '''
+    removed = {}
+    def drop(reason, terms):
+        removed[reason] = {'types': len(terms), 'tokens': sum(counts[t] for t in terms)}
+        return terms
+
+    too_rare   = drop('min_df', {t for t, n in df.items() if n < min_df})
+    max_docs   = max_df * num_docs
+    too_common = drop('max_df', {t for t, n in df.items() if n > max_docs and t not in too_rare})
+    keep       = [t for t in df if t not in too_rare and t not in too_common]
+    if max_vocab and len(keep) > max_vocab:
+        keep.sort(key=lambda t: (-counts[t], -df[t], t))
+        drop('max_vocab', set(keep[max_vocab:]))
+        keep = keep[:max_vocab]
+    else:
+        drop('max_vocab', set())
+
+    total_tokens = sum(counts.values())
+    kept_tokens  = sum(counts[t] for t in keep)
+    report = {'documents':      num_docs,
+              'min_df':         min_df,
+              'max_df':         max_df,
+              'max_vocab':      max_vocab,
+              'types_before':   len(df),
+              'types_after':    len(keep),
+              'tokens_before':  total_tokens,
+              'tokens_after':   kept_tokens,
+              'removed':        removed}
+    return set(keep), report
+
+
+def write_pruned(input_path, output_path, keep):
+    # Writes INPUT_PATH to OUTPUT_PATH with only the terms in KEEP; returns the number of documents left empty
+    emptied = 0
+    tmpname = output_path + '.tmp'
+    with open(input_path, encoding='utf-8', errors='replace') as fin, open(tmpname, 'w', encoding='utf-8') as fout:
+        for line in fin:
+            fields = line.rstrip('\r\n').split('\t', 2)
+            if len(fields) < 3:
+                fout.write(line if line.endswith('\n') else line + '\n')
+                continue
+            tokens = fields[2].split()
+            kept   = [t for t in tokens if t in keep]
+            if tokens and not kept:
+                emptied += 1
+            fout.write("{}\t{}\t{}\n".format(fields[0], fields[1], ' '.join(kept)))
+    os.replace(tmpname, output_path)
+    return emptied
+
+
+def summary_text(report):
+    lines = []
+    add   = lines.append
+    add("Vocabulary pruning: {} -> {} types, {} -> {} tokens ({:.1%} of tokens removed)".format(
+        report['types_before'], report['types_after'], report['tokens_before'], report['tokens_after'],
+        1 - report['tokens_after'] / max(1, report['tokens_before'])))
+    for reason, setting in [('min_df', report['min_df']), ('max_df', report['max_df']), ('max_vocab', report['max_vocab'])]:
+        r = report['removed'][reason]
+        add("  {:<9} {:<6} removed {} types, {} tokens".format(reason, setting, r['types'], r['tokens']))
+    add("  Documents left empty: {}".format(report['documents_emptied']))
+    return "\n".join(lines) + "\n"
+
+
+def prune(input_path, output_path, min_df=1, max_df=1.0, max_vocab=0, report_path=None):
+    df, counts, num_docs = count_terms(input_path)
+    keep, report = choose_vocabulary(df, counts, num_docs, min_df, max_df, max_vocab)
+    report['documents_emptied'] = write_pruned(input_path, output_path, keep)
+    if report_path:
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=2)
+    sys.stderr.write(summary_text(report))
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Drop rare, overly common or excess terms from a preprocessed docID<tab>label<tab>text file')
+    parser.add_argument('--input',     required=True, help='Preprocessed documents')
+    parser.add_argument('--output',    required=True, help='Pruned documents to write')
+    parser.add_argument('--min_df',    type=int,   default=1,   help='Drop terms in fewer than this many documents')
+    parser.add_argument('--max_df',    type=float, default=1.0, help='Drop terms in more than this fraction of the documents')
+    parser.add_argument('--max_vocab', type=int,   default=0,   help='Keep at most this many of the most frequent terms (0 = no cap)')
+    parser.add_argument('--report',    default=None, help='JSON report of the types and tokens removed')
+    args = parser.parse_args()
+    if not 0 < args.max_df <= 1:
+        parser.error('--max_df must be a fraction of the documents, in (0, 1]')
+    prune(args.input, args.output, args.min_df, args.max_df, args.max_vocab, args.report)
+    sys.stderr.write("Wrote {}\n".format(args.output))
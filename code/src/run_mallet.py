@@ -1,7 +1,13 @@
 ################################################################
 # Python driver for topic modeling and creating visualizations.
 #
-#   Currently just handles MALLET.
+#   Handles MALLET, and in-process NumPy backends that take the same
+#   train-topics options and write the same files:
+#     --package gibbs   collapsed Gibbs sampling (lda_gibbs.py)
+#     --package online  online variational Bayes over minibatches, for
+#                       corpora too large for memory (lda_online.py)
+#     --package anchor  anchor-word spectral method, fast for trying many
+#                       granularities (lda_anchor.py)
 #   Planning to extend to handle other packages.
 #
 #   Note: change default values at top for your local install.
@@ -10,6 +16,51 @@
 #   cmd is constructed using commandline arguments. Be careful
 #   about this from a security perspective!
 #
+#   train-topics progress (iteration, LL/token, tokens/sec, ETA) is shown
+#   as it runs and recorded in MODELDIR/MODELNAME.train-metrics.json;
+#   a failed train-topics fails the run. A model reused from --model_store
+#   keeps the metrics of the run that trained it, marked reused_from_store,
+#   with that run's time as stored_elapsed_seconds.
+#
+#   With --convergence_tolerance T, training stops early once LL/token
+#   changes by less than T (relative) between checks --segment_iterations
+#   apart, with --numiterations as the cap. MALLET is run in segments of
+#   that many iterations, each continuing from the previous one's
+#   --output-state via --input-state; the gibbs backend checks in-process.
+#   The iterations used are recorded in the metrics file.
+#
+#   With --warm_start STATE (a previous run's MODELNAME.topic-state.gz),
+#   training on a refreshed corpus continues from the previous model
+#   instead of random assignments (see warm_start.py), for
+#   --warm_start_iterations instead of --numiterations. Topic numbers
+#   carry over; how far each topic moved is written to
+#   MODELDIR/MODELNAME.warm-start.json. mallet and gibbs only.
+#
+#   --output_profile chooses which train-topics outputs are written, since
+#   the state file and the dense topic-word weights dominate the time spent
+#   writing output for large vocabularies:
+#     curation   doc-topics, topic keys and word-topic counts: all that
+#                model2csv and the curation materials need
+#     inference  curation, plus the model and inferencer (infer_topics.py)
+#     full       everything, including the state (needed by --warm_start
+#                in a later run) and the topic-word weights (default)
+#   --keep_state writes the state whatever the profile. The beta training
+#   started from is recorded in the metrics file, so that model2csv.py and
+#   the sweeps smooth with it when train-topics never reports one.
+#
+#   The MALLET instance file (--instances, by default WORKDIR/MODELNAME.mallet)
+#   is shared by every granularity. It is imported only when it is missing
+#   or was made from other documents (MODELNAME.mallet.source.json records
+#   which), and is written under a temporary name and renamed into place, so
+#   models trained at the same time never read a half-written file.
+#   --import_only just does the import (driver.py's import stage).
+#
+#   With --raw_docs, preprocessing output is streamed: each line is put in
+#   MALLET's 3-column format as it arrives and goes both to the
+#   --preprocessed_docs file and to `mallet import-file --input -`, so the
+#   corpus is never held in memory or written twice. driver.py's preprocess
+#   stage does this for MALLET when the vocabulary isn't pruned afterwards.
+#
 #   Note: If you encounter encoding errors, try using
 #   'iconv -f windows-1252 -t utf-8 -c' on the offending file.
 #
@@ -20,10 +71,18 @@
 #  from traceback_with_variables import activate_by_import
 
 import argparse
+import codecs
+import shlex
+import shutil
+import subprocess
 import tempfile
 import os
 import sys
-import pandas as pd
+import json
+import model_store
+import mallet_utils
+import topic_model_io
+import warm_start
 
 ################################################################
 # Default values. Edit for your local installation if needed.
@@ -36,13 +95,31 @@ default_model2csv            =  './model2csv.py'
 default_word_topics_file     =  './word_topics.csv'
 default_document_topics_file =  './document_topics.csv'
 default_optimize_interval    =  10
+default_beta                 =  0.01  # train-topics' default --beta, and the in-process backends'
+mallet_optimize_burnin       =  200   # MALLET's default --optimize-burn-in
+
+# train-topics outputs, by option and file suffix, and those each --output_profile writes
+output_files                 =  {'output-model':            'model',
+                                 'output-doc-topics':       'doc-topics',
+                                 'output-topic-keys':       'topic-keys',
+                                 'output-state':            'topic-state.gz',
+                                 'inferencer-filename':     'inferencer',
+                                 'word-topic-counts-file':  'word-topic-counts',
+                                 'topic-word-weights-file': 'topic-word-weights'}
+output_profiles              =  {'curation':  ['output-doc-topics', 'output-topic-keys', 'word-topic-counts-file'],
+                                 'inference': ['output-doc-topics', 'output-topic-keys', 'word-topic-counts-file',
+                                               'output-model', 'inferencer-filename'],
+                                 'full':      list(output_files)}
+
+# In-process backends: script run in place of `mallet train-topics`, reading the preprocessed file directly
+python_backends              =  {'gibbs': 'lda_gibbs.py', 'online': 'lda_online.py', 'anchor': 'lda_anchor.py'}
 
 ################################################################
 # Handle command line
 ################################################################
 parser = argparse.ArgumentParser(description='Driver to run topic modeling')
 parser.add_argument('-p','--package',
-                        help='Topic model package: scholar, mallet, segan',             dest='package',      default='mallet')
+                        help='Topic model package: mallet, or gibbs, online or anchor (NumPy, no JVM)', dest='package', default='mallet')
 parser.add_argument('-W','--workdir',
                         help='Directory to contain preprocessed/imported files',        dest='workdir',      default=None)
 parser.add_argument('-m','--modeldir',
@@ -54,10 +131,24 @@ parser.add_argument('-r','--raw_docs',
 parser.add_argument('-d','--preprocessed_docs',
                         help='File containing preprocessed documents one per line. ' \
                         'If RAW_DOCS is provided instead, this file is created',        dest='preprocessed_docs',      default=None)
+parser.add_argument('-S','--docstore',
+                        help='Document store (see docstore.py) holding the raw documents. ' \
+                        'If provided, model2csv fetches text from it instead of a copy of RAW_DOCS', dest='docstore', default=None)
+parser.add_argument('--instances',
+                        help='MALLET instance file for PREPROCESSED_DOCS, shared by every granularity; imported only if ' \
+                        'missing or made from other documents (default: WORKDIR/MODELNAME.mallet)', dest='instances', default=None)
+parser.add_argument('--import_only', action='store_true',
+                        help='Import PREPROCESSED_DOCS to the instance file and exit (mallet only)', dest='import_only')
 parser.add_argument('-w','--word_topics_file',
                         help='Path to output CSV file for topic-words distribution',    dest='word_topics_file',       default=default_word_topics_file)
 parser.add_argument('-D','--document_topics_file',
                         help='Path to output CSV file for doc-topics distribution',     dest='document_topics_file',   default=default_document_topics_file)
+parser.add_argument('--topic_word_npz',
+                        help='Also save sparse topic-word distributions here (see sparse_topic_word.py)', dest='topic_word_npz', default=None)
+parser.add_argument('--npy_dir',
+                        help='Also write the curation arrays (topic_word.npy, doc_topic.npy, vocab.txt) here', dest='npy_dir', default=None)
+parser.add_argument('--skip_csv', action='store_true',
+                        help='With --npy_dir, skip the word_topics and document_topics CSV files', dest='skip_csv')
 parser.add_argument('-b','--mallet_bin',
                         help='Path to mallet bin',                                      dest='mallet_bin',             default=default_mallet_bin)
 parser.add_argument('-P','--preprocessing',
@@ -70,6 +161,41 @@ parser.add_argument('-k','--numtopics',
                         help='Number of topics',                                        dest='numtopics',              default=10)
 parser.add_argument('-i','--numiterations',
                         help='Number of iterations',                                    dest='numiterations',          default=1000)
+parser.add_argument('--model_store',
+                        help='Shared model store directory (see model_store.py). If set, identical models ' \
+                        'are reused from the store instead of retrained',                dest='model_store',            default=None)
+parser.add_argument('--model_store_max_gb',
+                        help='Size cap for the model store in GB; least recently used models are evicted', dest='model_store_max_gb', default=20)
+parser.add_argument('-t','--num_threads',
+                        help='MALLET train-topics threads, or "auto" to size from cores and corpus size ' \
+                        '(default: $MALLET_THREADS if set, else auto)',                 dest='num_threads',            default=None)
+parser.add_argument('--mallet_memory',
+                        help='JVM heap for MALLET, e.g. 4g, or "auto" to size from corpus size and RAM ' \
+                        '(default: $MALLET_MEMORY if set, else auto). Doubled and retried on OutOfMemoryError', dest='mallet_memory', default=None)
+parser.add_argument('--passes',
+                        help='Passes over the corpus (online only; replaces --numiterations)', dest='passes',      default=1)
+parser.add_argument('--batch_size',
+                        help='Documents per minibatch (online only)',                   dest='batch_size',             default=1024)
+parser.add_argument('--max_vocab',
+                        help='Vocabulary size cap (anchor only)',                       dest='max_vocab',              default=5000)
+parser.add_argument('--convergence_tolerance',
+                        help='Stop training once LL/token changes by less than this fraction between ' \
+                        'checks (mallet and gibbs; 0 always runs NUMITERATIONS)',    dest='convergence_tolerance',  default=0)
+parser.add_argument('--segment_iterations',
+                        help='Iterations between convergence checks',                   dest='segment_iterations',     default=100)
+parser.add_argument('--warm_start',
+                        help='Previous run\'s MODELNAME.topic-state.gz to continue from on a refreshed ' \
+                        'corpus (mallet and gibbs)',                                    dest='warm_start',             default=None)
+parser.add_argument('--warm_start_iterations',
+                        help='Iterations when warm-starting, used instead of --numiterations', dest='warm_start_iterations', default=200)
+parser.add_argument('--optimize_interval',
+                        help='Iterations between hyperparameter optimizations (0 = keep alpha and beta fixed)', dest='optimize_interval', default=default_optimize_interval)
+parser.add_argument('--output_profile',
+                        help='Which outputs to write: curation, inference or full',     dest='output_profile',         default='full',
+                        choices=sorted(output_profiles))
+parser.add_argument('--keep_state',
+                        help='Also write the state, for a later run\'s --warm_start, whatever the profile',
+                        dest='keep_state',             action='store_true')
 parser.add_argument('-x','--extra_args',
                         help='Command-line flags to add to topic modeling command. ' \
                         'For example: -x "--random-seed 42 --beta 0.1"',                dest='extra_args',             default='')
@@ -81,9 +207,15 @@ workdir               = args['workdir']
 modeldir              = args['modeldir']
 raw_docs              = args['raw_docs']
 preprocessed_docs     = args['preprocessed_docs']
+instances             = args['instances']
+import_only           = args['import_only']
+docstore              = args['docstore']
 modelname             = args['modelname']
 word_topics_file      = args['word_topics_file']
 document_topics_file  = args['document_topics_file']
+topic_word_npz        = args['topic_word_npz']
+npy_dir               = args['npy_dir']
+skip_csv              = args['skip_csv']
 mallet_bin            = args['mallet_bin']
 preprocessing         = args['preprocessing']
 model2csv             = args['model2csv']
@@ -91,6 +223,20 @@ stoplist              = args['stoplist']
 numtopics             = args['numtopics']
 numiterations         = args['numiterations']
 extra_args            = args['extra_args']
+passes                = int(args['passes'])
+batch_size            = int(args['batch_size'])
+max_vocab             = int(args['max_vocab'])
+convergence_tolerance = float(args['convergence_tolerance'])
+segment_iterations    = int(args['segment_iterations'])
+warm_start_state      = args['warm_start']
+warm_start_iterations = int(args['warm_start_iterations'])
+output_profile        = args['output_profile']
+keep_state            = args['keep_state']
+optimize_interval     = int(args['optimize_interval'])
+model_store_dir       = args['model_store']
+model_store_max_gb    = float(args['model_store_max_gb'])
+num_threads           = args['num_threads']   or os.environ.get('MALLET_THREADS', 'auto')
+mallet_memory         = args['mallet_memory'] or os.environ.get('MALLET_MEMORY',  'auto')
 
 if args['workdir'] is None :
     parser.error('Required arguments: --workdir. Use -h to see detailed usage info.')
@@ -100,49 +246,175 @@ if args['modeldir'] is None:
 if preprocessed_docs is None and raw_docs is None:
     parser.error('Either --preprocessed_docs or --raw_docs is required. Use -h to see detailed usage info.')
     sys.exit(1)
-if (package != 'mallet'):
+if (package != 'mallet' and package not in python_backends):
     sys.stderr.write("Not yet handling package '{}'\n".format(package))
     sys.exit(1)
     
+################################################################
+# Helpers
+################################################################
+def three_column_lines(lines, label):
+    # MALLET's 3-column format, docID<tab>label<tab>text, numbering docIDs sequentially from 1
+    for docid, line in enumerate(lines, 1):
+        yield "{}\t{}\t{}\n".format(docid, label, line.rstrip('\r\n'))
+
+
+def instances_source(docs):
+    # What an instance file was imported from, recorded next to it
+    stat = os.stat(docs)
+    return {'documents': os.path.abspath(docs), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def instances_current(importfile, docs):
+    # Whether IMPORTFILE was imported from DOCS as it is now
+    try:
+        with open(importfile + '.source.json') as f:
+            return os.path.exists(importfile) and json.load(f) == instances_source(docs)
+    except (OSError, ValueError):
+        return False
+
+
+def finish_import(tmpname, importfile, docs):
+    # Renames a completed import into place, so a train-topics reading IMPORTFILE never sees it half-written
+    os.replace(tmpname, importfile)
+    source_tmpname = "{}.source.json.{}.tmp".format(importfile, os.getpid())
+    with open(source_tmpname, 'w') as f:
+        json.dump(instances_source(docs), f)
+    os.replace(source_tmpname, importfile + '.source.json')
+
+
+def train_topics_option(extra_args, option, option_type, default):
+    # The value train-topics gets for OPTION (e.g. '--beta'): from EXTRA_ARGS, or DEFAULT
+    option_parser = argparse.ArgumentParser(add_help=False)
+    option_parser.add_argument(option, dest='value', type=option_type, default=default)
+    return option_parser.parse_known_args(shlex.split(extra_args))[0].value
+
+
+def mark_reused(metrics_file, store_key):
+    # A stored model's metrics describe the run that trained it: say so, and that this run spent no time training.
+    # Rewritten under a new name and renamed into place, since the linked file is also the store's copy.
+    if not os.path.exists(metrics_file):
+        return
+    with open(metrics_file) as f:
+        metrics = json.load(f)
+    metrics.update({'reused_from_store':      store_key,
+                    'stored_elapsed_seconds': metrics.get('elapsed_seconds'),
+                    'elapsed_seconds':        0})
+    tmpname = "{}.{}.tmp".format(metrics_file, os.getpid())
+    with open(tmpname, 'w') as f:
+        json.dump(metrics, f, indent=2)
+    os.replace(tmpname, metrics_file)
+
+
+def tee_to_file(lines, path):
+    # Passes LINES through unchanged, writing each one to PATH as it goes
+    with open(path, 'w', encoding='utf-8') as f:
+        for line in lines:
+            f.write(line)
+            yield line
+
+
 ################################################################
 # Main
 ################################################################
+import_template = "{}/mallet import-file --input {} --output {} --token-regex '\\S+' --preserve-case --keep-sequence"
+importfile      = instances or "{}/{}.mallet".format(workdir, modelname)
+import_tmpname  = "{}.{}.tmp".format(importfile, os.getpid())
+imported        = False
 
 # If raw documents are provided, do preprocessing
 if raw_docs is not None:
     
-    # Run preprocessing, collect output
+    # Run preprocessing, streaming its output in 3-column format (using modelname as label)
+    # to the preprocessed docs file and, for MALLET, to import-file at the same time
     # Note: optional arg --emptyline 'contents" can be used to make sure preproc docs have no blank lines 
-    tempfile_fp    = tempfile.NamedTemporaryFile()
-    tempfile_name  = tempfile_fp.name
-    template       = "python {} --stoplist {} --infile {} > {}"
-    cmd            = template.format(preprocessing, stoplist, raw_docs, tempfile_name)
+    cmd     = "python {} --stoplist {} --infile {}".format(preprocessing, stoplist, raw_docs)
     sys.stderr.write("Running: {}\n".format(cmd))
-    os.system(cmd)
-
-    # Convert to mallet 3-column format: docID<tab>label<tab>text, using modelname as label and numbering docIDs sequentially
-    # Then clean up temporary file
-    sys.stderr.write("Converting {} to 3-column format and writing to {}\n".format(tempfile_name, preprocessed_docs))
-
-    # Commenting out version where pd.read_csv was used to create dataframe
-    # Instead, just reading lines from the file as strings into a fresh dataframe
-    # docs_df  = pd.read_csv(tempfile_name, sep='\t', encoding='utf-8', header=None, engine='python', on_bad_lines='warn', skip_blank_lines = False)
-    with open(tempfile_name, 'r') as file:
-          lines = file.read().splitlines()
-    docs_df = pd.DataFrame(lines, columns=['text'])
-    docs_df.insert(loc = 0, column = 'modelname', value = modelname)
-    docs_df.insert(loc = 0, column = 'docID',     value = [x+1 for x in range(len(docs_df.index))])
-    docs_df.to_csv(preprocessed_docs, sep='\t', index=False, header=False)
+    preproc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, text=True, encoding='utf-8', errors='replace')
+    lines   = tee_to_file(three_column_lines(preproc.stdout, modelname), preprocessed_docs)
+    if package in python_backends:
+        for _ in lines:
+            pass
+    else:
+        # The preprocessed corpus is smaller than the raw one, so this heap is enough
+        memory   = mallet_memory if mallet_memory != 'auto' else mallet_utils.auto_memory(os.path.getsize(raw_docs))
+        cmd      = import_template.format(mallet_bin, '-', import_tmpname)
+        imported = mallet_utils.run_mallet_with_input(cmd, memory, lines) == 0
+    if preproc.wait() != 0:
+        sys.stderr.write("Error: preprocessing exited with status {}\n".format(preproc.returncode))
+        sys.exit(1)
     sys.stderr.write("Done writing to {}\n".format(preprocessed_docs))
+    if imported:
+        finish_import(import_tmpname, importfile, preprocessed_docs)
+    if package not in python_backends and not imported:
+        sys.stderr.write("Streaming import failed; importing from {} instead\n".format(preprocessed_docs))
+
+# Size MALLET threads and JVM heap to the corpus unless given explicitly
+corpus_bytes = os.path.getsize(preprocessed_docs)
+if num_threads == 'auto':
+    num_threads = mallet_utils.auto_threads(corpus_bytes)
+if package in python_backends:
+    # No JVM; threads become sampler processes
+    mallet_memory = None
+elif mallet_memory == 'auto':
+    mallet_memory = mallet_utils.auto_memory(corpus_bytes, numtopics)
+sys.stderr.write("{} threads: {}, heap: {} (preprocessed corpus {:.1f} MB)\n".format(package, num_threads, mallet_memory or '-', corpus_bytes / 1e6))
 
-    tempfile_fp.close()
+if package in python_backends:
+    # The backend reads the preprocessed documents itself
+    train_topics = "python {}".format(os.path.join(os.path.dirname(os.path.abspath(__file__)), python_backends[package]))
+    importfile   = preprocessed_docs
+else:
+    # Import preprocessed documents, unless that was done while preprocessing or, for another
+    # granularity, from the same documents (e.g. by driver.py's import stage)
+    if not imported and instances_current(importfile, preprocessed_docs):
+        sys.stderr.write("Using {}, already imported from {}\n".format(importfile, preprocessed_docs))
+    elif not imported:
+        cmd = import_template.format(mallet_bin, preprocessed_docs, import_tmpname)
+        if mallet_utils.run_mallet_command(cmd, mallet_memory) != 0:
+            if os.path.exists(import_tmpname):
+                os.remove(import_tmpname)
+            sys.stderr.write("Error: mallet import-file failed. Exiting.\n")
+            sys.exit(1)
+        finish_import(import_tmpname, importfile, preprocessed_docs)
+    train_topics = "{}/mallet train-topics".format(mallet_bin)
+if import_only:
+    if package in python_backends:
+        sys.stderr.write("Nothing to import: package {} reads {} itself\n".format(package, preprocessed_docs))
+    sys.exit(0)
 
-# Import preprocessed documents 
-importfile = "{}/{}.mallet".format(workdir, modelname)
-template   = "{}/mallet import-file --input {} --output {} --token-regex '\\S+' --preserve-case --keep-sequence"
-cmd        = template.format(mallet_bin, preprocessed_docs, importfile)
-sys.stderr.write("Running: {}\n".format(cmd))
-os.system(cmd)
+# Options only the online and anchor backends take. The online checkpoint lives
+# in workdir, outside modeldir, so an interrupted run can be resumed; the anchor
+# co-occurrence cache is shared by every granularity.
+backend_args = ''
+if package == 'online':
+    checkpoint   = "{}/{}.k{}.online-checkpoint.npz".format(workdir, modelname, numtopics)
+    backend_args = "--passes {} --batch-size {} --checkpoint {}".format(passes, batch_size, checkpoint)
+elif package == 'anchor':
+    cooccurrence = "{}/{}.anchor-cooccurrence.npz".format(workdir, modelname)
+    backend_args = "--max-vocab {} --cooccurrence-cache {}".format(max_vocab, cooccurrence)
+elif package == 'gibbs' and convergence_tolerance:
+    backend_args = "--convergence-tolerance {} --convergence-interval {}".format(convergence_tolerance, segment_iterations)
+if convergence_tolerance and package not in ('mallet', 'gibbs'):
+    sys.stderr.write("Warning: --convergence_tolerance is ignored for package {}\n".format(package))
+    convergence_tolerance = 0
+
+# Warm start: continue from a previous run's state, which is already past burn-in
+optimize_burnin = mallet_optimize_burnin
+if warm_start_state:
+    if package not in ('mallet', 'gibbs'):
+        sys.stderr.write("Warning: --warm_start is ignored for package {}\n".format(package))
+        warm_start_state = None
+    elif not os.path.exists(warm_start_state):
+        sys.stderr.write("Warning: no previous state {}; training from scratch\n".format(warm_start_state))
+        warm_start_state = None
+    elif warm_start.state_num_topics(warm_start_state) != int(numtopics):
+        sys.stderr.write("Warning: previous state {} has {} topics, not {}; training from scratch\n".format(
+            warm_start_state, warm_start.state_num_topics(warm_start_state), numtopics))
+        warm_start_state = None
+if warm_start_state:
+    numiterations   = warm_start_iterations
+    optimize_burnin = 0
 
 # Create topic model
 # For details on parameters: malletbin/mallet train-topics --help
@@ -150,56 +422,161 @@ if (os.path.isdir(modeldir)):
     sys.stderr.write("Error: can't create model directory {} because it already exists. Exiting.\n".format(modeldir))
     sys.exit(3)
 os.mkdir(modeldir)
-template = "{}/mallet train-topics " \
+# MALLET's convergence segments continue from each other's state, so it is written
+# whatever the profile, and removed afterwards if the profile doesn't include it
+profile_outputs = list(output_profiles[output_profile])
+if keep_state and 'output-state' not in profile_outputs:
+    profile_outputs.append('output-state')
+outputs = list(profile_outputs)
+if convergence_tolerance and package == 'mallet' and 'output-state' not in outputs:
+    outputs.append('output-state')
+template = "{}" \
    " --input {}" \
    " --num-topics {}" \
    " --optimize-interval {}" \
    " --num-iterations {}" \
-   " {}" \
-   " --output-model             MODELDIR/MODELNAME.model" \
-   " --output-doc-topics        MODELDIR/MODELNAME.doc-topics" \
-   " --output-topic-keys        MODELDIR/MODELNAME.topic-keys" \
-   " --output-state             MODELDIR/MODELNAME.topic-state.gz" \
-   " --inferencer-filename      MODELDIR/MODELNAME.inferencer" \
-   " --word-topic-counts-file   MODELDIR/MODELNAME.word-topic-counts" \
-   " --topic-word-weights-file  MODELDIR/MODELNAME.topic-word-weights"
-template = template.format(mallet_bin, importfile, numtopics, default_optimize_interval, numiterations, extra_args)
+   " --num-threads {}" \
+   " {} {}"
+template += ''.join(" --{} MODELDIR/MODELNAME.{}".format(option, output_files[option]) for option in outputs)
+template = template.format(train_topics, importfile, numtopics, optimize_interval, 'NUMITERATIONS', num_threads, backend_args, extra_args)
 template = template.replace('MODELDIR',  modeldir)
 template = template.replace('MODELNAME', modelname)
-cmd      = ' '.join(template.split()) # Multiple spaces in string -> single space
-sys.stderr.write("Running: {}\n".format(cmd))
-os.system(cmd)
+template = ' '.join(template.split()) # Multiple spaces in string -> single space
+cmd      = template.replace('NUMITERATIONS', str(numiterations))
+
+# With a model store, an identical corpus and parameter set trained before
+# (possibly under another modelname or rootdir) is linked in rather than retrained
+store_key = None
+if model_store_dir:
+    store_params = {'package':           package,
+                    'numtopics':         int(numtopics),
+                    'numiterations':     int(numiterations),
+                    'optimize_interval': optimize_interval,
+                    'num_threads':       int(num_threads),
+                    'extra_args':        ' '.join(extra_args.split())}
+    if package == 'online':
+        store_params.update({'passes': passes, 'batch_size': batch_size})
+    elif package == 'anchor':
+        store_params.update({'max_vocab': max_vocab})
+    if convergence_tolerance:
+        store_params.update({'convergence_tolerance': convergence_tolerance, 'segment_iterations': segment_iterations})
+    if warm_start_state:
+        store_params.update({'warm_start': warm_start.state_digest(warm_start_state)})
+    if output_profile != 'full':
+        store_params.update({'output_profile': output_profile})
+    if keep_state and 'output-state' not in output_profiles[output_profile]:
+        store_params.update({'keep_state': True})
+    store_key    = model_store.model_key(preprocessed_docs, store_params)
+metrics_file = "{}/{}.train-metrics.json".format(modeldir, modelname)
+if store_key and model_store.lookup(model_store_dir, store_key, modeldir, modelname):
+    sys.stderr.write("Reusing stored model for {} topics, skipping train-topics\n".format(numtopics))
+    mark_reused(metrics_file, store_key)
+else:
+    # Progress, throughput and ETA as train-topics runs; the LL/token series goes to the metrics file.
+    # The online backend reports once per pass and the anchor backend has no iterations.
+    total_iterations = {'online': passes, 'anchor': None}.get(package, int(numiterations))
+    monitor          = mallet_utils.TrainingMonitor("K={}".format(numtopics), total_iterations, metrics_file,
+                                                    train_topics_option(extra_args, '--beta', float, default_beta))
+    initial_state    = None
+    if warm_start_state:
+        initial_state = "{}/{}.k{}.warm-start-state.gz".format(workdir, modelname, numtopics)
+        seeded        = warm_start.seed_state(warm_start_state, preprocessed_docs, initial_state,
+                                              train_topics_option(extra_args, '--random-seed', int, 0))
+    if convergence_tolerance and package == 'mallet':
+        # Each segment continues from the last one's state and writes the full set of outputs,
+        # so whichever segment turns out to be the last leaves a complete model behind
+        segment_state = "{}/{}.k{}.segment-state.gz".format(workdir, modelname, numtopics)
+        output_state  = "{}/{}.topic-state.gz".format(modeldir, modelname)
+        done, previous_ll, status = 0, None, 0
+        while done < int(numiterations):
+            iterations = min(segment_iterations, int(numiterations) - done)
+            segment    = template.replace('NUMITERATIONS', str(iterations))
+            # The segment's iteration count restarts at 1, so burn-in is what remains of MALLET's
+            segment   += " --optimize-burn-in {}".format(max(0, optimize_burnin - done))
+            if done:
+                segment += " --input-state {}".format(segment_state)
+            elif initial_state:
+                segment += " --input-state {}".format(initial_state)
+            monitor.start_segment(done)
+            status = mallet_utils.run_mallet_command(segment, mallet_memory, on_line=monitor)
+            if status != 0:
+                break
+            done += iterations
+            monitor.iteration = done
+            shutil.copyfile(output_state, segment_state)
+            ll = monitor.last_ll_per_token()
+            if mallet_utils.has_converged(previous_ll, ll, convergence_tolerance):
+                monitor.converged = True
+                break
+            previous_ll = ll
+        if os.path.exists(segment_state):
+            os.remove(segment_state)
+        if 'output-state' not in profile_outputs and os.path.exists(output_state):
+            os.remove(output_state)
+    else:
+        if initial_state:
+            cmd += " --optimize-burn-in {} --input-state {}".format(optimize_burnin, initial_state)
+        status = mallet_utils.run_mallet_command(cmd, mallet_memory, on_line=monitor)
+    if convergence_tolerance and status == 0:
+        monitor.converged = bool(monitor.converged)
+        if monitor.converged:
+            sys.stderr.write("K={}: converged after {} of at most {} iterations\n".format(numtopics, monitor.iteration, numiterations))
+        else:
+            sys.stderr.write("K={}: did not converge within {} iterations\n".format(numtopics, numiterations))
+    monitor.finish(status)
+    if status != 0:
+        sys.stderr.write("Error: train-topics for {} topics exited with status {}. Exiting.\n".format(numtopics, status))
+        sys.exit(1)
+    if initial_state:
+        # How far each topic moved from the previous run's topic of the same number
+        vocab, counts = topic_model_io.read_word_topic_counts("{}/{}.word-topic-counts".format(modeldir, modelname), int(numtopics))
+        report = {key: value for key, value in seeded.items() if key not in ('previous_vocab', 'previous_counts')}
+        report['iterations'] = int(numiterations)
+        report['topics']     = warm_start.compare_topics(seeded['previous_vocab'], seeded['previous_counts'], vocab, counts)
+        with open("{}/{}.warm-start.json".format(modeldir, modelname), 'w') as f:
+            json.dump(report, f, indent=2)
+        moved = [t['topic'] for t in report['topics'] if t['closest_previous'] != t['topic']]
+        sys.stderr.write("Warm start: {} of {} topics are now closest to a different previous topic{}\n".format(
+            len(moved), numtopics, ": {}".format(' '.join(map(str, moved))) if moved else ''))
+        os.remove(initial_state)
+    if store_key:
+        model_store.insert(model_store_dir, store_key, modeldir, modelname, store_params, int(model_store_max_gb * 1e9))
 
 if (model2csv):
     
   # Convert model output to CSV format
-  if raw_docs:
+  if docstore:
+      # Document text lives in the store, no per-model copy needed
+      docfile = None
+  elif raw_docs:
       # Create 3-column format for raw documents, as expected by model2csv
       docfile_fp  = tempfile.NamedTemporaryFile()
       docfile     = docfile_fp.name
       sys.stderr.write("Converting {} to 3-column format and writing to {}\n".format(raw_docs, docfile))
-      # Commenting out version where pd.read_csv was used to create dataframe
-      # since this is now throwing an error, even after updating to use on_bad_lines.
-      #  # Pandas handling of bad lines changed from < 1.3 to >= 1.3
-      #  # raw_docs_df  = pd.read_csv(raw_docs, sep='\t', encoding='utf-8', header=None, engine='python', warn_bad_lines=True, error_bad_lines=True)
-      #  raw_docs_df  = pd.read_csv(raw_docs, sep='\t', encoding='utf-8', header=None, engine='python', on_bad_lines='warn')
-      # Instead, just reading lines from the file as strings into a fresh dataframe
-      with open(raw_docs, 'r') as file:
-          lines = file.read().splitlines()
-      raw_docs_df = pd.DataFrame(lines, columns=['text'])
-      raw_docs_df.insert(loc = 0, column = 'modelname', value = modelname)
-      raw_docs_df.insert(loc = 0, column = 'docID',     value = [x+1 for x in range(len(raw_docs_df.index))])
-      raw_docs_df.to_csv(docfile, sep='\t', index=False, header=False)
+      # Read the way preprocessing reads it, so raw and preprocessed lines stay aligned
+      with codecs.open(raw_docs, 'r', encoding='utf-8', errors='ignore') as infile, \
+           open(docfile, 'w', encoding='utf-8') as outfile:
+          outfile.writelines(three_column_lines(infile, modelname))
   else:
       # Preprocessed docs file is already in the 3-column format
       docfile = preprocessed_docs
 
-  template = "python {} --package mallet --docfile {} --modeldir {} --modelname {} --word_topics_file {} --document_topics_file {} --vocabfile {}/{}.word-topic-counts"
-  cmd      = template.format(model2csv, docfile, modeldir, modelname, word_topics_file, document_topics_file, modeldir, modelname)
+  template = "python {} --package mallet --modeldir {} --modelname {} --word_topics_file {} --document_topics_file {} --vocabfile {}/{}.word-topic-counts"
+  cmd      = template.format(model2csv, modeldir, modelname, word_topics_file, document_topics_file, modeldir, modelname)
+  if docstore:
+      cmd  = cmd + " --docstore {}".format(docstore)
+  else:
+      cmd  = cmd + " --docfile {}".format(docfile)
+  if topic_word_npz:
+      cmd  = cmd + " --topic_word_npz {}".format(topic_word_npz)
+  if npy_dir:
+      cmd  = cmd + " --npy_dir {}".format(npy_dir)
+      if skip_csv:
+          cmd  = cmd + " --skip_csv"
   sys.stderr.write("Creating CSV files. Running: {}\n".format(cmd))
   os.system(cmd)
 
-  if raw_docs:
+  if raw_docs and not docstore:
       sys.stderr.write("Cleaning up {}\n".format(docfile))
       docfile_fp.close()
 
@@ -0,0 +1,189 @@
+################################################################
+#
+#  Sparse topic-word distributions from MALLET's word-topic counts
+#
+#  Nearly every entry of MALLET's topic-word-weights file is just the
+#  smoothing value beta: a topic-word weight is beta + the number of
+#  tokens of the word assigned to the topic, and most words have no
+#  tokens in most topics. The dense V x K matrix in word_topics.csv and
+#  topic_word.npy grows with the vocabulary times the number of topics.
+#
+#  The sparse word-topic-counts file (typeindex word topic:count ...)
+#  has the same information. SparseTopicWord keeps
+#
+#    - the counts as a K x V CSR matrix, so memory grows with the number
+#      of nonzero counts rather than V x K
+#    - beta per topic, and each topic's normalizer (its total count
+#      plus V * beta)
+#
+#  and computes a topic's probabilities, (count + beta) / normalizer,
+#  or its top words only when they are asked for. Indexing it by topic
+#  gives that topic's dense row, so it can stand in for the K x V
+#  topic_word array in the curation scripts. It is saved as an .npz.
+#
+#  Example:
+#    python sparse_topic_word.py
+#      --counts     /path/to/mallet_output/analysis.word-topic-counts
+#      --modeldir   /path/to/mallet_output
+#      --modelname  analysis
+#      --output     /path/to/curation/topic_word.npz
+#      --top_words  10
+#
+#  Example:  use it from another script in this directory
+#    from sparse_topic_word import SparseTopicWord
+#    topic_word = SparseTopicWord.load('/path/to/curation/topic_word.npz')
+#    words, probs = topic_word.top_words(3, 20)
+#
+################################################################
+import argparse
+import os
+import sys
+
+import numpy as np
+import scipy.sparse as sp
+
+block_lines = 65536
+
+
+def read_word_topic_counts(path, num_topics=None):
+    '''
+    Vocabulary and V x K CSR counts from a word-topic-counts file, one line per word type in
+    type index order. Without NUM_TOPICS, K is one more than the largest topic with a count.
+    '''
+    vocab, indptr, indices, counts = [], [np.zeros(1, dtype=np.int64)], [], []
+    pairs, lengths = [], []
+
+    def flush():
+        # Topic:count pairs of a block of lines, converted in one go
+        if lengths:
+            block = np.array(' '.join(pairs).replace(':', ' ').split(), dtype=np.int64).reshape(-1, 2)
+            indptr.append(indptr[-1][-1] + np.cumsum(lengths))
+            indices.append(block[:, 0].astype(np.int32))
+            counts.append(block[:, 1].astype(np.int32))
+        pairs.clear()
+        lengths.clear()
+
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            fields = line.split()
+            vocab.append(fields[1])
+            pairs.extend(fields[2:])
+            lengths.append(len(fields) - 2)
+            if len(lengths) == block_lines:
+                flush()
+    flush()
+    indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int32)
+    counts  = np.concatenate(counts)  if counts  else np.zeros(0, dtype=np.int32)
+    if num_topics is None:
+        num_topics = int(indices.max()) + 1 if len(indices) else 0
+    return vocab, sp.csr_matrix((counts, indices, np.concatenate(indptr)), shape=(len(vocab), num_topics))
+
+
+class SparseTopicWord:
+    '''
+    Topic-word distributions (count + beta) / (topic total + V * beta), from a V x K (or K x V)
+    sparse count matrix COUNTS and a scalar or per-topic BETA. Shaped like topic_word.npy, K x V.
+    '''
+
+    def __init__(self, vocab, counts, beta, topics_by_words=False):
+        self.vocab       = list(vocab)
+        self.counts      = sp.csr_matrix(counts if topics_by_words else counts.T)
+        K, V             = self.counts.shape
+        self.beta        = np.broadcast_to(np.asarray(beta, dtype=np.float64), (K,)).copy()
+        self.totals      = np.asarray(self.counts.sum(axis=1)).ravel()
+        self.normalizers = self.totals + V * self.beta
+
+    @property
+    def shape(self):
+        return self.counts.shape
+
+    @property
+    def num_topics(self):
+        return self.counts.shape[0]
+
+    def topic(self, k):
+        # Dense probabilities of every word in topic K
+        row = np.full(self.counts.shape[1], self.beta[k])
+        lo, hi = self.counts.indptr[k], self.counts.indptr[k + 1]
+        row[self.counts.indices[lo:hi]] += self.counts.data[lo:hi]
+        return row / self.normalizers[k]
+
+    # Lets it stand in for a K x V topic_word array, one topic at a time
+    __getitem__ = topic
+
+    def probabilities(self, k, words):
+        # Probabilities of the word type indices WORDS in topic K
+        words = np.asarray(words)
+        return (np.asarray(self.counts[k, words].todense()).ravel() + self.beta[k]) / self.normalizers[k]
+
+    def top_words(self, k, n):
+        '''
+        The N most probable words of topic K, as type indices and probabilities, most probable
+        first. Only the topic's nonzero counts are sorted; if it has fewer than N, the rest
+        are zero-count words (all equally probable), in type index order.
+        '''
+        lo, hi  = self.counts.indptr[k], self.counts.indptr[k + 1]
+        words   = self.counts.indices[lo:hi]
+        counts  = self.counts.data[lo:hi]
+        order   = np.lexsort((words, -counts))[:n]
+        top     = words[order]
+        if len(top) < n:
+            unused = np.ones(self.counts.shape[1], dtype=bool)
+            unused[words] = False
+            top = np.concatenate([top, np.flatnonzero(unused)[:n - len(top)]])
+        probs = (np.concatenate([counts[order], np.zeros(len(top) - len(order))]) + self.beta[k]) / self.normalizers[k]
+        return top, probs
+
+    def to_dense(self):
+        # K x V probabilities, as in topic_word.npy
+        return np.vstack([self.topic(k) for k in range(self.num_topics)])
+
+    def save(self, path):
+        # Through a file handle so that np.savez doesn't add .npz to the name
+        with open(path, 'wb') as f:
+            np.savez(f, vocab=np.array(self.vocab, dtype=str), data=self.counts.data, indices=self.counts.indices,
+                     indptr=self.counts.indptr, shape=np.array(self.counts.shape), beta=self.beta)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as npz:
+            counts = sp.csr_matrix((npz['data'], npz['indices'], npz['indptr']), shape=tuple(npz['shape']))
+            return cls(npz['vocab'].tolist(), counts, npz['beta'], topics_by_words=True)
+
+
+def from_word_topic_counts(path, beta, num_topics=None):
+    vocab, counts = read_word_topic_counts(path, num_topics)
+    return SparseTopicWord(vocab, counts, beta)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Sparse topic-word distributions from a MALLET word-topic-counts file, saved as .npz')
+    parser.add_argument('--counts',     required=True, help='MODELNAME.word-topic-counts')
+    parser.add_argument('--output',     required=True, help='.npz file to write')
+    parser.add_argument('--beta',       type=float, default=None, help='Smoothing; by default the last beta MALLET reported for the model')
+    parser.add_argument('--modeldir',   default=None, help='Model directory, for the default beta and number of topics')
+    parser.add_argument('--modelname',  default=None)
+    parser.add_argument('--top_words',  type=int, default=0, help='Also print this many top words per topic')
+    args = parser.parse_args()
+
+    beta, num_topics = args.beta, None
+    if args.modeldir and args.modelname:
+        # Imported here: model2csv.py brings in pandas, which nothing else here needs
+        from model2csv import mallet_beta
+        if beta is None:
+            beta = mallet_beta(args.modeldir, args.modelname)
+        keys = os.path.join(args.modeldir, args.modelname + '.topic-keys')
+        if os.path.exists(keys):
+            with open(keys) as f:
+                num_topics = sum(1 for line in f if line.strip())
+    if beta is None:
+        parser.error('--beta, or --modeldir and --modelname, are needed for the smoothing')
+
+    topic_word = from_word_topic_counts(args.counts, beta, num_topics)
+    topic_word.save(args.output)
+    K, V = topic_word.shape
+    sys.stderr.write("{} topics x {} words, {} nonzero counts ({:.2%}); wrote {}\n".format(
+        K, V, topic_word.counts.nnz, topic_word.counts.nnz / max(1, K * V), args.output))
+    for k in range(K if args.top_words else 0):
+        words, _ = topic_word.top_words(k, args.top_words)
+        print("Topic {}: {}".format(k + 1, ' '.join(topic_word.vocab[w] for w in words)))
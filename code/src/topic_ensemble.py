@@ -0,0 +1,166 @@
+################################################################
+#
+#  Topic stability across an ensemble of runs with different seeds
+#
+#  A topic that only one random seed produces is a poor use of curation
+#  time. Given several runs of the same model (same corpus and number of
+#  topics, different seeds), this aligns their topics and reports how
+#  reproducible each one is:
+#
+#    - every topic of every run is compared with every other by cosine
+#      similarity of their word distributions (word_topics.csv), in one
+#      matrix product over the runs' combined vocabulary
+#    - each pair of runs is aligned one-to-one by Hungarian matching
+#      on those similarities (scipy's linear_sum_assignment)
+#    - a run's centrality is its mean matched similarity to the others;
+#      the most central run is the most typical of the ensemble
+#    - each topic of the reference run (by default the central one) gets
+#      a stability score: its mean matched similarity across the other
+#      runs, with the worst match and the fraction of runs in which it is
+#      reproduced (similarity >= --threshold)
+#
+#  Each run directory holds the word_topics.csv that run_mallet.py wrote
+#  for it. Used by driver.py when ensemble > 1; can also be run on its own.
+#
+#  Example:
+#    python topic_ensemble.py
+#      --runs         /path/to/modeling/model_k20/ensemble/seed_13 /path/to/modeling/model_k20/ensemble/seed_14 ...
+#      --output_json  /path/to/modeling/model_k20/ensemble/ensemble.json
+#      --output_txt   /path/to/modeling/model_k20/ensemble/topic_stability.txt
+#
+################################################################
+import argparse
+import csv
+import json
+import os
+import sys
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+default_threshold = 0.8
+num_top_words     = 10
+
+
+def read_word_topics(path):
+    # Vocabulary and V x K topic-word matrix from a word_topics.csv (Word, Topic 1, ..., Topic K)
+    with open(path, newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        next(reader)
+        vocab, rows = [], []
+        for row in reader:
+            vocab.append(row[0])
+            rows.append(row[1:])
+    return vocab, np.array(rows, dtype=np.float32)
+
+
+def topic_similarities(runs):
+    '''
+    Cosine similarities between all topics of all RUNS (a list of (vocab, V x K matrix)),
+    as one (N*K) x (N*K) matrix with run i's topics in rows and columns i*K .. (i+1)*K-1.
+    '''
+    union   = np.unique(np.concatenate([np.asarray(vocab, dtype=str) for vocab, _ in runs]))
+    columns = []
+    for vocab, matrix in runs:
+        aligned = np.zeros((len(union), matrix.shape[1]), dtype=np.float32)
+        aligned[np.searchsorted(union, np.asarray(vocab, dtype=str))] = matrix
+        columns.append(aligned)
+    M  = np.hstack(columns)
+    M /= np.maximum(np.linalg.norm(M, axis=0), 1e-12)
+    return M.T @ M
+
+
+def match_runs(similarity, num_runs, num_topics):
+    '''
+    Hungarian matching between every pair of runs. Returns MATCH, where MATCH[i][j][k] is the
+    topic of run j aligned with topic k of run i, and SCORE, where SCORE[i][j][k] is their similarity.
+    '''
+    match = np.zeros((num_runs, num_runs, num_topics), dtype=int)
+    score = np.ones((num_runs, num_runs, num_topics))
+    for i in range(num_runs):
+        match[i, i] = np.arange(num_topics)
+        for j in range(i + 1, num_runs):
+            block     = similarity[i * num_topics:(i + 1) * num_topics, j * num_topics:(j + 1) * num_topics]
+            rows, col = linear_sum_assignment(block, maximize=True)
+            match[i, j, rows] = col
+            match[j, i, col]  = rows
+            score[i, j, rows] = block[rows, col]
+            score[j, i, col]  = block[rows, col]
+    return match, score
+
+
+def ensemble_report(run_dirs, reference='central', threshold=default_threshold):
+    runs       = [read_word_topics(os.path.join(d, 'word_topics.csv')) for d in run_dirs]
+    num_topics = runs[0][1].shape[1]
+    bad        = [d for d, (_, matrix) in zip(run_dirs, runs) if matrix.shape[1] != num_topics]
+    if bad:
+        sys.stderr.write("Error: runs do not all have {} topics: {}\n".format(num_topics, ' '.join(bad)))
+        sys.exit(1)
+    num_runs = len(runs)
+    match, score = match_runs(topic_similarities(runs), num_runs, num_topics)
+
+    # Centrality: mean matched similarity to the other runs
+    others     = ~np.eye(num_runs, dtype=bool)
+    pair_means = score.mean(axis=2)
+    centrality = (pair_means * others).sum(axis=1) / max(1, num_runs - 1)
+    central    = int(centrality.argmax())
+    ref        = central if reference == 'central' else int(reference)
+
+    vocab, matrix = runs[ref]
+    stable        = score[ref][others[ref]]            # (N-1) x K matched similarities
+    topics = []
+    for k in range(num_topics):
+        top = np.argsort(-matrix[:, k])[:num_top_words]
+        topics.append({'topic':          k + 1,
+                       'stability':      round(float(stable[:, k].mean()), 4) if num_runs > 1 else None,
+                       'min_similarity': round(float(stable[:, k].min()), 4) if num_runs > 1 else None,
+                       'reproduced':     round(float((stable[:, k] >= threshold).mean()), 4) if num_runs > 1 else None,
+                       'top_words':      [vocab[w] for w in top]})
+    return {'runs':              [os.path.abspath(d) for d in run_dirs],
+            'num_topics':        num_topics,
+            'threshold':         threshold,
+            'centrality':        [round(float(c), 4) for c in centrality],
+            'central_run':       central,
+            'reference_run':     ref,
+            'mean_stability':    round(float(stable.mean()), 4) if num_runs > 1 else None,
+            'topics':            topics,
+            # alignment[j][k]: topic number in run j matching topic k+1 of the reference run
+            'alignment':         (match[ref] + 1).tolist()}
+
+
+def summary_text(report):
+    lines = []
+    add   = lines.append
+    add("Topic stability across {} runs".format(len(report['runs'])))
+    add("================================")
+    for i, (run, c) in enumerate(zip(report['runs'], report['centrality'])):
+        marks = [m for m, j in (('central', report['central_run']), ('reference', report['reference_run'])) if i == j]
+        add("Run {:>2}: centrality {:.3f}  {}{}".format(i + 1, c, run, "  ({})".format(', '.join(marks)) if marks else ''))
+    if report['mean_stability'] is not None:
+        add("Mean topic stability: {:.3f}".format(report['mean_stability']))
+        add("")
+        add("Topics of run {}, least stable first (stability = mean matched cosine similarity;".format(report['reference_run'] + 1))
+        add("reproduced = fraction of other runs with a match of at least {}):".format(report['threshold']))
+        for t in sorted(report['topics'], key=lambda t: t['stability']):
+            add("  Topic {:>3}: stability {:.3f}  min {:.3f}  reproduced {:>4.0%}  {}".format(
+                t['topic'], t['stability'], t['min_similarity'], t['reproduced'], ' '.join(t['top_words'])))
+    return "\n".join(lines) + "\n"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Align topics across runs with different seeds and score their stability')
+    parser.add_argument('--runs',        nargs='+', required=True, help='Run directories, each with a word_topics.csv')
+    parser.add_argument('--reference',   default='central', help='Run whose topics are scored: "central" or a 0-based run index')
+    parser.add_argument('--threshold',   type=float, default=default_threshold, help='Similarity at which a topic counts as reproduced')
+    parser.add_argument('--output_json', required=True)
+    parser.add_argument('--output_txt',  required=True)
+    args = parser.parse_args()
+
+    report = ensemble_report(args.runs, args.reference, args.threshold)
+    with open(args.output_json, 'w') as f:
+        json.dump(report, f, indent=2)
+    text = summary_text(report)
+    with open(args.output_txt, 'w') as f:
+        f.write(text)
+    sys.stderr.write(text)
+    sys.stderr.write("Wrote {} and {}\n".format(args.output_json, args.output_txt))
@@ -0,0 +1,379 @@
+################################################################
+#
+#  Reading corpora and writing topic models in MALLET's file formats
+#
+#  Shared by the in-process topic model backends (lda_gibbs.py, lda_online.py,
+#  lda_anchor.py), so that whatever trains the model, run_mallet.py, model2csv.py
+#  and the curation scripts see the same files MALLET would have written:
+#
+#    MODELNAME.doc-topics          docnum<tab>docID<tab>p_0<tab>...<tab>p_K-1
+#    MODELNAME.word-topic-counts   typeindex word topic:count topic:count ...
+#    MODELNAME.topic-word-weights  topic<tab>word<tab>weight (beta + count)
+#    MODELNAME.topic-keys          topic<tab>alpha<tab>top words
+#    MODELNAME.topic-state.gz      one line per token, as in MALLET's --output-state
+#
+#  MALLET's binary --output-model is replaced by a NumPy .npz archive with the
+#  vocabulary, word-topic counts and hyperparameters (see save_model).
+#  Documents can be given topic proportions under fixed topics by fold-in
+#  (see fold_in), the counterpart of MALLET's inferencer. State files are
+#  read back with read_state, as for MALLET's --input-state, or streamed a
+#  chunk at a time with iter_state.
+#
+#  The input corpus is the docID<tab>label<tab>text file that MALLET imports,
+#  tokenized on whitespace (MALLET's --token-regex '\S+' --preserve-case).
+#  Word type indices follow first occurrence, as in a MALLET alphabet.
+#
+################################################################
+import csv
+import gzip
+import io
+import sys
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+
+class Corpus:
+    '''
+    Documents as one flat array of word type indices (WORDS), with document
+    boundaries in DOC_PTR: document d is words[doc_ptr[d]:doc_ptr[d+1]].
+    '''
+    def __init__(self, names, vocab, doc_ptr, words):
+        self.names   = names
+        self.vocab   = vocab
+        self.doc_ptr = doc_ptr
+        self.words   = words
+
+    @property
+    def num_docs(self):
+        return len(self.names)
+
+    @property
+    def num_tokens(self):
+        return len(self.words)
+
+    def doc_lengths(self):
+        return np.diff(self.doc_ptr)
+
+    def token_docs(self):
+        # Document index of every token
+        return np.repeat(np.arange(self.num_docs, dtype=np.int32), self.doc_lengths())
+
+
+def iter_documents(path):
+    # (docID, tokens) for each line of a docID<tab>label<tab>text file
+    with open(path, encoding='utf-8', errors='replace') as f:
+        for line in f:
+            fields = line.rstrip('\r\n').split('\t', 2)
+            yield fields[0], (fields[2].split() if len(fields) > 2 else [])
+
+
+def read_corpus(path, vocab=None):
+    '''
+    Reads a docID<tab>label<tab>text file into a Corpus. With VOCAB (a list of words)
+    the type indices are fixed and unknown words are dropped, as for inference on new
+    documents; otherwise the vocabulary is built in first-occurrence order.
+    '''
+    if vocab is None:
+        index = {}
+        grow  = True
+    else:
+        index = {w: i for i, w in enumerate(vocab)}
+        grow  = False
+    names   = []
+    doc_ptr = [0]
+    words   = []
+    for name, tokens in iter_documents(path):
+        if grow:
+            ids = [index.setdefault(t, len(index)) for t in tokens]
+        else:
+            ids = [index[t] for t in tokens if t in index]
+        words.extend(ids)
+        names.append(name)
+        doc_ptr.append(len(words))
+    if grow:
+        vocab = list(index)
+    return Corpus(names, list(vocab), np.array(doc_ptr, dtype=np.int64), np.array(words, dtype=np.int32))
+
+
+def iter_batches(path, index, batch_size, skip=0):
+    '''
+    Yields (names, X) for successive batches of BATCH_SIZE documents, X being a sparse
+    documents x vocabulary count matrix over the words in INDEX (a dict from word to
+    column); other words are dropped. The first SKIP documents are skipped.
+    '''
+    names, rows, cols = [], [], []
+    for d, (name, tokens) in enumerate(iter_documents(path)):
+        if d < skip:
+            continue
+        ids = [index[t] for t in tokens if t in index]
+        rows.extend([len(names)] * len(ids))
+        cols.extend(ids)
+        names.append(name)
+        if len(names) == batch_size:
+            yield names, count_matrix(rows, cols, len(names), len(index))
+            names, rows, cols = [], [], []
+    if names:
+        yield names, count_matrix(rows, cols, len(names), len(index))
+
+
+def count_matrix(rows, cols, num_docs, num_types):
+    X = sp.coo_matrix((np.ones(len(rows)), (rows, cols)), shape=(num_docs, num_types)).tocsr()
+    X.sum_duplicates()
+    return X
+
+
+def fold_in(X, phi, alpha, iterations=50, tolerance=1e-4):
+    '''
+    Topic counts for the documents in X (sparse documents x vocabulary counts) under
+    fixed topics PHI (K x V, rows are distributions over words): EM for each document's
+    topic proportions with Dirichlet(ALPHA) smoothing, all documents at once.
+    Returns the D x K expected topic counts; pass them to doc_topic_proportions.
+    '''
+    num_docs    = X.shape[0]
+    alpha       = np.asarray(alpha, dtype=np.float64)
+    doc_lengths = np.asarray(X.sum(axis=1)).ravel()
+    doc_of_nnz  = np.repeat(np.arange(num_docs), np.diff(X.indptr))
+    phi_nnz     = phi[:, X.indices].T
+    theta       = np.full((num_docs, len(alpha)), 1.0 / len(alpha))
+    for _ in range(iterations):
+        denom = np.einsum('nk,nk->n', theta[doc_of_nnz], phi_nnz) + 1e-100
+        S     = sp.csr_matrix((X.data / denom, X.indices, X.indptr), shape=X.shape)
+        ndk   = theta * (S @ phi.T)
+        new   = (ndk + alpha) / (doc_lengths[:, None] + alpha.sum())
+        done  = np.abs(new - theta).max() < tolerance
+        theta = new
+        if done:
+            break
+    return ndk
+
+
+def fold_in_doc_topics(path, corpus_path, vocab, phi, alpha, batch_size=4096):
+    # Streams the documents in CORPUS_PATH through fold_in, writing a doc-topics file to PATH
+    index = {w: i for i, w in enumerate(vocab)}
+    alpha = np.asarray(alpha, dtype=np.float64)
+    start = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        for names, X in iter_batches(corpus_path, index, batch_size):
+            append_doc_topics(f, start, names, doc_topic_proportions(fold_in(X, phi, alpha), alpha))
+            start += len(names)
+    sys.stderr.write("Wrote {}\n".format(path))
+
+
+def doc_topic_proportions(ndk, alpha):
+    # MALLET's doc-topics values: (n_dk + alpha_k) / (n_d + sum(alpha))
+    theta = ndk + alpha[None, :]
+    return theta / theta.sum(axis=1, keepdims=True)
+
+
+def append_doc_topics(f, start, names, theta):
+    # Rows for documents START, START+1, ... to an open doc-topics file, for writers that stream
+    for d, (name, row) in enumerate(zip(names, theta.tolist()), start):
+        f.write("{}\t{}\t{}\n".format(d, name, '\t'.join(map(repr, row))))
+
+
+def write_doc_topics(path, names, theta):
+    with open(path, 'w', encoding='utf-8') as f:
+        append_doc_topics(f, 0, names, theta)
+
+
+def write_word_topic_counts(path, vocab, nkw):
+    # NKW is V x K; counts are rounded for backends whose counts are expectations
+    counts = np.rint(nkw).astype(np.int64)
+    with open(path, 'w', encoding='utf-8') as f:
+        for v, word in enumerate(vocab):
+            row    = counts[v]
+            topics = np.flatnonzero(row)
+            topics = topics[np.argsort(-row[topics], kind='stable')]
+            pairs  = ' '.join("{}:{}".format(k, row[k]) for k in topics)
+            f.write("{} {} {}\n".format(v, word, pairs) if pairs else "{} {}\n".format(v, word))
+
+
+def read_word_topic_counts(path, num_topics):
+    # Reads a word-topic-counts file back as (vocab, V x K counts)
+    vocab = []
+    pairs = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            fields = line.split()
+            vocab.append(fields[1])
+            pairs.append(fields[2:])
+    nkw = np.zeros((len(vocab), num_topics), dtype=np.int64)
+    for v, row in enumerate(pairs):
+        for pair in row:
+            k, count = pair.split(':')
+            nkw[v, int(k)] = int(count)
+    return vocab, nkw
+
+
+def write_topic_word_weights(path, vocab, weights):
+    # WEIGHTS is V x K, unnormalized (beta + count); topic-major, words in type order, as MALLET writes it
+    with open(path, 'w', encoding='utf-8') as f:
+        for k in range(weights.shape[1]):
+            prefix = "{}\t".format(k)
+            f.write(''.join(prefix + w + '\t' + repr(x) + '\n' for w, x in zip(vocab, weights[:, k].tolist())))
+
+
+def write_topic_keys(path, vocab, weights, alpha, num_words=20):
+    top = np.argsort(-weights, axis=0, kind='stable')[:num_words]
+    with open(path, 'w', encoding='utf-8') as f:
+        for k in range(weights.shape[1]):
+            f.write("{}\t{}\t{}\n".format(k, alpha[k], ' '.join(vocab[v] for v in top[:, k])))
+
+
+def write_state(path, corpus, z, alpha, beta):
+    # Same layout as MALLET's --output-state, so it can be read back with --input-state
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        f.write("#doc source pos typeindex type topic\n")
+        f.write("#alpha : {}\n".format(' '.join(map(repr, np.asarray(alpha).tolist()))))
+        f.write("#beta : {}\n".format(beta))
+        vocab = corpus.vocab
+        for d in range(corpus.num_docs):
+            lo, hi = corpus.doc_ptr[d], corpus.doc_ptr[d + 1]
+            if lo == hi:
+                continue
+            prefix = "{} NA ".format(d)
+            f.write(''.join("{}{} {} {} {}\n".format(prefix, pos, w, vocab[w], t)
+                            for pos, (w, t) in enumerate(zip(corpus.words[lo:hi].tolist(), z[lo:hi].tolist()))))
+
+
+def iter_state(path, chunk_bytes=64 << 20):
+    '''
+    Streams a state file in MALLET's --output-state layout, decompressing CHUNK_BYTES at a time.
+    Yields ('header', alpha, beta) once the #alpha and #beta lines have been read, then for each
+    chunk ('tokens', doc, word, topic, new_types): per-token arrays in file order, and a dict
+    mapping each type index seen for the first time in the chunk to its word. The integer
+    columns are parsed by pandas' C parser, and words are only decoded for new types.
+    '''
+    alpha, beta = None, None
+    header      = True
+    seen        = np.zeros(0, dtype=bool)
+    rest        = b''
+    with gzip.open(path, 'rb') as f:
+        while True:
+            block = f.read(chunk_bytes)
+            data  = rest + block
+            if block:
+                cut  = data.rfind(b'\n') + 1
+                data, rest = data[:cut], data[cut:]
+            if header:
+                start = 0
+                while data.startswith(b'#', start):
+                    end   = data.find(b'\n', start)
+                    end   = len(data) if end < 0 else end
+                    line  = data[start:end].decode('utf-8')
+                    start = end + 1
+                    if line.startswith('#alpha :'):
+                        alpha = np.array(line.split(':', 1)[1].split(), dtype=np.float64)
+                    elif line.startswith('#beta :'):
+                        beta = float(line.split(':', 1)[1])
+                data = data[start:]
+                if data or not block:
+                    header = False
+                    yield 'header', alpha, beta
+            if not header and data:
+                # Line I is data[starts[I]:ends[I]]
+                ends   = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord('\n'))
+                if not data.endswith(b'\n'):
+                    ends = np.append(ends, len(data))
+                starts = np.concatenate([[0], ends[:-1] + 1])
+                doc, word, topic = state_columns(data, len(ends))
+                types, first = np.unique(word, return_index=True)
+                if types[-1] >= len(seen):
+                    seen = np.concatenate([seen, np.zeros(types[-1] + 1 - len(seen), dtype=bool)])
+                new   = ~seen[types]
+                seen[types[new]] = True
+                # The word is the second field from the right (see state_columns)
+                yield 'tokens', doc, word, topic, {int(t): data[starts[i]:ends[i]].rsplit(b' ', 2)[1].decode('utf-8')
+                                                   for t, i in zip(types[new], first[new])}
+            if not block:
+                break
+
+
+def state_columns(data, num_lines):
+    '''
+    The doc, typeindex and topic columns of NUM_LINES lines of a state file (doc source pos
+    typeindex type topic) in DATA, as int64, int32 and int32 arrays. The source may itself
+    contain spaces, in which case the C parser sees extra fields and each line is split
+    from the right instead.
+    '''
+    try:
+        table = pd.read_csv(io.BytesIO(data), sep=' ', header=None, names=range(6), usecols=[0, 3, 5],
+                            dtype=np.int64, engine='c', quoting=csv.QUOTE_NONE, skip_blank_lines=False)
+        if len(table) == num_lines:
+            return table[0].to_numpy(), table[3].to_numpy(np.int32), table[5].to_numpy(np.int32)
+    except (ValueError, pd.errors.ParserError):
+        pass
+    fields = np.array([[line.split(b' ', 1)[0]] + line.rsplit(b' ', 3)[1:] for line in data.splitlines()], dtype=object)
+    return fields[:, 0].astype(np.int64), fields[:, 1].astype(np.int32), fields[:, 3].astype(np.int32)
+
+
+def read_state(path):
+    '''
+    Reads a state file in MALLET's --output-state layout (as write_state writes it).
+    Returns a dict with 'alpha', 'beta', 'vocab' (words by the state's type index) and
+    per-token arrays 'doc', 'word' (type index) and 'topic', in file order.
+    See topic_state.py for states too large to hold in memory.
+    '''
+    alpha, beta = None, None
+    docs, words, topics = [], [], []
+    types = {}
+    for item in iter_state(path):
+        if item[0] == 'header':
+            _, alpha, beta = item
+            continue
+        _, doc, word, topic, new_types = item
+        docs.append(doc)
+        words.append(word)
+        topics.append(topic)
+        types.update(new_types)
+    vocab = [''] * (max(types) + 1 if types else 0)
+    for index, word in types.items():
+        vocab[index] = word
+    return {'alpha': alpha, 'beta': beta, 'vocab': vocab,
+            'doc':   np.concatenate(docs)   if docs else np.zeros(0, dtype=np.int64),
+            'word':  np.concatenate(words)  if words else np.zeros(0, dtype=np.int32),
+            'topic': np.concatenate(topics) if topics else np.zeros(0, dtype=np.int32)}
+
+
+def save_model(path, vocab, nkw, alpha, beta, **extra):
+    # Written through a file handle so np.savez doesn't add .npz to MALLET-style names like MODELNAME.model
+    with open(path, 'wb') as f:
+        np.savez(f, vocab=np.array(vocab, dtype=str), nkw=nkw, alpha=np.asarray(alpha), beta=beta, **extra)
+
+
+def load_model(path):
+    with np.load(path) as npz:
+        model = {key: npz[key] for key in npz.files}
+    model['vocab'] = model['vocab'].tolist()
+    model['beta']  = float(model['beta'])
+    return model
+
+
+def write_mallet_outputs(outputs, vocab, nkw, alpha, beta, weights=None, names=None, ndk=None, corpus=None, z=None):
+    '''
+    Writes whichever of MALLET's train-topics outputs are requested in OUTPUTS, a dict
+    keyed by MALLET option name ('output-doc-topics', 'word-topic-counts-file', ...)
+    giving the path. NKW is V x K word-topic counts (or expected counts) and WEIGHTS
+    the unnormalized topic-word weights, NKW + BETA by default. The doc-topics file
+    is written only given the document NAMES and their D x K topic counts NDK, the
+    state file only given the CORPUS and its per-token topics Z.
+    '''
+    alpha = np.asarray(alpha, dtype=np.float64)
+    if weights is None:
+        weights = nkw + beta
+    writers = {
+        'word-topic-counts-file':  lambda path: write_word_topic_counts(path, vocab, nkw),
+        'topic-word-weights-file': lambda path: write_topic_word_weights(path, vocab, weights),
+        'output-topic-keys':       lambda path: write_topic_keys(path, vocab, weights, alpha),
+        'output-model':            lambda path: save_model(path, vocab, nkw, alpha, beta),
+    }
+    if ndk is not None:
+        writers['output-doc-topics'] = lambda path: write_doc_topics(path, names, doc_topic_proportions(ndk, alpha))
+    if corpus is not None and z is not None:
+        writers['output-state'] = lambda path: write_state(path, corpus, z, alpha, beta)
+    for option, write in writers.items():
+        if outputs.get(option):
+            write(outputs[option])
+            sys.stderr.write("Wrote {}\n".format(outputs[option]))
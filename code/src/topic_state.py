@@ -0,0 +1,266 @@
+################################################################
+#
+#  Token-level topic assignments from a MALLET topic-state file, as memory-mapped arrays
+#
+#  MODELNAME.topic-state.gz has every token's topic assignment, one text
+#  line per token, so it is several times the size of the corpus. This
+#  streams it a chunk at a time (topic_model_io.iter_state) into compact
+#  arrays that sit side by side, like a document store (docstore.py):
+#
+#    PREFIX.doc.npy     int32 document index of every token, in file order
+#    PREFIX.term.npy    type index of every token (uint16 if the vocabulary allows, else int32)
+#    PREFIX.topic.npy   topic of every token (uint16 if the topics allow, else int32)
+#    PREFIX.vocab.txt   the word for each type index, one per line
+#    PREFIX.json        alpha, beta and the array sizes
+#
+#  Memory use is bounded by the chunk size and the vocabulary, however
+#  many tokens there are: the arrays are written as each chunk is parsed.
+#  TopicState memory-maps them for per-document term-topic breakdowns,
+#  or recomputes document-topic and word-topic counts a block of tokens
+#  at a time without reading the state file again.
+#
+#  Example:
+#    python topic_state.py
+#      --state   /path/to/modeling/model_k20/mallet_output/analysis.topic-state.gz
+#      --output  /path/to/modeling/model_k20/mallet_output/analysis.topic-state
+#      --model_doc_topics /path/to/modeling/model_k20/mallet_output/analysis.doc-topics
+#
+#  Empty documents have no tokens in the state, so the number of documents
+#  comes from the model's doc-topics file (or --num_docs).
+#
+#  Example:  use the arrays from another script in this directory
+#    from topic_state import TopicState
+#    state = TopicState('/path/to/modeling/model_k20/mallet_output/analysis.topic-state')
+#    ndk   = state.doc_topic_counts()
+#    terms, topics = state.document(42)
+#
+################################################################
+import argparse
+import json
+import os
+import struct
+import sys
+
+import numpy as np
+
+import topic_model_io
+
+default_chunk_mb = 64
+block_tokens     = 1 << 22
+header_bytes     = 128          # .npy header, padded so that the final shape always fits
+
+
+def array_file(prefix, name):
+    return "{}.{}.npy".format(prefix, name)
+
+
+def vocab_file(prefix):
+    return prefix + '.vocab.txt'
+
+
+def meta_file(prefix):
+    return prefix + '.json'
+
+
+def compact_dtype(limit):
+    # Smallest of uint16 and int32 that holds values below LIMIT
+    return np.uint16 if limit <= np.iinfo(np.uint16).max + 1 else np.int32
+
+
+def npy_header(dtype, length, row_shape=()):
+    # A version 1.0 .npy header of exactly HEADER_BYTES for LENGTH rows of shape ROW_SHAPE (scalars by default)
+    text = "{{'descr': {!r}, 'fortran_order': False, 'shape': {}, }}".format(np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                                                                          (length,) + tuple(row_shape))
+    text = text.ljust(header_bytes - 10 - 1) + '\n'
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(text)) + text.encode('latin1')
+
+
+class ArrayWriter:
+    '''
+    Appends to a .npy file whose length is not known in advance: the header is
+    rewritten with the final length on close. Rows are scalars, or arrays of
+    shape ROW_SHAPE (e.g. (K,) for a D x K array written a block of rows at a time).
+    '''
+    def __init__(self, path, dtype, row_shape=()):
+        self.path      = path
+        self.dtype     = np.dtype(dtype)
+        self.row_shape = tuple(row_shape)
+        self.length    = 0
+        self.f         = open(path + '.tmp', 'wb')
+        self.f.write(npy_header(self.dtype, 0, self.row_shape))
+
+    def write(self, values):
+        values = np.ascontiguousarray(values, dtype=self.dtype)
+        if values.shape[1:] != self.row_shape:
+            raise ValueError("rows of shape {} written to {}, which has rows of shape {}".format(values.shape[1:], self.path, self.row_shape))
+        self.f.write(values.tobytes())
+        self.length += len(values)
+
+    def discard(self):
+        # Abandons the file, e.g. when what was being written turns out to be invalid
+        self.f.close()
+        os.remove(self.path + '.tmp')
+
+    def close(self):
+        self.f.seek(0)
+        self.f.write(npy_header(self.dtype, self.length, self.row_shape))
+        self.f.close()
+        os.replace(self.path + '.tmp', self.path)
+
+
+def convert_state(state_path, prefix, chunk_mb=default_chunk_mb, num_types=None, num_topics=None, num_docs=None):
+    '''
+    Streams the state file STATE_PATH into the arrays at PREFIX (see above). The term and
+    topic arrays are uint16 when NUM_TYPES and NUM_TOPICS allow it; the number of topics is
+    read from the state's #alpha line, and without NUM_TYPES terms are int32 (the vocabulary
+    is only known at the end). Empty documents have no lines in the state, so NUM_DOCS should
+    be given: otherwise the count ends at the last non-empty document. Values at or beyond
+    the given sizes are a ValueError, leaving no arrays behind, rather than wrapping around.
+    Returns the contents of PREFIX.json.
+    '''
+    os.makedirs(os.path.dirname(os.path.abspath(prefix)), exist_ok=True)
+    items = topic_model_io.iter_state(state_path, int(chunk_mb * (1 << 20)))
+    _, alpha, beta = next(items)
+    num_topics = num_topics or len(alpha)
+    limits  = {'doc':   ('documents', num_docs),
+               'term':  ('types',     num_types),
+               'topic': ('topics',    num_topics)}
+    writers = {'doc':   ArrayWriter(array_file(prefix, 'doc'),   np.int32),
+               'term':  ArrayWriter(array_file(prefix, 'term'),  compact_dtype(num_types) if num_types else np.int32),
+               'topic': ArrayWriter(array_file(prefix, 'topic'), compact_dtype(num_topics))}
+    types   = {}
+    last    = -1
+    try:
+        for _, doc, word, topic, new_types in items:
+            for name, values in (('doc', doc), ('term', word), ('topic', topic)):
+                what, limit = limits[name]
+                if limit and len(values) and values.max() >= limit:
+                    raise ValueError("{} has {} index {}, but there are {} {}".format(state_path, name, values.max(), limit, what))
+                writers[name].write(values)
+            types.update(new_types)
+            last = doc[-1] if len(doc) else last
+    except BaseException:
+        for w in writers.values():
+            w.discard()
+        raise
+    for w in writers.values():
+        w.close()
+
+    vocab = [''] * (max(types) + 1 if types else 0)
+    for index, word in types.items():
+        vocab[index] = word
+    with open(vocab_file(prefix), 'w', encoding='utf-8') as f:
+        f.writelines(word + '\n' for word in vocab)
+    doc  = np.load(array_file(prefix, 'doc'), mmap_mode='r')
+    meta = {'state':      os.path.abspath(state_path),
+            'alpha':      np.asarray(alpha).tolist(),
+            'beta':       beta,
+            'num_tokens': len(doc),
+            'num_docs':   num_docs or int(last) + 1,
+            'num_types':  len(vocab),
+            'num_topics': num_topics}
+    with open(meta_file(prefix), 'w') as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+class TopicState:
+    '''
+    Read-only access to the arrays written by convert_state(). Tokens are in state file
+    order, so each document's tokens are contiguous and documents are in increasing order.
+    '''
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        with open(meta_file(prefix)) as f:
+            self.meta = json.load(f)
+        self.alpha  = np.array(self.meta['alpha'])
+        self.beta   = self.meta['beta']
+        self.doc    = np.load(array_file(prefix, 'doc'),   mmap_mode='r')
+        self.term   = np.load(array_file(prefix, 'term'),  mmap_mode='r')
+        self.topic  = np.load(array_file(prefix, 'topic'), mmap_mode='r')
+        with open(vocab_file(prefix), encoding='utf-8') as f:
+            self.vocab = [line.rstrip('\n') for line in f]
+        self._doc_ptr = None
+
+    @property
+    def num_docs(self):
+        return self.meta['num_docs']
+
+    @property
+    def num_topics(self):
+        return self.meta['num_topics']
+
+    def doc_ptr(self):
+        # Document d's tokens are DOC_PTR[d]:DOC_PTR[d+1] (empty documents have no tokens in the state)
+        if self._doc_ptr is None:
+            self._doc_ptr = np.searchsorted(self.doc, np.arange(self.num_docs + 1))
+        return self._doc_ptr
+
+    def document(self, d):
+        # Type indices and topics of document D's tokens
+        ptr = self.doc_ptr()
+        return np.asarray(self.term[ptr[d]:ptr[d + 1]]), np.asarray(self.topic[ptr[d]:ptr[d + 1]])
+
+    def document_breakdown(self, d):
+        # Document D's term-topic counts: {(word, topic): count}
+        terms, topics = self.document(d)
+        pairs, counts = np.unique(terms.astype(np.int64) * self.num_topics + topics, return_counts=True)
+        return {(self.vocab[p // self.num_topics], int(p % self.num_topics)): int(c) for p, c in zip(pairs.tolist(), counts.tolist())}
+
+    def _counts(self, rows, num_rows):
+        # NUM_ROWS x K counts of (ROWS, topic) over all tokens, a block at a time
+        K      = self.num_topics
+        counts = np.zeros(num_rows * K, dtype=np.int64)
+        for start in range(0, len(self.topic), block_tokens):
+            stop    = start + block_tokens
+            counts += np.bincount(np.asarray(rows[start:stop], dtype=np.int64) * K + self.topic[start:stop],
+                                  minlength=num_rows * K)
+        return counts.reshape(num_rows, K)
+
+    def doc_topic_counts(self):
+        # D x K topic counts of each document
+        return self._counts(self.doc, self.num_docs)
+
+    def word_topic_counts(self):
+        # V x K topic counts of each word type
+        return self._counts(self.term, len(self.vocab))
+
+    def doc_topic_proportions(self):
+        # D x K proportions, smoothed by alpha as in MALLET's --output-doc-topics
+        return topic_model_io.doc_topic_proportions(self.doc_topic_counts(), self.alpha)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Stream a MALLET topic-state file into memory-mapped token arrays')
+    parser.add_argument('--state',      required=True, help='MODELNAME.topic-state.gz')
+    parser.add_argument('--output',     default=None,  help='Prefix for the output files (default: the state path without .gz)')
+    parser.add_argument('--chunk_mb',   type=float, default=default_chunk_mb, help='Decompressed MB parsed at a time')
+    parser.add_argument('--num_types',  type=int, default=None, help='Vocabulary size, if known, so terms can be stored as uint16')
+    parser.add_argument('--num_docs',   type=int, default=None, help='Number of documents, including empty ones (default: from --model_doc_topics)')
+    parser.add_argument('--model_doc_topics', default=None, help='The model\'s MODELNAME.doc-topics, one row per document, to count the documents')
+    parser.add_argument('--doc_topics', default=None, help='Also write document-topic proportions recomputed from the state, in MALLET\'s doc-topics layout')
+    args   = parser.parse_args()
+    prefix = args.output or (args.state[:-3] if args.state.endswith('.gz') else args.state)
+
+    for name in ('num_types', 'num_docs'):
+        if getattr(args, name) is not None and getattr(args, name) <= 0:
+            parser.error("--{} must be positive".format(name))
+    num_docs = args.num_docs
+    if num_docs is None and args.model_doc_topics:
+        with open(args.model_doc_topics, encoding='utf-8') as f:
+            num_docs = sum(1 for line in f if line.strip() and not line.startswith('#'))
+    if num_docs is None:
+        sys.stderr.write("Warning: without --num_docs or --model_doc_topics, empty documents after the last non-empty one aren't counted\n")
+
+    try:
+        meta = convert_state(args.state, prefix, args.chunk_mb, args.num_types, num_docs=num_docs)
+    except ValueError as e:
+        sys.stderr.write("Error: {}\n".format(e))
+        sys.exit(1)
+    sys.stderr.write("{} tokens, {} documents, {} types, {} topics; wrote {}.*\n".format(
+        meta['num_tokens'], meta['num_docs'], meta['num_types'], meta['num_topics'], prefix))
+    if args.doc_topics:
+        state = TopicState(prefix)
+        topic_model_io.write_doc_topics(args.doc_topics, [str(d) for d in range(state.num_docs)], state.doc_topic_proportions())
+        sys.stderr.write("Wrote {}\n".format(args.doc_topics))
@@ -0,0 +1,183 @@
+################################################################
+#
+#  Warm-start a topic model on a refreshed corpus from a previous run
+#
+#  When a docket is refreshed with new comments, the previous model's
+#  topic assignments are a far better starting point than random ones.
+#  This writes a state file for the new corpus, in MALLET's
+#  --output-state layout, for train-topics --input-state (MALLET or the
+#  gibbs backend) to continue from:
+#
+#    documents already in the previous run (same preprocessed tokens)
+#      keep their previous topic assignments exactly; copies of the
+#      same text are matched to the previous copies in order
+#    new or changed documents
+#      get topic proportions by fold-in under the previous topics
+#      (topic_model_io.fold_in), and each token a topic sampled from
+#      its posterior given those proportions
+#
+#  Topic k of the new model starts as topic k of the previous one, so
+#  topic numbering (and curated labels) carry over. compare_topics
+#  reports how far each topic moved in the retraining.
+#
+#  Used by run_mallet.py --warm_start; can also be run on its own.
+#
+#  Example:
+#    python warm_start.py
+#      --previous_state  /path/to/old/model_k20/mallet_output/analysis.topic-state.gz
+#      --input           /path/to/modeling/processed/analysis_preprocessed.txt
+#      --output_state    /path/to/modeling/analysis.k20.warm-start-state.gz
+#
+################################################################
+import argparse
+import collections
+import gzip
+import hashlib
+import sys
+
+import numpy as np
+
+import topic_model_io
+
+batch_size = 4096
+
+
+def state_digest(path):
+    # Identifies a previous state for the model store: warm-started models depend on it
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def state_num_topics(path):
+    # Number of topics in a state file, from its #alpha line, without reading the tokens
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            if line.startswith('#alpha :'):
+                return len(line.split(':', 1)[1].split())
+            if not line.startswith('#'):
+                break
+    return None
+
+
+def previous_documents(state):
+    # Maps each previous document's text (tokens joined by spaces) to the ranges of its copies' tokens in the state, in order
+    vocab  = state['vocab']
+    starts = np.flatnonzero(np.diff(state['doc'], prepend=-1))
+    ends   = np.append(starts[1:], len(state['doc']))
+    docs   = collections.defaultdict(collections.deque)
+    for lo, hi in zip(starts.tolist(), ends.tolist()):
+        docs[' '.join(vocab[w] for w in state['word'][lo:hi].tolist())].append((lo, hi))
+    return docs
+
+
+def word_topic_counts(state, num_topics):
+    # V x K counts over the state's type indices
+    nkw = np.zeros((len(state['vocab']), num_topics), dtype=np.int64)
+    np.add.at(nkw, (state['word'], state['topic']), 1)
+    return nkw
+
+
+def sample_topics(corpus, docs, phi, alpha, rng):
+    # Topic for every token of DOCS: fold-in proportions, then a draw from each token's posterior
+    lengths = corpus.doc_lengths()[docs]
+    rows    = np.repeat(np.arange(len(docs)), lengths)
+    tokens  = np.concatenate([np.arange(corpus.doc_ptr[d], corpus.doc_ptr[d + 1]) for d in docs])
+    words   = corpus.words[tokens]
+    X       = topic_model_io.count_matrix(rows, words, len(docs), len(corpus.vocab))
+    theta   = topic_model_io.doc_topic_proportions(topic_model_io.fold_in(X, phi, alpha), alpha)
+    p       = theta[rows] * phi[:, words].T
+    cum     = np.cumsum(p, axis=1)
+    u       = rng.random(len(words)) * cum[:, -1]
+    return tokens, np.minimum((cum < u[:, None]).sum(axis=1), len(alpha) - 1).astype(np.int32)
+
+
+def seed_state(previous_path, corpus_path, output_path, seed=0):
+    '''
+    Writes to OUTPUT_PATH a state file for the documents in CORPUS_PATH (docID<tab>label<tab>text),
+    seeded from the state file PREVIOUS_PATH. Returns a summary dict, which also holds the
+    previous run's vocabulary and word-topic counts for compare_topics.
+    '''
+    previous   = topic_model_io.read_state(previous_path)
+    alpha      = previous['alpha']
+    beta       = previous['beta']
+    num_topics = len(alpha)
+    corpus     = topic_model_io.read_corpus(corpus_path)
+    rng        = np.random.default_rng(seed)
+
+    # Previous topics as distributions over the new vocabulary, for inferring new documents
+    previous_nkw = word_topic_counts(previous, num_topics)
+    index  = {w: i for i, w in enumerate(corpus.vocab)}
+    mapped = np.array([index.get(w, -1) for w in previous['vocab']], dtype=np.int64)
+    nkw    = np.zeros((len(corpus.vocab), num_topics))
+    known  = mapped >= 0
+    nkw[mapped[known]] = previous_nkw[known]
+    vbeta  = max(len(previous['vocab']), len(corpus.vocab)) * beta
+    phi    = ((nkw + beta) / (previous_nkw.sum(axis=0) + vbeta)).T
+
+    # Documents the previous run saw keep their assignments, each copy of a text taking the next previous copy's
+    old_docs = previous_documents(previous)
+    z        = np.zeros(corpus.num_tokens, dtype=np.int32)
+    infer    = []
+    reused   = 0
+    for d in range(corpus.num_docs):
+        lo, hi = corpus.doc_ptr[d], corpus.doc_ptr[d + 1]
+        if lo == hi:
+            continue
+        copies = old_docs.get(' '.join(corpus.vocab[w] for w in corpus.words[lo:hi].tolist()))
+        if not copies:
+            infer.append(d)
+        else:
+            match    = copies.popleft()
+            z[lo:hi] = previous['topic'][match[0]:match[1]]
+            reused  += 1
+    for start in range(0, len(infer), batch_size):
+        tokens, topics = sample_topics(corpus, infer[start:start + batch_size], phi, alpha, rng)
+        z[tokens] = topics
+
+    topic_model_io.write_state(output_path, corpus, z, alpha, beta)
+    sys.stderr.write("Warm start: {} documents keep their previous topics, {} new or changed documents inferred; "
+                     "wrote {}\n".format(reused, len(infer), output_path))
+    return {'previous_state':  previous_path,
+            'num_topics':      num_topics,
+            'reused_docs':     reused,
+            'inferred_docs':   len(infer),
+            'previous_vocab':  previous['vocab'],
+            'previous_counts': previous_nkw}
+
+
+def compare_topics(previous_vocab, previous_counts, vocab, counts):
+    '''
+    Cosine similarity between each topic's word distribution before and after retraining
+    (V x K counts over each run's own vocabulary, aligned by word). Returns one dict per
+    topic with its similarity to the previous topic of the same number, and the previous
+    topic it is now most similar to.
+    '''
+    index = {w: i for i, w in enumerate(previous_vocab)}
+    union = list(previous_vocab) + [w for w in vocab if w not in index]
+    index = {w: i for i, w in enumerate(union)}
+    old   = np.zeros((len(union), previous_counts.shape[1]))
+    new   = np.zeros((len(union), counts.shape[1]))
+    old[:len(previous_vocab)] = previous_counts
+    new[[index[w] for w in vocab]] = counts
+    old  /= np.maximum(np.linalg.norm(old, axis=0), 1e-12)
+    new  /= np.maximum(np.linalg.norm(new, axis=0), 1e-12)
+    sim   = old.T @ new
+    best  = sim.argmax(axis=0)
+    return [{'topic':                 k,
+             'similarity':            round(float(sim[k, k]), 4) if k < sim.shape[0] else None,
+             'closest_previous':      int(best[k]),
+             'closest_similarity':    round(float(sim[best[k], k]), 4)}
+            for k in range(sim.shape[1])]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Seed a topic model state for a refreshed corpus from a previous run')
+    parser.add_argument('--previous_state', required=True, help='Previous run\'s MODELNAME.topic-state.gz')
+    parser.add_argument('--input',          required=True, help='New docID<tab>label<tab>text file')
+    parser.add_argument('--output_state',   required=True, help='State file to write, for train-topics --input-state')
+    parser.add_argument('--random_seed',    type=int, default=0)
+    args = parser.parse_args()
+    seed_state(args.previous_state, args.input, args.output_state, args.random_seed)